@@ -0,0 +1,889 @@
+import os
+import sys
+import re
+import json
+import time
+import random
+import resource
+import argparse
+import tempfile
+import datetime
+import statistics
+import configparser
+import multiprocessing
+import urllib.parse
+import io
+import csv
+import gzip
+from threading import Lock, Thread
+from functools import lru_cache
+from collections import Counter, OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+### End-to-end benchmark ###
+############################
+# Runs OCIService.extract_data against a local stand-in for the Identity,
+# Compute, Blockstorage, Database, Limits, Monitoring, Announcements and
+# Resource Search endpoints and a fake PAR upload target, and reports wall time, API calls,
+# peak RSS and upload bytes per run.
+#
+#   python benchmark.py --scenario medium --engine threads async --output run.json
+#   python benchmark.py --scenario medium --baseline run.json
+#
+# The tenancies are synthetic and generated from a scenario: the built-in
+# ones below or sections of an ini file passed with --scenarios. Every run
+# extracts in a fresh process so its peak RSS is its own.
+
+TENANCY_ID = 'ocid1.tenancy.oc1..benchmark'
+
+REGIONS = [
+   ( 'IAD', 'us-ashburn-1' ), ( 'PHX', 'us-phoenix-1' ), ( 'FRA', 'eu-frankfurt-1' ), ( 'LHR', 'uk-london-1' ),
+   ( 'AMS', 'eu-amsterdam-1' ), ( 'NRT', 'ap-tokyo-1' ), ( 'SYD', 'ap-sydney-1' ), ( 'GRU', 'sa-saopaulo-1' )
+]
+
+### Synthetic tenancies ###
+###########################
+# Counts are per region x compartment unless noted.
+DEFAULTS = {
+   'regions': 2,
+   'compartments': 5,
+   'availability_domains': 1,   # per region
+   'instances': 4,
+   'dedicated_vm_hosts': 0,
+   'volumes': 4,
+   'db_systems': 1,
+   'databases': 1,              # per db home
+   'autonomous_dbs': 1,
+   'images': 1,
+   'platform_images': 20,       # per region
+   'services': 5,               # limits services per region
+   'limits': 10,                # per service
+   'announcements': 10,
+   'datapoints': 60,            # most datapoints per series per metrics query
+   'page_size': 100,            # most records per page of a list call
+   'latency_ms': 20,
+   'latency_jitter_ms': 10,
+   'throttle_rps': 0,           # calls per second per region and service before 429s - 0 for none
+   'throttle_fraction': 0,      # share of the calls answered with a 429 at random
+}
+
+SCENARIOS = OrderedDict([
+   ( 'small', {} ),
+   ( 'medium', { 'regions': 4, 'compartments': 25, 'availability_domains': 3, 'instances': 10, 'volumes': 10, 'datapoints': 24, 'throttle_rps': 50 } ),
+   ( 'large', { 'regions': 8, 'compartments': 100, 'availability_domains': 3, 'instances': 25, 'volumes': 25, 'db_systems': 2, 'autonomous_dbs': 3, 'services': 20, 'limits': 25, 'datapoints': 6, 'throttle_rps': 50 } ),
+   ( 'throttled', { 'regions': 2, 'compartments': 10, 'instances': 10, 'throttle_rps': 5, 'throttle_fraction': 0.05 } ),
+])
+
+### timestamps as the API sends them ###
+########################################
+def timestamp(value):
+   return value.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def parse_timestamp(value):
+   return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+class SyntheticTenancy(object):
+   def __init__(self, settings):
+      self.settings = settings
+      self.created = timestamp( datetime.datetime(2020, 1, 1) )
+      self.regions = [ REGIONS[i] if i < len(REGIONS) else ( f'R{i}', f'xx-region-{i}' ) for i in range(settings[ 'regions' ]) ]
+      self.compartments = [ f'ocid1.compartment.oc1..benchmark{c:05d}' for c in range(settings[ 'compartments' ]) ]
+      self.compartment_indexes = { c: i for i, c in enumerate(self.compartments) }
+      # Resource Search types whose query fails, like a type Search doesn't
+      # index in a region
+      self.unsearchable = set()
+      self.revision = 0
+
+   # renames the instances of the first compartment - a change Search shows
+   def revise(self):
+      self.revision += 1
+      SyntheticTenancy.instances.cache_clear()
+
+   def count(self, name):
+      return self.settings[ name ]
+
+   def ads(self, region):
+      return [ f'bench:{region.upper()}-AD-{a + 1}' for a in range(self.count('availability_domains')) ]
+
+   def compartment_index(self, compartment_id):
+      return self.compartment_indexes.get(compartment_id)
+
+   def scope(self, compartment_id, in_subtree):
+      if compartment_id == TENANCY_ID:
+         return self.compartments if in_subtree else []
+      return [ compartment_id ] if compartment_id in self.compartment_indexes else []
+
+   ### Identity ###
+   ################
+   def tenancy(self):
+      return { 'id': TENANCY_ID, 'name': 'benchmark', 'description': 'synthetic benchmark tenancy', 'homeRegionKey': self.regions[0][0] }
+
+   def region_subscriptions(self):
+      return [ { 'regionKey': key, 'regionName': name, 'status': 'READY', 'isHomeRegion': i == 0 } for i, ( key, name ) in enumerate(self.regions) ]
+
+   def compartment_list(self):
+      return [ { 'id': c, 'compartmentId': TENANCY_ID, 'name': f'compartment-{i}', 'description': 'synthetic', 'lifecycleState': 'ACTIVE', 'timeCreated': self.created } for i, c in enumerate(self.compartments) ]
+
+   def availability_domains(self, region):
+      return [ { 'id': f'ocid1.availabilitydomain.oc1..{region}-{i}', 'name': ad, 'compartmentId': TENANCY_ID } for i, ad in enumerate(self.ads(region)) ]
+
+   ### Compute ###
+   ###############
+   @lru_cache(maxsize=None)
+   def instances(self, region, compartment_id):
+      c = self.compartment_index(compartment_id)
+      if c is None:
+         return []
+      ads = self.ads(region)
+      return [ {
+         'id': f'ocid1.instance.oc1.{region}.c{c}i{i}', 'availabilityDomain': ads[i % len(ads)], 'compartmentId': compartment_id,
+         'displayName': f'instance-{c}-{i}' + ( f'-r{self.revision}' if c == 0 and self.revision else '' ), 'faultDomain': f'FAULT-DOMAIN-{i % 3 + 1}', 'lifecycleState': 'RUNNING',
+         'region': region, 'shape': 'VM.Standard.E4.Flex', 'timeCreated': self.created
+      } for i in range(self.count('instances')) ]
+
+   def dedicated_vm_hosts(self, region, compartment_id):
+      c = self.compartment_index(compartment_id)
+      if c is None:
+         return []
+      ads = self.ads(region)
+      return [ {
+         'id': f'ocid1.dedicatedvmhost.oc1.{region}.c{c}h{i}', 'availabilityDomain': ads[i % len(ads)], 'compartmentId': compartment_id,
+         'dedicatedVmHostShape': 'DVH.Standard2.52', 'displayName': f'host-{c}-{i}', 'faultDomain': 'FAULT-DOMAIN-1',
+         'lifecycleState': 'ACTIVE', 'remainingOcpus': 12.0, 'totalOcpus': 52.0, 'timeCreated': self.created
+      } for i in range(self.count('dedicated_vm_hosts')) ]
+
+   def volume_attachments(self, region, compartment_id):
+      return [ {
+         'attachmentType': 'paravirtualized', 'id': instance[ 'id' ].replace('instance', 'volumeattachment'), 'availabilityDomain': instance[ 'availabilityDomain' ],
+         'compartmentId': compartment_id, 'device': '/dev/oracleoci/oraclevdb', 'displayName': 'data', 'instanceId': instance[ 'id' ],
+         'isPvEncryptionInTransitEnabled': False, 'isReadOnly': False, 'isShareable': False, 'lifecycleState': 'ATTACHED',
+         'volumeId': instance[ 'id' ].replace('instance', 'volume'), 'timeCreated': self.created
+      } for instance in self.instances(region, compartment_id) ]
+
+   def boot_volume_attachments(self, region, ad, compartment_id):
+      return [ {
+         'id': instance[ 'id' ].replace('instance', 'bootvolumeattachment'), 'availabilityDomain': ad, 'bootVolumeId': instance[ 'id' ].replace('instance', 'bootvolume'),
+         'compartmentId': compartment_id, 'displayName': 'boot', 'instanceId': instance[ 'id' ], 'isPvEncryptionInTransitEnabled': False,
+         'lifecycleState': 'ATTACHED', 'timeCreated': self.created
+      } for instance in self.instances(region, compartment_id) if instance[ 'availabilityDomain' ] == ad ]
+
+   @lru_cache(maxsize=None)
+   def platform_images(self, region):
+      return [ self.image(f'ocid1.image.oc1.{region}.p{i}', None, f'Oracle-Linux-8-{i}') for i in range(self.count('platform_images')) ]
+
+   # like the API, a compartment's listing repeats the platform images
+   def images(self, region, compartment_id):
+      c = self.compartment_index(compartment_id)
+      own = [] if c is None else [ self.image(f'ocid1.image.oc1.{region}.c{c}m{i}', compartment_id, f'custom-{c}-{i}') for i in range(self.count('images')) ]
+      return self.platform_images(region) + own
+
+   def image(self, image_id, compartment_id, name):
+      return {
+         'id': image_id, 'compartmentId': compartment_id, 'displayName': name, 'baseImageId': None, 'createImageAllowed': True,
+         'launchMode': 'PARAVIRTUALIZED', 'lifecycleState': 'AVAILABLE', 'operatingSystem': 'Oracle Linux', 'operatingSystemVersion': '8',
+         'sizeInMBs': 47694, 'timeCreated': self.created,
+         'launchOptions': { 'bootVolumeType': 'PARAVIRTUALIZED', 'firmware': 'UEFI_64', 'networkType': 'PARAVIRTUALIZED' }
+      }
+
+   ### Blockstorage ###
+   ####################
+   def volumes(self, region, compartment_id):
+      c = self.compartment_index(compartment_id)
+      if c is None:
+         return []
+      ads = self.ads(region)
+      return [ self.volume(f'ocid1.volume.oc1.{region}.c{c}v{i}', ads[i % len(ads)], compartment_id, f'volume-{c}-{i}') for i in range(self.count('volumes')) ]
+
+   def boot_volumes(self, region, ad, compartment_id):
+      return [ dict(self.volume(instance[ 'id' ].replace('instance', 'bootvolume'), ad, compartment_id, 'boot'), imageId=self.platform_images(region)[0][ 'id' ] if self.count('platform_images') else None)
+               for instance in self.instances(region, compartment_id) if instance[ 'availabilityDomain' ] == ad ]
+
+   def volume(self, volume_id, ad, compartment_id, name):
+      return {
+         'id': volume_id, 'availabilityDomain': ad, 'compartmentId': compartment_id, 'displayName': name, 'isHydrated': True,
+         'kmsKeyId': None, 'lifecycleState': 'AVAILABLE', 'sizeInGBs': 50, 'sizeInMBs': 51200, 'volumeGroupId': None,
+         'vpusPerGB': 10, 'timeCreated': self.created
+      }
+
+   ### Database ###
+   ################
+   def db_systems(self, region, compartment_id):
+      c = self.compartment_index(compartment_id)
+      if c is None:
+         return []
+      ads = self.ads(region)
+      return [ {
+         'id': f'ocid1.dbsystem.oc1.{region}.c{c}s{i}', 'availabilityDomain': ads[i % len(ads)], 'compartmentId': compartment_id,
+         'cpuCoreCount': 4, 'dataStoragePercentage': 80, 'dataStorageSizeInGBs': 256, 'databaseEdition': 'ENTERPRISE_EDITION',
+         'diskRedundancy': 'HIGH', 'displayName': f'dbsystem-{c}-{i}', 'domain': 'example.com', 'hostname': f'db{c}{i}',
+         'lifecycleState': 'AVAILABLE', 'nodeCount': 1, 'recoStorageSizeInGB': 256, 'shape': 'VM.Standard2.4',
+         'version': '19.0.0.0', 'timeCreated': self.created
+      } for i in range(self.count('db_systems')) ]
+
+   def db_homes(self, region, compartment_id):
+      return [ {
+         'id': db_system[ 'id' ].replace('dbsystem', 'dbhome'), 'compartmentId': compartment_id, 'dbSystemId': db_system[ 'id' ],
+         'dbVersion': '19.0.0.0', 'displayName': 'home', 'lifecycleState': 'AVAILABLE', 'timeCreated': self.created
+      } for db_system in self.db_systems(region, compartment_id) ]
+
+   def databases(self, region, compartment_id, db_home_id):
+      return [ {
+         'id': f'{db_home_id.replace("dbhome", "database")}d{i}', 'compartmentId': compartment_id, 'dbHomeId': db_home_id,
+         'dbName': f'DB{i}', 'dbUniqueName': f'DB{i}_unique', 'dbWorkload': 'OLTP', 'lifecycleState': 'AVAILABLE', 'pdbName': None,
+         'dbBackupConfig': { 'autoBackupEnabled': True, 'autoBackupWindow': 'SLOT_ONE', 'recoveryWindowInDays': 30 }, 'timeCreated': self.created
+      } for i in range(self.count('databases')) ]
+
+   @lru_cache(maxsize=None)
+   def autonomous_databases(self, region, compartment_id):
+      c = self.compartment_index(compartment_id)
+      if c is None:
+         return []
+      return [ {
+         'id': f'ocid1.autonomousdatabase.oc1.{region}.c{c}a{i}', 'compartmentId': compartment_id, 'cpuCoreCount': 1,
+         'dataSafeStatus': 'NOT_REGISTERED', 'dataStorageSizeInTBs': 1, 'dbName': f'ADB{c}x{i}', 'dbVersion': '19c',
+         'dbWorkload': 'OLTP', 'displayName': f'adb-{c}-{i}', 'isAutoScalingEnabled': False, 'isDedicated': False,
+         'isFreeTier': False, 'lifecycleState': 'AVAILABLE', 'whitelistedIps': None, 'timeCreated': self.created
+      } for i in range(self.count('autonomous_dbs')) ]
+
+   ### Limits ###
+   ##############
+   def services(self):
+      return [ { 'name': f'service-{s}', 'description': f'Synthetic service {s}' } for s in range(self.count('services')) ]
+
+   def limit_values(self, region, service_name):
+      values = []
+      for l in range(self.count('limits')):
+         # every fifth limit is not set and every third one is per AD
+         value = 0 if l % 5 == 4 else 10 * (l + 1)
+         if l % 3 == 2:
+            values += [ { 'name': f'limit-{l}', 'scopeType': 'AD', 'availabilityDomain': ad, 'value': value } for ad in self.ads(region) ]
+         else:
+            values.append( { 'name': f'limit-{l}', 'scopeType': 'REGION', 'value': value } )
+      return values
+
+   def resource_availability(self, limit_name):
+      used = int(limit_name.rsplit('-', 1)[-1])
+      return { 'used': used, 'available': 10 * (used + 1) - used }
+
+   ### Monitoring ###
+   ##################
+   def metrics(self, region, compartment_id, in_subtree, details):
+      name = details[ 'query' ].split('[')[0]
+      step = { 'm': 60, 'h': 3600 }[ details[ 'query' ].split(']')[0][-1] ] * int( details[ 'query' ].split('[')[1].split(']')[0][:-1] )
+      start = parse_timestamp(details[ 'startTime' ])
+      end = parse_timestamp(details[ 'endTime' ])
+      points = min( self.count('datapoints'), int( (end - start).total_seconds() // step ) )
+
+      if details[ 'namespace' ] == 'oci_autonomous_database':
+         resources = [ db for c in self.scope(compartment_id, in_subtree) for db in self.autonomous_databases(region, c) ]
+      else:
+         resources = [ instance for c in self.scope(compartment_id, in_subtree) for instance in self.instances(region, c) ]
+
+      timestamps = [ timestamp( start + datetime.timedelta(seconds=step * p) ) for p in range(points) ]
+      return [ {
+         'namespace': details[ 'namespace' ], 'compartmentId': res[ 'compartmentId' ], 'name': name,
+         'dimensions': { 'resourceId': res[ 'id' ] },
+         'aggregatedDatapoints': [ { 'timestamp': ts, 'value': float( (r + p) % 100 ) } for p, ts in enumerate(timestamps) ]
+      } for r, res in enumerate(resources) ]
+
+   ### Resource Search ###
+   #########################
+   # what 'query A, B resources' finds - the custom images, not the platform
+   # ones, and databases by their db_name as Search shows them
+   def search(self, region, details):
+      match = re.match( r'query (.+) resources$', details[ 'query' ].strip(), re.IGNORECASE )
+      types = [ t.strip() for t in match[1].split(',') ] if match else []
+      failed = [ t for t in types if t.lower() in { u.lower() for u in self.unsearchable } or t.lower() not in SEARCH_TYPES ]
+      if not types or failed:
+         raise StandInError( 400, 'InvalidParameter', f'Invalid query: {", ".join(failed) or details[ "query" ]} can not be searched.' )
+
+      return [ {
+         'resourceType': SEARCH_TYPES[ t.lower() ][0], 'identifier': res[ 'id' ], 'compartmentId': c, 'timeCreated': res[ 'timeCreated' ],
+         'displayName': res.get('displayName', res.get('dbName')), 'availabilityDomain': res.get('availabilityDomain'),
+         'lifecycleState': res[ 'lifecycleState' ], 'freeformTags': {}, 'definedTags': {}
+      } for t in types for c in self.compartments for res in SEARCH_TYPES[ t.lower() ][1](self, region, c) ]
+
+   ### Announcements ###
+   #####################
+   def announcements(self):
+      return [ {
+         'type': 'AnnouncementSummary', 'id': f'ocid1.announcement.oc1..benchmark{a}', 'referenceTicketNumber': f'TICKET-{a}',
+         'summary': f'Synthetic announcement {a}', 'announcementType': 'ACTION_RECOMMENDED', 'lifecycleState': 'ACTIVE',
+         'isBanner': False, 'affectedRegions': [ name for _, name in self.regions ], 'services': [ 'Compute' ],
+         'timeCreated': self.created, 'timeUpdated': self.created
+      } for a in range(self.count('announcements')) ]
+
+# the Resource Search types of the synthetic resources - the autonomous
+# container databases and exadata infrastructures are never any
+SEARCH_TYPES = {
+   'instance': ( 'Instance', SyntheticTenancy.instances ),
+   'dedicatedvmhost': ( 'DedicatedVmHost', SyntheticTenancy.dedicated_vm_hosts ),
+   'volume': ( 'Volume', SyntheticTenancy.volumes ),
+   'bootvolume': ( 'BootVolume', lambda t, r, c: [ bv for ad in t.ads(r) for bv in t.boot_volumes(r, ad, c) ] ),
+   'image': ( 'Image', lambda t, r, c: [ image for image in t.images(r, c) if image[ 'compartmentId' ] ] ),
+   'dbsystem': ( 'DbSystem', SyntheticTenancy.db_systems ),
+   'database': ( 'Database', lambda t, r, c: [ db for home in t.db_homes(r, c) for db in t.databases(r, c, home[ 'id' ]) ] ),
+   'autonomousdatabase': ( 'AutonomousDatabase', SyntheticTenancy.autonomous_databases ),
+   'autonomouscontainerdatabase': ( 'AutonomousContainerDatabase', lambda t, r, c: [] ),
+   'autonomousexadatainfrastructure': ( 'AutonomousExadataInfrastructure', lambda t, r, c: [] ),
+}
+
+### Stand-in server ###
+#######################
+# One path per endpoint of the services the collectors call, served under
+# /<region> so endpoint_template can point every client at one host. The
+# service name picks the throttling bucket.
+ROUTES = [
+   ( 'GET', r'/20160918/tenancies/[^/]+', 'identity', 'get_tenancy', lambda t, r, m, q, b: t.tenancy() ),
+   ( 'GET', r'/20160918/tenancies/[^/]+/regionSubscriptions', 'identity', 'list_region_subscriptions', lambda t, r, m, q, b: t.region_subscriptions() ),
+   ( 'GET', r'/20160918/compartments', 'identity', 'list_compartments', lambda t, r, m, q, b: t.compartment_list() ),
+   ( 'GET', r'/20160918/availabilityDomains', 'identity', 'list_availability_domains', lambda t, r, m, q, b: t.availability_domains(r) ),
+   ( 'GET', r'/20160918/instances', 'compute', 'list_instances', lambda t, r, m, q, b: t.instances(r, q.get('compartmentId')) ),
+   ( 'GET', r'/20160918/dedicatedVmHosts', 'compute', 'list_dedicated_vm_hosts', lambda t, r, m, q, b: t.dedicated_vm_hosts(r, q.get('compartmentId')) ),
+   ( 'GET', r'/20160918/volumeAttachments', 'compute', 'list_volume_attachments', lambda t, r, m, q, b: t.volume_attachments(r, q.get('compartmentId')) ),
+   ( 'GET', r'/20160918/bootVolumeAttachments', 'compute', 'list_boot_volume_attachments', lambda t, r, m, q, b: t.boot_volume_attachments(r, q.get('availabilityDomain'), q.get('compartmentId')) ),
+   ( 'GET', r'/20160918/images', 'compute', 'list_images', lambda t, r, m, q, b: t.images(r, q.get('compartmentId')) ),
+   ( 'GET', r'/20160918/volumes', 'blockstorage', 'list_volumes', lambda t, r, m, q, b: t.volumes(r, q.get('compartmentId')) ),
+   ( 'GET', r'/20160918/bootVolumes', 'blockstorage', 'list_boot_volumes', lambda t, r, m, q, b: t.boot_volumes(r, q.get('availabilityDomain'), q.get('compartmentId')) ),
+   ( 'GET', r'/20160918/dbSystems', 'database', 'list_db_systems', lambda t, r, m, q, b: t.db_systems(r, q.get('compartmentId')) ),
+   ( 'GET', r'/20160918/dbHomes', 'database', 'list_db_homes', lambda t, r, m, q, b: t.db_homes(r, q.get('compartmentId')) ),
+   ( 'GET', r'/20160918/databases', 'database', 'list_databases', lambda t, r, m, q, b: t.databases(r, q.get('compartmentId'), q.get('dbHomeId', '')) ),
+   ( 'GET', r'/20160918/autonomousExadataInfrastructures', 'database', 'list_autonomous_exadata_infrastructures', lambda t, r, m, q, b: [] ),
+   ( 'GET', r'/20160918/autonomousContainerDatabases', 'database', 'list_autonomous_container_databases', lambda t, r, m, q, b: [] ),
+   ( 'GET', r'/20160918/autonomousDatabases', 'database', 'list_autonomous_databases', lambda t, r, m, q, b: t.autonomous_databases(r, q.get('compartmentId')) ),
+   ( 'GET', r'/20190729/services', 'limits', 'list_services', lambda t, r, m, q, b: t.services() ),
+   ( 'GET', r'/20190729/limitValues', 'limits', 'list_limit_values', lambda t, r, m, q, b: t.limit_values(r, q.get('serviceName')) ),
+   ( 'GET', r'/20190729/services/[^/]+/limits/([^/]+)/resourceAvailability', 'limits', 'get_resource_availability', lambda t, r, m, q, b: t.resource_availability(m[1]) ),
+   ( 'POST', r'/20180401/metrics/actions/summarizeMetricsData', 'monitoring', 'summarize_metrics_data', lambda t, r, m, q, b: t.metrics(r, q.get('compartmentId'), q.get('compartmentIdInSubtree') == 'true', b) ),
+   ( 'GET', r'/20180904/announcements', 'announcements', 'list_announcements', lambda t, r, m, q, b: t.announcements() ),
+   ( 'POST', r'/20180409/resources', 'search', 'search_resources', lambda t, r, m, q, b: t.search(r, b) ),
+]
+
+# list calls whose records come wrapped in a collection
+COLLECTIONS = { 'list_announcements', 'search_resources' }
+
+# an error response of a handler
+class StandInError(Exception):
+   def __init__(self, status, code, message):
+      super().__init__(message)
+      self.status = status
+      self.code = code
+
+### per region and service request buckets - 429 once one is empty ###
+#######################################################################
+class Throttle(object):
+   def __init__(self, rate):
+      self.rate = rate
+      self.lock = Lock()
+      self.buckets = {}
+
+   def allow(self, key):
+      if not self.rate:
+         return True
+
+      with self.lock:
+         now = time.monotonic()
+         tokens, updated = self.buckets.get( key, ( self.rate, now ) )
+         tokens = min( self.rate, tokens + (now - updated) * self.rate )
+         allowed = tokens >= 1
+         self.buckets[key] = ( tokens - 1 if allowed else tokens, now )
+         return allowed
+
+class StandInServer(ThreadingHTTPServer):
+   daemon_threads = True
+
+   # keep_objects keeps the uploaded objects for --check
+   def __init__(self, tenancy, keep_objects=False):
+      super().__init__( ( '127.0.0.1', 0 ), StandInHandler )
+      self.tenancy = tenancy
+      self.keep_objects = keep_objects
+      self.settings = tenancy.settings
+      self.throttle = Throttle( float(self.settings[ 'throttle_rps' ]) )
+      self.routes = [ ( method, re.compile(pattern + '$'), service, operation, handler ) for method, pattern, service, operation, handler in ROUTES ]
+      self.lock = Lock()
+      self.reset()
+
+   @property
+   def url(self):
+      return f'http://127.0.0.1:{self.server_address[1]}'
+
+   def reset(self):
+      with self.lock:
+         self.calls = Counter()
+         self.throttled = Counter()
+         self.response_bytes = 0
+         self.upload_bytes = 0
+         self.uploads = Counter()
+         self.multipart = {}
+         self.parts = {}
+         self.objects = {}
+
+   def counters(self):
+      with self.lock:
+         return {
+            'api_calls': sum(self.calls.values()),
+            'throttled': sum(self.throttled.values()),
+            'calls': dict(sorted(self.calls.items())),
+            'response_bytes': self.response_bytes,
+            'upload_bytes': self.upload_bytes,
+            'uploaded_objects': len(self.uploads)
+         }
+
+   def start(self):
+      Thread( target=self.serve_forever, daemon=True ).start()
+      return self
+
+class StandInHandler(BaseHTTPRequestHandler):
+   # keep-alive like the real endpoints
+   protocol_version = 'HTTP/1.1'
+
+   def log_message(self, format, *args):
+      pass
+
+   def do_GET(self):
+      self.dispatch()
+
+   def do_POST(self):
+      self.dispatch()
+
+   def do_PUT(self):
+      self.dispatch()
+
+   def do_DELETE(self):
+      self.dispatch()
+
+   def send(self, status, body=b'', headers=None):
+      self.send_response(status)
+      for name, value in (headers or {}).items():
+         self.send_header(name, value)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def error(self, status, code, message):
+      self.send( status, json.dumps( { 'code': code, 'message': message } ).encode('utf-8') )
+
+   def dispatch(self):
+      body = self.rfile.read( int(self.headers.get('Content-Length') or 0) )
+      url = urllib.parse.urlsplit(self.path)
+
+      if url.path.startswith('/par/') or url.path.startswith('/multipart/'):
+         self.upload(url.path, body)
+         return
+
+      region, _, path = url.path[1:].partition('/')
+      path = '/' + path
+      query = dict( urllib.parse.parse_qsl(url.query) )
+      server = self.server
+      settings = server.settings
+
+      for method, pattern, service, operation, handler in server.routes:
+         match = pattern.match(path)
+         if method == self.command and match:
+            break
+      else:
+         self.error(404, 'NotAuthorizedOrNotFound', f'{self.command} {path} is not served by the benchmark.')
+         return
+
+      latency = random.uniform( max(0, settings[ 'latency_ms' ] - settings[ 'latency_jitter_ms' ]), settings[ 'latency_ms' ] + settings[ 'latency_jitter_ms' ] )
+      time.sleep( latency / 1000 )
+
+      throttled = not server.throttle.allow( ( region, service ) ) or random.random() < float(settings[ 'throttle_fraction' ])
+      with server.lock:
+         server.calls[operation] += 1
+         server.throttled[operation] += int(throttled)
+      if throttled:
+         self.error(429, 'TooManyRequests', 'Too many requests for the tenant.')
+         return
+
+      try:
+         data = handler( server.tenancy, region, match, query, json.loads(body) if body else None )
+      except StandInError as err:
+         self.error( err.status, err.code, str(err) )
+         return
+
+      # page the list calls - the page token is the offset of the next record
+      headers = {}
+      if isinstance(data, list) and operation != 'summarize_metrics_data':
+         page_size = min( int(settings[ 'page_size' ]), int(query.get('limit', settings[ 'page_size' ])) )
+         start = int(query.get('page', 0))
+         if start + page_size < len(data):
+            headers[ 'opc-next-page' ] = str(start + page_size)
+         data = data[ start:start + page_size ]
+         if operation in COLLECTIONS:
+            data = { 'items': data }
+
+      payload = json.dumps(data).encode('utf-8')
+      with server.lock:
+         server.response_bytes += len(payload)
+      self.send(200, payload, headers)
+
+   ### fake PAR - single PUTs and multipart uploads ###
+   ####################################################
+   def upload(self, path, body):
+      server = self.server
+
+      with server.lock:
+         server.upload_bytes += len(body)
+
+         if path.startswith('/par/') and self.headers.get('opc-multipart') == 'true':
+            upload_id = f'/multipart/{len(server.multipart)}/'
+            server.multipart[upload_id] = path
+            server.parts[upload_id] = {}
+            self.send( 200, json.dumps( { 'accessUri': upload_id } ).encode('utf-8') )
+            return
+
+         if path.startswith('/par/'):
+            server.uploads[path] += 1
+            if server.keep_objects:
+               server.objects[path] = body
+         elif self.command == 'POST':
+            server.uploads[ server.multipart.get(path, path) ] += 1
+            if server.keep_objects:
+               parts = server.parts.get(path, {})
+               server.objects[ server.multipart.get(path, path) ] = b''.join( parts[part] for part in sorted(parts) )
+         elif self.command == 'PUT' and server.keep_objects:
+            upload_id, _, part = path.rpartition('/')
+            server.parts.setdefault( upload_id + '/', {} )[ int(part) ] = body
+
+      self.send(200)
+
+### Benchmark runs ###
+######################
+# The config file of a run - the synthetic tenancy's identity, the
+# stand-in endpoints and any extract settings given with --set.
+def write_config(directory, server, tenancy, extract_settings):
+   from cryptography.hazmat.primitives import serialization
+   from cryptography.hazmat.primitives.asymmetric import rsa
+
+   key_file = os.path.join(directory, 'key.pem')
+   if not os.path.exists(key_file):
+      key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+      with open(key_file, 'wb') as f:
+         f.write( key.private_bytes( serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption() ) )
+
+   parser = configparser.ConfigParser(interpolation=None)
+   parser[ 'DEFAULT' ] = dict( {
+      'user': 'ocid1.user.oc1..benchmark',
+      'fingerprint': ':'.join( [ '00' ] * 16 ),
+      'key_file': key_file,
+      'tenancy': TENANCY_ID,
+      'region': tenancy.regions[0][1],
+      'par': f'{server.url}/par/',
+      'endpoint_template': f'{server.url}/{{region}}'
+   }, **extract_settings )
+
+   path = os.path.join(directory, 'config')
+   with open(path, 'w') as f:
+      parser.write(f)
+   return path
+
+### runs in a fresh process - peak RSS is the extract's own ###
+###############################################################
+def extract(config_file, engine, results):
+   import oci_services
+   oci_services.CONFIG_FILE = config_file
+
+   try:
+      start = time.perf_counter()
+      oci_services.OCIService( 'CONFIG', engine=engine ).extract_data()
+      results.put( {
+         'wall_seconds': round(time.perf_counter() - start, 3),
+         'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+      } )
+   except BaseException as err:
+      results.put( { 'error': repr(err) } )
+      raise
+
+def run_once(server, config_file, engine):
+   context = multiprocessing.get_context('spawn')
+   results = context.Queue()
+
+   server.reset()
+   process = context.Process( target=extract, args=(config_file, engine, results) )
+   process.start()
+   result = results.get()
+   process.join()
+
+   if 'error' in result:
+      raise RuntimeError(f'Extract failed: {result["error"]}')
+
+   result.update( server.counters() )
+   return result
+
+### --check: every output format gives the same tables ###
+###########################################################
+# Extracts the small scenario once per output format and engine and reads
+# every uploaded table back, so a value a typed column can't hold fails
+# the check instead of a production run.
+def read_table(extension, body):
+   if extension in ( 'csv', 'csv.gz' ):
+      text = ( gzip.decompress(body) if extension == 'csv.gz' else body ).decode('utf-8')
+      rows = list( csv.reader( io.StringIO(text) ) )
+      return rows[0], len(rows) - 1
+
+   import pyarrow.ipc
+   import pyarrow.parquet
+   table = pyarrow.parquet.read_table( io.BytesIO(body) ) if extension == 'parquet' else pyarrow.ipc.open_file( io.BytesIO(body) ).read_all()
+   return table.column_names, table.num_rows
+
+# the output_format values of oci_services - csv first
+OUTPUT_FORMATS = ( 'csv', 'csv.gz', 'parquet', 'arrow' )
+
+def check_formats(engines, extract_settings):
+   tenancy = SyntheticTenancy( dict(DEFAULTS) )
+   server = StandInServer( tenancy, keep_objects=True ).start()
+   expected = None
+   failures = []
+
+   try:
+      with tempfile.TemporaryDirectory(prefix='oci-benchmark-') as directory:
+         for output_format in OUTPUT_FORMATS:
+            config_file = write_config( directory, server, tenancy, dict(extract_settings, output_format=output_format) )
+            for engine in engines:
+               try:
+                  run_once( server, config_file, engine )
+               except RuntimeError as err:
+                  failures.append( f'{output_format} {engine}: {err}' )
+                  continue
+
+               tables = {}
+               for path, body in server.objects.items():
+                  table, _, extension = os.path.basename(path).partition('.')
+                  if extension != 'json':
+                     tables[ table.rsplit('_', 1)[0] ] = read_table( extension, body )
+
+               # the first format is csv - the others must match it
+               expected = expected or tables
+               if tables != expected:
+                  differ = sorted( name for name in set(tables) | set(expected) if tables.get(name) != expected.get(name) )
+                  failures.append( f'{output_format} {engine}: tables differ from csv: {", ".join(differ)}' )
+
+               print( f'{output_format} {engine}: {len(tables)} tables, {sum(rows for _, rows in tables.values())} rows', file=sys.stderr )
+   finally:
+      server.shutdown()
+      server.server_close()
+
+   for failure in failures:
+      print( f'FAILED {failure}' )
+   if failures:
+      raise SystemExit(1)
+   print( f'All {len(OUTPUT_FORMATS)} output formats wrote the same tables.' )
+
+### --check: Search-planned listings give the same tables ###
+#############################################################
+# The search engine and the prefilter only list where Search shows
+# resources, so they must write what listing everything writes - also
+# when a type can't be searched and its listings fall back to every
+# compartment, and when the prefilter plans from the cached index of an
+# earlier run. Runs on the threads engine, the only one that plans with
+# Search, in order: whether a run queries Search depends on the cache.
+INVENTORY_RUNS = [
+   # label, extract settings, unsearchable types, queries Search
+   ( 'list', {}, (), False ),
+   ( 'prefilter', { 'prefilter': 'true' }, (), True ),
+   ( 'prefilter, cached index', { 'prefilter': 'true' }, (), False ),
+   ( 'search', { 'inventory_engine': 'search' }, (), True ),
+   ( 'search, AutonomousExadataInfrastructure unsearchable', { 'inventory_engine': 'search' }, ( 'AutonomousExadataInfrastructure', ), True ),
+   ( 'prefilter, cached index without AutonomousExadataInfrastructure', { 'prefilter': 'true' }, ( 'AutonomousExadataInfrastructure', ), False ),
+]
+
+# the rows of every csv table, sorted and without report_no - the metrics
+# tables follow the clock and are left out
+def read_rows(objects):
+   tables = {}
+   for path, body in objects.items():
+      table, _, extension = os.path.basename(path).partition('.')
+      name = table.rsplit('_', 1)[0]
+      if extension == 'csv' and not name.startswith('metrics'):
+         rows = list( csv.reader( io.StringIO( body.decode('utf-8') ) ) )
+         keep = [ i for i, column in enumerate(rows[0]) if column != 'report_no' ]
+         tables[name] = [ [ row[i] for i in keep ] for row in rows[:1] ] + sorted( [ row[i] for i in keep ] for row in rows[1:] )
+   return tables
+
+def check_inventory(extract_settings, runs=INVENTORY_RUNS):
+   tenancy = SyntheticTenancy( dict(DEFAULTS) )
+   server = StandInServer( tenancy, keep_objects=True ).start()
+   expected = None
+   failures = []
+
+   try:
+      with tempfile.TemporaryDirectory(prefix='oci-benchmark-') as directory:
+         for label, settings, unsearchable, searched in runs:
+            config_file = write_config( directory, server, tenancy, dict(extract_settings, output_format='csv', cache_dir=os.path.join(directory, 'cache'), **settings) )
+            tenancy.unsearchable = set(unsearchable)
+            try:
+               result = run_once( server, config_file, 'threads' )
+            except RuntimeError as err:
+               failures.append( f'{label}: {err}' )
+               continue
+
+            # the first run lists everything - the others must match it
+            tables = read_rows(server.objects)
+            expected = expected or tables
+            if tables != expected:
+               differ = sorted( name for name in set(tables) | set(expected) if tables.get(name) != expected.get(name) )
+               failures.append( f'{label}: tables differ from {runs[0][0]}: {", ".join(differ)}' )
+            if bool( result[ 'calls' ].get('search_resources') ) != searched:
+               failures.append( f'{label}: Resource Search was {"not " if searched else ""}queried' )
+
+            print( f'{label}: {len(tables)} tables, {sum(len(rows) - 1 for rows in tables.values())} rows, {result["api_calls"]} calls, {result["calls"].get("search_resources", 0)} searches', file=sys.stderr )
+   finally:
+      tenancy.unsearchable = set()
+      server.shutdown()
+      server.server_close()
+
+   for failure in failures:
+      print( f'FAILED {failure}' )
+   if failures:
+      raise SystemExit(1)
+   print( f'All {len(runs)} inventory runs wrote the same tables.' )
+
+### --check: incremental runs replay what is unchanged ###
+##########################################################
+# With a state file the second run replays every listing from the store and
+# must still write the tables of the first. Once the instances of one
+# compartment are renamed only that compartment's compute listing runs
+# again, and the tables must be those of a run without state.
+def check_state(extract_settings):
+   tenancy = SyntheticTenancy( dict(DEFAULTS) )
+   server = StandInServer( tenancy, keep_objects=True ).start()
+   failures = []
+
+   try:
+      with tempfile.TemporaryDirectory(prefix='oci-benchmark-') as directory:
+         settings = dict(extract_settings, output_format='csv')
+         stateful = write_config( directory, server, tenancy, dict(settings, state_file=os.path.join(directory, 'state.db')) )
+         runs = {}
+         for label, config_file, revise in [ ( 'first', stateful, False ), ( 'second', stateful, False ), ( 'renamed', stateful, True ), ( 'renamed without state', None, False ) ]:
+            if revise:
+               tenancy.revise()
+            result = run_once( server, config_file or write_config( directory, server, tenancy, settings ), 'threads' )
+            runs[label] = ( read_rows(server.objects), result[ 'calls' ] )
+            print( f'{label}: {result["api_calls"]} calls, {result["calls"].get("list_instances", 0)} instance listings', file=sys.stderr )
+
+         if runs[ 'second' ][0] != runs[ 'first' ][0]:
+            failures.append( 'the second run wrote other tables than the first' )
+         if runs[ 'second' ][1].get('list_instances') or runs[ 'second' ][1].get('list_volumes') or runs[ 'second' ][1].get('list_db_systems'):
+            failures.append( 'the second run listed compartments again' )
+         if runs[ 'renamed' ][0] != runs[ 'renamed without state' ][0]:
+            failures.append( 'the run after the rename wrote other tables than a run without state' )
+         if runs[ 'renamed' ][1].get('list_instances') != len(tenancy.regions) or runs[ 'renamed' ][1].get('list_volumes'):
+            failures.append( 'the run after the rename did not list just the renamed compartment' )
+   except RuntimeError as err:
+      failures.append( str(err) )
+   finally:
+      server.shutdown()
+      server.server_close()
+
+   for failure in failures:
+      print( f'FAILED {failure}' )
+   if failures:
+      raise SystemExit(1)
+   print( 'Incremental runs replayed the unchanged listings and wrote the same tables.' )
+
+### median run of a scenario and engine ###
+###########################################
+def summarize(runs):
+   ordered = sorted( runs, key=lambda run: run[ 'wall_seconds' ] )
+   median = ordered[ (len(ordered) - 1) // 2 ]
+   return {
+      'wall_seconds': statistics.median( run[ 'wall_seconds' ] for run in runs ),
+      'wall_seconds_min': ordered[0][ 'wall_seconds' ],
+      'peak_rss_mb': max( run[ 'peak_rss_mb' ] for run in runs ),
+      'api_calls': median[ 'api_calls' ],
+      'throttled': median[ 'throttled' ],
+      'upload_bytes': median[ 'upload_bytes' ],
+      'uploaded_objects': median[ 'uploaded_objects' ],
+      'calls': median[ 'calls' ]
+   }
+
+COLUMNS = [ ( 'wall_seconds', 'wall s' ), ( 'peak_rss_mb', 'rss MB' ), ( 'api_calls', 'calls' ), ( 'throttled', '429s' ), ( 'upload_bytes', 'upload bytes' ) ]
+
+def print_table(results, baseline=None):
+   print( f'{"scenario":<12} {"engine":<8} ' + ' '.join( f'{title:>20}' for _, title in COLUMNS ) )
+   for key, summary in results.items():
+      scenario, engine = key.split('/')
+      cells = []
+      for column, _ in COLUMNS:
+         cell = f'{summary[column]}'
+         before = ( baseline or {} ).get(key, {}).get(column)
+         if before:
+            cell += f' ({(summary[column] - before) / before:+.0%})'
+         cells.append( f'{cell:>20}' )
+      print( f'{scenario:<12} {engine:<8} ' + ' '.join(cells) )
+
+def load_scenarios(path):
+   scenarios = OrderedDict( (name, dict(DEFAULTS, **settings)) for name, settings in SCENARIOS.items() )
+   if path:
+      parser = configparser.ConfigParser(interpolation=None)
+      if not parser.read(path):
+         raise SystemExit(f'Scenario file {path} not found.')
+      for name in parser.sections():
+         unknown = set(parser[name]) - set(DEFAULTS)
+         if unknown:
+            raise SystemExit(f'Unknown settings in scenario {name}: {", ".join(sorted(unknown))}')
+         scenarios[name] = dict( DEFAULTS, **{ key: float(value) if key.startswith('throttle') or key.startswith('latency') else int(value) for key, value in parser[name].items() } )
+   return scenarios
+
+def main():
+   parser = argparse.ArgumentParser( description='Benchmark extract_data against a local stand-in for OCI.' )
+   parser.add_argument( '--scenario', nargs='+', default=[ 'small' ], help='scenarios to run (default: small)' )
+   parser.add_argument( '--scenarios', metavar='FILE', help='ini file of extra scenarios - one section each, keys as in DEFAULTS' )
+   parser.add_argument( '--engine', nargs='+', default=[ 'threads' ], choices=[ 'threads', 'async' ], help='collection engines to run' )
+   parser.add_argument( '--repeat', type=int, default=3, help='runs per scenario and engine (default: 3)' )
+   parser.add_argument( '--set', nargs='+', default=[], metavar='KEY=VALUE', help='extract config settings, e.g. max_workers=64 rate_limit=false' )
+   parser.add_argument( '--output', metavar='FILE', help='write the results as JSON' )
+   parser.add_argument( '--baseline', metavar='FILE', help='compare against the JSON of an earlier run' )
+   parser.add_argument( '--list', action='store_true', help='list the scenarios and exit' )
+   parser.add_argument( '--check', action='store_true', help='extract the small scenario in every output format, with Search planning and incrementally, check the tables match and exit' )
+   args = parser.parse_args()
+
+   scenarios = load_scenarios(args.scenarios)
+   if args.list:
+      for name, settings in scenarios.items():
+         print( name, ' '.join( f'{key}={value}' for key, value in settings.items() if value != DEFAULTS[key] ) )
+      return
+
+   unknown = [ name for name in args.scenario if name not in scenarios ]
+   if unknown:
+      raise SystemExit(f'Unknown scenario: {", ".join(unknown)} - see --list')
+   extract_settings = dict( setting.split('=', 1) for setting in args.set )
+
+   if args.check:
+      check_formats( args.engine, extract_settings )
+      check_inventory( extract_settings )
+      check_state( extract_settings )
+      return
+
+   baseline = None
+   if args.baseline:
+      with open(args.baseline) as f:
+         baseline = json.load(f)[ 'results' ]
+
+   results = OrderedDict()
+   with tempfile.TemporaryDirectory(prefix='oci-benchmark-') as directory:
+      for name in args.scenario:
+         tenancy = SyntheticTenancy( scenarios[name] )
+         server = StandInServer(tenancy).start()
+         try:
+            config_file = write_config(directory, server, tenancy, extract_settings)
+            for engine in args.engine:
+               runs = []
+               for run in range(args.repeat):
+                  runs.append( run_once(server, config_file, engine) )
+                  print( f'{name} {engine} run {run + 1}: {runs[-1]["wall_seconds"]}s, {runs[-1]["api_calls"]} calls', file=sys.stderr )
+               results[ f'{name}/{engine}' ] = dict( summarize(runs), runs=runs )
+         finally:
+            server.shutdown()
+            server.server_close()
+
+   print_table(results, baseline)
+
+   if args.output:
+      with open(args.output, 'w') as f:
+         json.dump( { 'scenarios': { name: scenarios[name] for name in args.scenario }, 'settings': extract_settings, 'results': results }, f, indent=2 )
+
+if __name__ == '__main__':
+   main()
@@ -1,7 +1,7 @@
 import oci
-import sys
 import time
-from oci_services import OCIService
+import argparse
+from oci_services import OCIService, BatchService, Profiler, PROFILERS, configure_logging, log_start
 
 def execute_extract():
    # config = oci.config.from_file( "/.oci/config", "DEFAULT")
@@ -12,14 +12,34 @@ def execute_extract():
 	# tenancy.print()
 	# announcement.print()
 
-   start_time = time.time()
-   if len(sys.argv) > 1:
-      authentication = sys.argv[1]
-   else:
-      authentication = "CONFIG"
+   parser = argparse.ArgumentParser()
+   parser.add_argument( 'authentication', nargs='?', default="CONFIG" )
+   parser.add_argument( 'app_name', nargs='?', default="NONE" )
+   parser.add_argument( '--batch', nargs='+', metavar='PROFILE_OR_TENANCY_OCID', help='extract several tenancies in one run' )
+   parser.add_argument( '--engine', choices=[ 'threads', 'async' ], help='collection engine - overrides collection_engine in the config' )
+   parser.add_argument( '--profile', metavar='DIRECTORY', help='profile the collectors and uploads, write the profiles and a summary to DIRECTORY' )
+   parser.add_argument( '--profiler', choices=PROFILERS, default='sample', help='with --profile: sample the stacks of all threads (default), cProfile each section and the worker tasks of each collector, or only keep the summary' )
+   parser.add_argument( '--trace-memory', action='store_true', help='with --profile: track memory with tracemalloc (slower)' )
+   args = parser.parse_args()
+   configure_logging( args.app_name )
+   log_start()
+
+   profiler = None
+   if args.profile:
+      profiler = Profiler( args.profile, args.profiler, trace_memory=args.trace_memory )
+      profiler.start()
 
-   oci_service = OCIService( authentication )
-   oci_service.extract_data()
+   start_time = time.time()
+   try:
+      if args.batch:
+         oci_service = BatchService( args.authentication, args.batch, engine=args.engine, profiler=profiler )
+      else:
+         oci_service = OCIService( args.authentication, engine=args.engine, profiler=profiler )
+      oci_service.extract_data()
+   finally:
+      if profiler:
+         profiler.stop()
+         print(f"--- Profile written to {args.profile} ---")
    print("--- Execution time ---")
    print("--- %s seconds ---" % (time.time() - start_time))
 
@@ -0,0 +1,512 @@
+import oci
+import time
+import json
+import random
+import asyncio
+from contextlib import asynccontextmanager
+from traceback import format_exception
+from oci._vendor import requests as oci_requests
+from oci._vendor.requests.structures import CaseInsensitiveDict
+from oci_services import (
+   logger, call_context, AdaptiveRateLimiter, RateLimiter, ClientPool, THROTTLE_ATTEMPTS, THROTTLE_SECONDS,
+   Compute, BlockStorage, DBSystem, Images, Limit, Monitoring
+)
+
+# optional - only the async engine needs aiohttp
+try:
+   import aiohttp
+   import yarl
+except ImportError:
+   aiohttp = None
+
+### asyncio collection engine ###
+#################################
+# Runs Compute, BlockStorage, DBSystem, Images, Limit and Monitoring as
+# coroutines on one event loop instead of one thread per region x
+# compartment. The SDK still builds every request - its HTTP layer is only
+# swapped for a capture - then the request is signed and sent over one
+# aiohttp connection pool, so thousands of calls can be in flight at once.
+# The collectors are subclasses of the threaded ones and write the same
+# tables with the same create_csv.
+class CapturedRequest(Exception):
+   def __init__(self, request):
+      self.request = request
+
+class AsyncEngine(object):
+   def __init__(self, oci_service, pipeline):
+      if aiohttp is None:
+         raise ValueError('the async engine needs the aiohttp package')
+
+      self.oci_service = oci_service
+      self.pipeline = pipeline
+      self.config = config = oci_service.config
+      self.max_requests = int(config.get('async_max_requests', 1000))
+      self.clients = {}
+      self.limiters = oci_service.clients.limiters
+      self.open_calls = {}
+      self.service_workers = int(config.get('service_workers', 8))
+      self.stats = oci_service.stats
+      self.http = None
+
+   ### collect everything, upload each collector as soon as it is done ###
+   #######################################################################
+   def run(self, tenancy):
+      return asyncio.run( self.collect(tenancy) )
+
+   async def collect(self, tenancy):
+      connector = aiohttp.TCPConnector( limit=self.max_requests, limit_per_host=0, ttl_dns_cache=300 )
+      timeout = aiohttp.ClientTimeout( sock_connect=10, sock_read=60 )
+
+      async with aiohttp.ClientSession( connector=connector, timeout=timeout, auto_decompress=True ) as self.http:
+         collectors = [
+            ( 'limit', AsyncLimit ),
+            ( 'compute', AsyncCompute ),
+            ( 'block_storage', AsyncBlockStorage ),
+            ( 'db_system', AsyncDBSystem ),
+            ( 'monitoring', AsyncMonitoring ),
+            ( 'images', AsyncImages ),
+         ]
+         results = await asyncio.gather( *( self.run_collector(name, collector_class, tenancy) for name, collector_class in collectors ), return_exceptions=True )
+
+      for client in self.clients.values():
+         client.base_client.session.close()
+
+      failed = [ ( name, result ) for ( name, _ ), result in zip(collectors, results) if isinstance(result, BaseException) ]
+      for name, err in failed:
+         logger.error(f'Pipeline stage {name} failed.')
+         logger.exception(format_exception(type(err), err, err.__traceback__))
+
+      if failed:
+         raise failed[0][1]
+
+      return { name: result for ( name, _ ), result in zip(collectors, results) }
+
+   async def run_collector(self, name, collector_class, tenancy):
+      start_time = time.time()
+      try:
+         collector = collector_class(self, name)
+         await collector.collect(tenancy)
+      finally:
+         self.pipeline.durations[name] = time.time() - start_time
+
+      # the upload jobs count against <name>_upload like the threaded stages
+      call_context.collector = f'{name}_upload'
+      self.oci_service.uploads.submit(collector)
+      return collector
+
+   ### the client of a collector - SDK clients are per class and region ###
+   ########################################################################
+   def client(self, client_class, region_name, collector):
+      key = (client_class, region_name)
+      sdk_client = self.clients.get(key)
+      if sdk_client is None:
+         sdk_client = self.clients[key] = self.oci_service.clients.create( client_class, region_name )
+         sdk_client.base_client.request = self.capture
+
+      service = ClientPool.service_name(client_class)
+      return AsyncClient( self, sdk_client, self.limiter(service, region_name), service, region_name, collector )
+
+   def limiter(self, service, region_name):
+      rate_limits = self.oci_service.clients.rate_limits
+      if rate_limits is None:
+         return None
+
+      key = (region_name, service)
+      if key not in self.limiters:
+         self.limiters[key] = AdaptiveRateLimiter( **rate_limits )
+
+      return self.limiters[key]
+
+   ### calls in flight - the only bound until a limiter sees its first 429 ###
+   ###########################################################################
+   def open_slots(self, service, region_name):
+      key = (region_name, service)
+      if key not in self.open_calls:
+         self.open_calls[key] = asyncio.Semaphore( self.service_workers )
+
+      return self.open_calls[key]
+
+   ### stands in for BaseClient.request - hands the built request back ###
+   #######################################################################
+   @staticmethod
+   def capture(request, *args, **kwargs):
+      raise CapturedRequest(request)
+
+   ### the request an SDK operation would send ###
+   ###############################################
+   def build(self, sdk_client, operation, *args, **kwargs):
+      kwargs[ 'retry_strategy' ] = oci.retry.NoneRetryStrategy()
+      try:
+         getattr(sdk_client, operation)(*args, **kwargs)
+      except CapturedRequest as captured:
+         return captured.request
+
+      raise RuntimeError(f'{operation} did not send a request')
+
+   ### sign and send one attempt ###
+   #################################
+   async def send(self, base_client, request):
+      signer = base_client.signer if request.enforce_content_headers else base_client.signer.without_content_headers
+      prepared = oci_requests.Request( request.method, request.url, params=request.query_params, headers=request.header_params, data=request.body, auth=signer ).prepare()
+
+      async with self.http.request( prepared.method, yarl.URL(prepared.url, encoded=True), data=prepared.body, headers=dict(prepared.headers) ) as response:
+         body = await response.read()
+         return response.status, CaseInsensitiveDict(response.headers), body
+
+### one SDK client on the event loop ###
+########################################
+# call() runs an operation with the same retries as the threaded engine:
+# 429s go to the adaptive rate limiter and are retried through it, 5xx,
+# QuotaExceeded/LimitExceeded and connection errors back off with jitter,
+# within THROTTLE_ATTEMPTS attempts and THROTTLE_SECONDS seconds. While
+# the limiter is still open, at most service_workers calls per region and
+# service are in flight, as many as the threaded engine would send.
+class AsyncClient(object):
+   def __init__(self, engine, sdk_client, limiter, service, region, collector):
+      self.engine = engine
+      self.sdk_client = sdk_client
+      self.base_client = sdk_client.base_client
+      self.limiter = limiter
+      self.service = service
+      self.region = region
+      self.collector = collector
+
+   async def call(self, operation, *args, **kwargs):
+      request = self.engine.build( self.sdk_client, operation, *args, **kwargs )
+      start = time.monotonic()
+      waited = 0
+      throttles = 0
+      size = 0
+      attempt = 0
+      error = True
+
+      try:
+         for attempt in range(1, THROTTLE_ATTEMPTS + 1):
+            wait_start = time.monotonic()
+            try:
+               async with self.admit():
+                  call_start = time.monotonic()
+                  waited += call_start - wait_start
+                  status, headers, body = await self.engine.send( self.base_client, request )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+               failure = err
+            else:
+               size += len(body)
+               if 200 <= status < 300:
+                  if self.limiter is not None:
+                     self.limiter.succeeded( time.monotonic() - call_start )
+                  data = self.base_client.deserialize_response_data( body, request.response_type ) if request.response_type else None
+                  error = False
+                  return oci.response.Response( status, headers, data, request )
+
+               failure = self.service_error( operation, request, status, headers, body )
+               if status == 429:
+                  throttles += 1
+                  if self.limiter is not None:
+                     self.limiter.throttled()
+               elif not ( status >= 500 and status != 501 or status == 400 and failure.code in ( 'QuotaExceeded', 'LimitExceeded' ) ):
+                  raise failure
+
+            if attempt == THROTTLE_ATTEMPTS or time.monotonic() - start > THROTTLE_SECONDS:
+               raise failure
+
+            # throttles already slow the limiter down - wait less on them
+            backoff = min(60, 2 ** attempt)
+            throttled = isinstance(failure, oci.exceptions.ServiceError) and failure.status == 429
+            await asyncio.sleep( random.uniform(0, backoff / 4 if throttled else backoff) )
+      finally:
+         self.engine.stats.record(
+            self.collector, self.service, operation, self.region,
+            time.monotonic() - start - waited,
+            waited=waited,
+            attempts=attempt,
+            throttles=throttles,
+            pages=int(operation.startswith('list_')),
+            size=size,
+            error=error
+         )
+
+   ### wait for a token - or for a free slot while the limiter is open ###
+   #########################################################################
+   @asynccontextmanager
+   async def admit(self):
+      while self.limiter is not None:
+         if self.limiter.rate is None:
+            async with self.engine.open_slots( self.service, self.region ):
+               # the first 429 may have set a rate while this call waited
+               if self.limiter.rate is None:
+                  yield
+                  return
+            continue
+
+         sleep_time = self.limiter.try_acquire()
+         if not sleep_time:
+            break
+         await asyncio.sleep(sleep_time)
+
+      yield
+
+   def service_error(self, operation, request, status, headers, body):
+      try:
+         details = json.loads(body)
+      except ValueError:
+         details = {}
+
+      return oci.exceptions.ServiceError(
+         status, details.get('code'), headers, details.get('message'),
+         operation_name=operation, target_service=self.service, request_endpoint=f'{request.method} {request.url}'
+      )
+
+   ### every record of a list operation, page by page ###
+   ######################################################
+   async def list_all(self, operation, *args, **kwargs):
+      records = []
+      while True:
+         response = await self.call( operation, *args, **kwargs )
+
+         # some list calls wrap their records in a collection
+         records += getattr( response.data, 'items', response.data )
+         if not response.has_next_page:
+            return records
+
+         kwargs[ 'page' ] = response.next_page
+
+### run coroutines, log failures and return the results ###
+###########################################################
+# Like Scheduler.gather - a failed task is logged and gives None.
+async def gather(coroutines):
+   results = await asyncio.gather( *coroutines, return_exceptions=True )
+
+   for result in results:
+      if isinstance(result, BaseException):
+         logger.error("A scheduled task failed.")
+         logger.exception(format_exception(type(result), result, result.__traceback__))
+
+   return [ None if isinstance(result, BaseException) else result for result in results ]
+
+### the fields the threaded collectors set up in __init__ ###
+#############################################################
+def init_collector(collector, engine, name, *lists):
+   collector.engine = engine
+   collector.name = name
+   collector.uploads = engine.oci_service.uploads
+   collector.report_no = engine.oci_service.report_no
+   collector.tenancy_id = engine.config[ 'tenancy' ]
+   for list_name in lists:
+      setattr(collector, list_name, [])
+
+class AsyncCompute(Compute):
+   def __init__(self, engine, name):
+      init_collector( self, engine, name, 'dedicated_hosts', 'instances', 'bv_attachments', 'vol_attachments' )
+
+   async def collect(self, tenancy):
+      jobs = []
+      for region in tenancy.regions:
+         compute_client = self.engine.client( oci.core.ComputeClient, region.region_name, self.name )
+         for c in tenancy.get_compartments():
+            jobs.append( self.get_info(c, compute_client, tenancy, region) )
+
+      for result in await gather(jobs):
+         for list_name, records in (result or {}).items():
+            getattr(self, list_name).extend( records )
+
+      logger.info("Compute - DONE.")
+
+   async def get_info(self, c, compute_client, tenancy, region):
+      ads = tenancy.get_availability_domains(region.region_name)
+      dedicated_hosts, instances, vol_attachments, *bv_attachments = await asyncio.gather(
+         compute_client.list_all( 'list_dedicated_vm_hosts', c.id ),
+         compute_client.list_all( 'list_instances', c.id ),
+         compute_client.list_all( 'list_volume_attachments', c.id ),
+         *( compute_client.list_all( 'list_boot_volume_attachments', ad.name, c.id ) for ad in ads )
+      )
+
+      return { 'dedicated_hosts': dedicated_hosts, 'instances': instances, 'vol_attachments': vol_attachments, 'bv_attachments': [ attachment for attachments in bv_attachments for attachment in attachments ] }
+
+class AsyncBlockStorage(BlockStorage):
+   def __init__(self, engine, name):
+      init_collector( self, engine, name, 'boot_volumes', 'block_volumes' )
+
+   async def collect(self, tenancy):
+      jobs = []
+      for region in tenancy.regions:
+         block_storage_client = self.engine.client( oci.core.BlockstorageClient, region.region_name, self.name )
+         for c in tenancy.get_compartments():
+            jobs.append( self.get_info(c, block_storage_client, tenancy, region) )
+
+      for result in await gather(jobs):
+         for list_name, records in (result or {}).items():
+            getattr(self, list_name).extend( records )
+
+      logger.info("Block Storage - DONE.")
+
+   async def get_info(self, c, block_storage_client, tenancy, region):
+      ads = tenancy.get_availability_domains(region.region_name)
+      block_volumes, *boot_volumes = await asyncio.gather(
+         block_storage_client.list_all( 'list_volumes', compartment_id=c.id ),
+         *( block_storage_client.list_all( 'list_boot_volumes', availability_domain=ad.name, compartment_id=c.id ) for ad in ads )
+      )
+
+      return { 'block_volumes': block_volumes, 'boot_volumes': [ volume for volumes in boot_volumes for volume in volumes ] }
+
+class AsyncDBSystem(DBSystem):
+   def __init__(self, engine, name):
+      init_collector( self, engine, name, 'db_systems', 'db_homes', 'databases', 'autonomous_exadata', 'autonomous_cdb', 'autonomous_db' )
+
+   async def collect(self, tenancy):
+      jobs = []
+      for region in tenancy.regions:
+         db_client = self.engine.client( oci.database.DatabaseClient, region.region_name, self.name )
+         for c in tenancy.get_compartments():
+            jobs.append( self.get_info(c, db_client) )
+
+      for result in await gather(jobs):
+         for list_name, records in (result or {}).items():
+            getattr(self, list_name).extend( records )
+
+      logger.info("DB Systems - DONE.")
+
+   async def get_databases(self, c, db_client):
+      db_homes = await db_client.list_all( 'list_db_homes', c.id )
+      databases = await asyncio.gather( *( db_client.list_all( 'list_databases', c.id, db_home_id=db_home.id ) for db_home in db_homes ) )
+      return db_homes, [ db for dbs in databases for db in dbs ]
+
+   async def get_info(self, c, db_client):
+      db_systems, ( db_homes, databases ), autonomous_exadata, autonomous_cdb, autonomous_db = await asyncio.gather(
+         db_client.list_all( 'list_db_systems', c.id ),
+         self.get_databases( c, db_client ),
+         db_client.list_all( 'list_autonomous_exadata_infrastructures', c.id ),
+         db_client.list_all( 'list_autonomous_container_databases', c.id ),
+         db_client.list_all( 'list_autonomous_databases', c.id )
+      )
+
+      return { 'db_systems': db_systems, 'db_homes': db_homes, 'databases': databases, 'autonomous_exadata': autonomous_exadata, 'autonomous_cdb': autonomous_cdb, 'autonomous_db': autonomous_db }
+
+class AsyncImages(Images):
+   def __init__(self, engine, name):
+      init_collector( self, engine, name, 'images' )
+      self.cache = engine.oci_service.cache
+      self.cache_ttl = float(engine.config.get('images_cache_ttl_hours', 24)) * 3600
+
+   async def collect(self, tenancy):
+      jobs = []
+      for region in tenancy.regions:
+         compute_client = self.engine.client( oci.core.ComputeClient, region.region_name, self.name )
+         jobs.append( self.get_platform_images(compute_client, region) )
+         for c in tenancy.get_compartments():
+            jobs.append( self.get_info(c, compute_client) )
+
+      for images in await gather(jobs):
+         self.images.extend( images or [] )
+
+      # an image is listed once whatever the number of listings it showed up in
+      self.images = list( { image.id: image for image in self.images }.values() )
+
+   async def get_platform_images(self, compute_client, region):
+      cache_name = f'platform_images_{self.tenancy_id}_{region.region_name}'
+      cached = self.cache.get( cache_name, self.cache_ttl )
+      if cached is not None:
+         return compute_client.base_client.deserialize_response_data( json.dumps(cached).encode('utf-8'), 'list[Image]' )
+
+      images = [ image for image in await compute_client.list_all( 'list_images', self.tenancy_id ) if image.compartment_id is None ]
+      self.cache.put( cache_name, compute_client.base_client.sanitize_for_serialization(images) )
+      return images
+
+   async def get_info(self, c, compute_client):
+      # every listing repeats the platform images - keep the compartment's own
+      return [ image for image in await compute_client.list_all( 'list_images', c.id ) if image.compartment_id == c.id ]
+
+class AsyncLimit(Limit):
+   def __init__(self, engine, name):
+      init_collector( self, engine, name, 'limit_summary' )
+      self.cache = engine.oci_service.cache
+      self.cache_ttl = float(engine.config.get('limits_cache_ttl_hours', 24)) * 3600
+      self.rate = float(engine.config.get('limits_rate', 10))
+
+   async def collect(self, tenancy):
+      for rows in await gather( self.get_region(region.region_name) for region in tenancy.regions ):
+         self.limit_summary.extend( rows or [] )
+
+      logger.info("Limit - DONE.")
+
+   ### services and limit values of a region - cached like Limit does ###
+   ######################################################################
+   async def get_definitions(self, limits_client, region_name):
+      cache_name = f'limits_{self.tenancy_id}_{region_name}'
+      cached = self.cache.get( cache_name, self.cache_ttl )
+      if cached is not None:
+         return [ ( oci.limits.models.ServiceSummary(**service), [ oci.limits.models.LimitValueSummary(**limit) for limit in cached[ 'limits' ][ service[ 'name' ] ] ] ) for service in cached[ 'services' ] ]
+
+      services = await limits_client.list_all( 'list_services', self.tenancy_id, sort_by="name" )
+      limits = await asyncio.gather( *( limits_client.list_all( 'list_limit_values', self.tenancy_id, service_name=service.name, sort_by="name" ) for service in services ) )
+      self.cache.put( cache_name, {
+         'services': [ oci.util.to_dict(service) for service in services ],
+         'limits': { service.name: [ oci.util.to_dict(limit) for limit in service_limits ] for service, service_limits in zip(services, limits) }
+      } )
+
+      return list( zip(services, limits) )
+
+   async def get_region(self, region_name):
+      limits_client = self.engine.client( oci.limits.LimitsClient, region_name, self.name )
+      limiter = RateLimiter( self.rate )
+
+      jobs = []
+      for service, limits in await self.get_definitions( limits_client, region_name ):
+         # if not limit, continue, don't calculate limit = 0
+         jobs += [ self.get_info(service, limits_client, limiter, limit, region_name) for limit in limits if limit.value != 0 ]
+
+      return [ row for row in await gather(jobs) if row is not None ]
+
+   async def get_info(self, service, limits_client, limiter, limit, region):
+      val = {
+               'service_name': str(service.name),
+               'service_description': str(service.description),
+               'limit_name': str(limit.name),
+               'availability_domain': ("" if limit.availability_domain is None else str(limit.availability_domain)),
+               'scope_type': str(limit.scope_type),
+               'value': str(limit.value),
+               'used': "",
+               'available': "",
+               'region_name': str(region)
+      }
+
+      # get usage per limit if available - at most limits_rate calls a second per region
+      while True:
+         sleep_time = limiter.try_acquire()
+         if not sleep_time:
+            break
+         await asyncio.sleep(sleep_time)
+
+      if limit.scope_type == "AD":
+         usage = ( await limits_client.call( 'get_resource_availability', service.name, limit.name, self.tenancy_id, availability_domain=limit.availability_domain ) ).data
+      else:
+         usage = ( await limits_client.call( 'get_resource_availability', service.name, limit.name, self.tenancy_id ) ).data
+
+      # oci.limits.models.ResourceAvailability
+      if usage.used:
+         val['used'] = str(usage.used)
+
+      if usage.available:
+         val['available'] = str(usage.available)
+
+      return val
+
+class AsyncMonitoring(Monitoring):
+   def __init__(self, engine, name):
+      self.engine = engine
+      self.name = name
+
+   async def collect(self, tenancy):
+      self.configure( self.engine.oci_service, tenancy )
+
+      queries = []
+      for region_name, name, parts in self.queries(tenancy):
+         monitor = self.engine.client( oci.monitoring.MonitoringClient, region_name, self.name )
+         queries.append( ( name, gather( [ self.get_metrics(monitor, details, compartment_id, in_subtree) for details, compartment_id, in_subtree in parts ] ) ) )
+
+      # merge the slices of every query in query order
+      for ( name, _ ), results in zip( queries, await asyncio.gather( *( parts for _, parts in queries ) ) ):
+         self.merge( name, results )
+
+   async def get_metrics(self, monitor, metrics_summary, compartment_id, in_subtree):
+      return ( await monitor.call( 'summarize_metrics_data', compartment_id, metrics_summary, compartment_id_in_subtree=in_subtree ) ).data
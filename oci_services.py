@@ -3,44 +3,79 @@ import time
 import datetime
 import requests
 import logging
+import csv
+import io
+import tempfile
+import random
+import urllib.parse
 import socket
 import sys
 import os
+import configparser
+import sqlite3
+import hashlib
+import json
+import math
+import heapq
+import gzip
+import shutil
+import re
+import cProfile
+import pstats
+import tracemalloc
 from logging.handlers import SysLogHandler
-from threading import Thread
+from threading import Lock, local, Event, Thread, Timer, get_ident, active_count, current_thread, enumerate as enumerate_threads
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager, nullcontext
+from functools import partial
 from traceback import format_exception
 
+# optional (pip install pyarrow) - only output_format parquet and arrow need
+# pyarrow; OutputFormat raises for those formats when it is missing
+try:
+   import pyarrow
+   import pyarrow.ipc
+   import pyarrow.parquet
+except ImportError:
+   pyarrow = None
+
+# optional - only zstd upload compression needs zstandard
+try:
+   import zstandard
+except ImportError:
+   zstandard = None
+
 ### Global Variables ###
 ########################
 config = None
 signer = None
-report_no = None
-par_url = None
 ########################
 
-### Check APP Name ###
-######################
-try:
-  app_name = sys.argv[2]
-except Exception:
-   app_name = 'NONE'
-######################
-
 ### LOGGER ###
 ##############
-# Pass the two as env variables when runing the docker container
-logging_address = os.environ['LOGGING_ADDRESS']
-logging_port = os.environ['LOGGING_PORT']
-
-# log to CSA VM on TCP
-syslog = SysLogHandler(address=(logging_address, int(logging_port)))
-format = f'%(asctime)s {app_name}: %(levelname)s : %(lineno)d : %(message)s'
-formatter = logging.Formatter(format, datefmt='%b %d %H:%M:%S')
-syslog.setFormatter(formatter)
-
 logger = logging.getLogger()
-logger.addHandler(syslog)
 logger.setLevel(logging.INFO)
+
+# called by extract_data.py with the app name from its arguments
+def configure_logging(app_name='NONE'):
+   # Pass the two as env variables when runing the docker container
+   logging_address = os.environ['LOGGING_ADDRESS']
+   logging_port = os.environ['LOGGING_PORT']
+
+   # log to CSA VM on TCP
+   syslog = SysLogHandler(address=(logging_address, int(logging_port)))
+   format = f'%(asctime)s {app_name}: %(levelname)s : %(lineno)d : %(message)s'
+   formatter = logging.Formatter(format, datefmt='%b %d %H:%M:%S')
+   syslog.setFormatter(formatter)
+   logger.addHandler(syslog)
+
+# the run's start marker and the collector lines syslog gets first - logged
+# by extract_data.py once the handler is attached, not at import time
+def log_start():
+   logger.info("### START ###")
+   for name in ( 'Tennancy', 'Announcement', 'Limit', 'Images', 'Compute', 'Block Storage', 'DB System', 'Monitoring' ):
+      logger.info(f'Initiate {name} object...')
 ##############
 
 ### Uncaught Exception Handler ###
@@ -90,19 +125,1395 @@ retry_strategy_via_constructor = oci.retry.RetryStrategyBuilder(
    # exponential backoff and retry with equal jitter
    backoff_type=oci.retry.BACKOFF_FULL_JITTER_EQUAL_ON_THROTTLE_VALUE
 ).get_retry_strategy()
+
+# Same strategy without the 429 entry. Calls made through a ThrottledClient
+# use it so throttles come back to the client-side rate limiter instead of
+# being retried by the SDK behind its back.
+retry_strategy_without_throttle = oci.retry.RetryStrategyBuilder(
+   max_attempts_check=True,
+   max_attempts=10,
+   total_elapsed_time_check=True,
+   total_elapsed_time_seconds=600,
+   retry_max_wait_between_calls_seconds=60,
+   retry_base_sleep_time_seconds=2,
+   service_error_check=True,
+   service_error_retry_on_any_5xx=True,
+   service_error_retry_config={
+      400: ['QuotaExceeded', 'LimitExceeded']
+   },
+   backoff_type=oci.retry.BACKOFF_FULL_JITTER_VALUE
+).get_retry_strategy()
 ####################################
 
-logger.info("### START ###")
+### Collector of the running call ###
+######################################
+# Pipeline stages name the collector of their thread. Tasks handed to other
+# threads are wrapped with bind_collector so the calls they make are still
+# counted against that collector.
+call_context = local()
+
+def current_collector():
+   return getattr(call_context, 'collector', None)
+
+def bind_collector(fn):
+   collector = current_collector()
+
+   def run(*args, **kwargs):
+      call_context.collector = collector
+      return fn(*args, **kwargs)
+
+   return run
+
+### Shared Work Scheduler ###
+#############################
+# All collectors submit their OCI list calls here instead of starting one
+# thread per region x compartment. A single bounded pool runs the calls and
+# a task only starts when the global, per-region and per-service (region +
+# service endpoint) limits all have room, so we never run faster than the
+# API throttling allows. In batch mode several tenancies share the pool:
+# each tenancy has its own queues and region/service limits, and tenancies
+# are served round-robin so a large one can't starve the others.
+#
+# A task can also carry a RateLimiter: it is only started once the limiter
+# has a token, and until then its queue is skipped and a timer dispatches
+# again - tasks never wait for a token while holding a worker.
+class Scheduler(object):
+   def __init__(self, max_workers=32, region_workers=16, service_workers=8):
+      self.max_workers = max_workers
+      self.region_workers = region_workers
+      self.service_workers = service_workers
+
+      self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='oci-worker')
+
+      # side pool for page prefetches - workers may block on these, so they
+      # must not share the main pool
+      self.prefetch_workers = max(1, max_workers // 4)
+      self.prefetcher = ThreadPoolExecutor(max_workers=self.prefetch_workers, thread_name_prefix='oci-prefetch')
+      self.lock = Lock()
+      self.running = 0
+      self.running_regions = {}
+      self.running_services = {}
+
+      # per tenancy, one FIFO queue per (region, service) - both levels
+      # are served round-robin
+      self.queues = OrderedDict()
+      # when the timer waiting for a rate-limited queue fires
+      self.wake_at = None
+
+   ### queue a call and return a Future for its result ###
+   #######################################################
+   def submit(self, fn, *args, region=None, service=None, tenant=None, limiter=None, **kwargs):
+      future = Future()
+      key = (tenant, region, service)
+      fn = bind_collector(fn)
+
+      with self.lock:
+         self.queues.setdefault(tenant, OrderedDict()).setdefault(key, deque()).append( (fn, args, kwargs, future, limiter) )
+         self.dispatch()
+
+      return future
+
+   ### start queued tasks while limits allow - caller holds the lock ###
+   #####################################################################
+   def dispatch(self):
+      started = True
+
+      while started and self.running < self.max_workers:
+         started = False
+
+         # at most one task per tenancy per pass
+         for tenant in list(self.queues):
+            if self.running >= self.max_workers:
+               break
+
+            queues = self.queues[tenant]
+            for key in list(queues):
+               region_key = key[:2]
+               if self.running_regions.get(region_key, 0) >= self.region_workers:
+                  continue
+               if self.running_services.get(key, 0) >= self.service_workers:
+                  continue
+
+               queue = queues[key]
+               limiter = queue[0][4]
+               if limiter is not None:
+                  sleep_time = limiter.try_acquire()
+                  if sleep_time:
+                     self.wake_in(sleep_time)
+                     continue
+
+               task = queue.popleft()
+               if queue:
+                  # move to the back so other regions/services get their turn
+                  queues.move_to_end(key)
+               else:
+                  del queues[key]
+
+               if queues:
+                  self.queues.move_to_end(tenant)
+               else:
+                  del self.queues[tenant]
+
+               self.running += 1
+               self.running_regions[region_key] = self.running_regions.get(region_key, 0) + 1
+               self.running_services[key] = self.running_services.get(key, 0) + 1
+               self.executor.submit(self.run, key, task)
+               started = True
+               break
+
+   ### dispatch again once a rate-limited queue has a token - caller holds the lock ###
+   ####################################################################################
+   def wake_in(self, seconds):
+      wake_at = time.monotonic() + seconds
+      if self.wake_at is not None and self.wake_at <= wake_at:
+         return
+
+      self.wake_at = wake_at
+      timer = Timer(seconds, self.wake)
+      timer.daemon = True
+      timer.start()
+
+   def wake(self):
+      with self.lock:
+         self.wake_at = None
+         self.dispatch()
+
+   ### worker - run a task then hand the slot to the next one ###
+   ##############################################################
+   def run(self, key, task):
+      fn, args, kwargs, future, _ = task
+
+      try:
+         if future.set_running_or_notify_cancel():
+            try:
+               future.set_result(fn(*args, **kwargs))
+            except BaseException as err:
+               future.set_exception(err)
+      finally:
+         with self.lock:
+            self.running -= 1
+            self.running_regions[key[:2]] -= 1
+            self.running_services[key] -= 1
+            self.dispatch()
+
+   ### wait for a batch of futures, log failures and return the results ###
+   ########################################################################
+   def gather(self, futures):
+      results = []
+
+      for future in futures:
+         try:
+            results.append(future.result())
+         except Exception as err:
+            logger.error("A scheduled task failed.")
+            logger.exception(format_exception(type(err), err, err.__traceback__))
+            results.append(None)
+
+      return results
+
+   def shutdown(self):
+      self.executor.shutdown(wait=True)
+      self.prefetcher.shutdown(wait=True)
+
+### Token bucket rate limiter ###
+#################################
+# acquire() blocks until a token is free. Tokens refill at rate per second
+# up to burst, so short bursts go straight through and a long fan-out
+# settles at rate calls per second.
+class RateLimiter(object):
+   def __init__(self, rate, burst=None):
+      self.rate = rate
+      self.burst = burst or max(1, rate)
+      self.tokens = self.burst
+      self.updated = time.monotonic()
+      self.lock = Lock()
+
+   def acquire(self):
+      while True:
+         sleep_time = self.try_acquire()
+         if not sleep_time:
+            return
+
+         time.sleep(sleep_time)
+
+   ### take a token - 0 if one was free, else the seconds until the next ###
+   #########################################################################
+   def try_acquire(self):
+      with self.lock:
+         now = time.monotonic()
+         self.tokens = min( self.burst, self.tokens + (now - self.updated) * self.rate )
+         self.updated = now
+         if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+         return (1 - self.tokens) / self.rate
+
+### Adaptive rate limit ###
+###########################
+# A token bucket that tunes its own rate, AIMD style: every successful call
+# adds increase / rate (about +increase calls/s per second of traffic), a 429
+# halves the rate. Throttles arriving within a cooldown of the last decrease
+# come from calls already in flight and are only counted. While latency runs
+# well above its baseline the rate is held instead of raised, so a service
+# that is slowing down is not pushed into throttling.
+#
+# Without a starting rate the limiter stays open until the first 429 and
+# only counts the calls that succeed; the rate then starts at the rate the
+# service accepted over the last window seconds. A run that is never
+# throttled is never slowed down.
+class AdaptiveRateLimiter(RateLimiter):
+   def __init__(self, rate=None, minimum=1, maximum=100, increase=1, decrease=0.5, cooldown=1, latency_factor=3, window=5):
+      super().__init__(maximum)
+      self.rate = None
+      self.minimum = minimum
+      self.maximum = maximum
+      self.increase = increase
+      self.decrease = decrease
+      self.cooldown = cooldown
+      self.latency_factor = latency_factor
+      self.window = window
+      self.latency = None
+      self.baseline = None
+      self.decreased = 0
+      self.calls = 0
+      self.throttles = 0
+      self.lowest = None
+      self.opened = time.monotonic()
+      self.recent = deque()
+      if rate is not None:
+         self.set_rate( rate )
+
+   def set_rate(self, rate):
+      self.rate = min( self.maximum, max( self.minimum, rate ) )
+      self.burst = max( 1, self.rate )
+      self.tokens = min( self.tokens, self.burst )
+      self.lowest = self.rate if self.lowest is None else min( self.lowest, self.rate )
+
+   def try_acquire(self):
+      if self.rate is None:
+         return 0
+
+      return super().try_acquire()
+
+   ### calls per second the service accepted lately - while open ###
+   ##################################################################
+   def observed_rate(self, now):
+      while self.recent and self.recent[0] < now - self.window:
+         self.recent.popleft()
+      return len(self.recent) / max( 1, min( self.window, now - self.opened ) )
+
+   def succeeded(self, latency):
+      with self.lock:
+         self.calls += 1
+         if self.latency is None:
+            self.latency = self.baseline = latency
+         else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+            self.baseline = min( latency, 0.95 * self.baseline + 0.05 * latency )
+
+         if self.rate is None:
+            # trimmed as it goes, so a long open run keeps one window of calls
+            self.recent.append( time.monotonic() )
+            self.observed_rate( self.recent[-1] )
+         elif self.latency <= self.latency_factor * self.baseline:
+            self.set_rate( self.rate + self.increase / self.rate )
+
+   def throttled(self):
+      with self.lock:
+         self.calls += 1
+         self.throttles += 1
+         now = time.monotonic()
+         if self.rate is None:
+            self.decreased = self.updated = now
+            self.set_rate( self.observed_rate(now) )
+            self.recent.clear()
+            self.tokens = 0
+         elif now - self.decreased >= self.cooldown:
+            self.decreased = now
+            self.set_rate( self.rate * self.decrease )
+            self.tokens = min( self.tokens, 0 )
+
+### Call statistics ###
+#######################
+# Count, errors, HTTP attempts, 429s, pages, bytes and latencies of every
+# OCI call and upload request, per (collector, service, operation, region).
+# HTTP attempts and response bytes are counted by a hook on the shared
+# sessions, so retries made inside the SDK show up as well.
+def count_response(response, *args, **kwargs):
+   call_context.attempts = getattr(call_context, 'attempts', 0) + 1
+   call_context.bytes = getattr(call_context, 'bytes', 0) + int(response.headers.get('content-length') or 0)
+   return response
+
+class CallStats(object):
+   def __init__(self):
+      self.lock = Lock()
+      self.calls = {}
+
+   def record(self, collector, service, operation, region, seconds, waited=0, attempts=1, throttles=0, pages=0, size=0, error=False):
+      key = (collector or '', service, operation, region or '')
+
+      with self.lock:
+         stats = self.calls.get(key)
+         if stats is None:
+            stats = self.calls[key] = { 'calls': 0, 'errors': 0, 'attempts': 0, 'throttles': 0, 'pages': 0, 'bytes': 0, 'waited': 0.0, 'latencies': [] }
+
+         stats[ 'calls' ] += 1
+         stats[ 'errors' ] += int(error)
+         stats[ 'attempts' ] += attempts
+         stats[ 'throttles' ] += throttles
+         stats[ 'pages' ] += pages
+         stats[ 'bytes' ] += size
+         stats[ 'waited' ] += waited
+         stats[ 'latencies' ].append( seconds )
+
+   ### one row per key with latency percentiles - for the run report ###
+   ######################################################################
+   def summary(self):
+      rows = []
+      with self.lock:
+         for (collector, service, operation, region), stats in sorted(self.calls.items()):
+            latencies = sorted(stats[ 'latencies' ])
+            rows.append({
+               'collector': collector,
+               'service': service,
+               'operation': operation,
+               'region': region,
+               'calls': stats[ 'calls' ],
+               'errors': stats[ 'errors' ],
+               'attempts': stats[ 'attempts' ],
+               'retries': stats[ 'attempts' ] - stats[ 'calls' ],
+               'throttles': stats[ 'throttles' ],
+               'pages': stats[ 'pages' ],
+               'bytes': stats[ 'bytes' ],
+               'seconds': round(sum(latencies), 3),
+               'wait_seconds': round(stats[ 'waited' ], 3),
+               'p50': round(percentile(latencies, 0.5), 4),
+               'p90': round(percentile(latencies, 0.9), 4),
+               'p99': round(percentile(latencies, 0.99), 4),
+               'max': round(latencies[-1], 4)
+            })
+
+      return rows
+
+   ### log the busiest services ###
+   ################################
+   def report(self, top=10):
+      totals = {}
+      for row in self.summary():
+         total = totals.setdefault( (row[ 'service' ], row[ 'region' ]), { 'calls': 0, 'retries': 0, 'throttles': 0, 'seconds': 0 } )
+         for name in total:
+            total[name] += row[name]
+
+      logger.info(" --- OCI calls --- ")
+      for (service, region), total in sorted(totals.items(), key=lambda item: -item[1][ 'seconds' ])[:top]:
+         logger.info(f'{service} {region}: {total["calls"]} calls, {total["retries"]} retries, {total["throttles"]} throttled, {total["seconds"]:.2f}s')
+
+### OCI client behind a rate limiter ###
+########################################
+# Every method call waits for a token, reports its latency and handles 429s
+# itself: the limiter slows down and the call is retried once the limiter
+# lets it through again, within the same attempt and time budget as
+# retry_strategy_via_constructor. Other errors are raised unchanged. Each
+# call is recorded in the CallStats of the tenancy.
+THROTTLE_ATTEMPTS = 10
+THROTTLE_SECONDS = 600
+
+class ThrottledClient(object):
+   def __init__(self, client, limiter, stats, service, region):
+      self.client = client
+      self.limiter = limiter
+      self.stats = stats
+      self.service = service
+      self.region = region
+
+   def __getattr__(self, name):
+      attr = getattr(self.client, name)
+      if name.startswith('_') or not callable(attr):
+         return attr
+
+      # the collector is taken here, in the thread that asked for the method
+      return partial(self.call, name, attr, current_collector())
+
+   def call(self, operation, method, collector, *args, **kwargs):
+      if kwargs.get('retry_strategy') is retry_strategy_via_constructor:
+         kwargs['retry_strategy'] = retry_strategy_without_throttle
+
+      call_context.attempts = call_context.bytes = 0
+      start = time.monotonic()
+      waited = 0
+      throttles = 0
+      error = True
+      try:
+         for attempt in range(1, THROTTLE_ATTEMPTS + 1):
+            wait_start = time.monotonic()
+            if self.limiter is not None:
+               self.limiter.acquire()
+            call_start = time.monotonic()
+            waited += call_start - wait_start
+
+            try:
+               result = method(*args, **kwargs)
+            except oci.exceptions.ServiceError as e:
+               if e.status != 429 or attempt == THROTTLE_ATTEMPTS or time.monotonic() - start > THROTTLE_SECONDS:
+                  raise
+
+               throttles += 1
+               if self.limiter is not None:
+                  self.limiter.throttled()
+               time.sleep( random.uniform(0, min(60, 2 ** attempt) / 4) )
+               continue
+
+            if self.limiter is not None:
+               self.limiter.succeeded( time.monotonic() - call_start )
+            error = False
+            return result
+      finally:
+         self.stats.record(
+            collector, self.service, operation, self.region,
+            time.monotonic() - start - waited,
+            waited=waited,
+            attempts=max(call_context.attempts, throttles + 1),
+            throttles=throttles,
+            pages=int(operation.startswith('list_')),
+            size=call_context.bytes,
+            error=error
+         )
+
+### One tenancy's view of a shared scheduler ###
+################################################
+# Collectors call submit() as usual; the tasks are queued under the
+# tenancy so the scheduler can keep tenancies fair. With --profile every
+# task and page prefetch is profiled as a task of the collector that
+# submitted it.
+class TenantScheduler(object):
+   def __init__(self, scheduler, tenant, profiler=None):
+      self.scheduler = scheduler
+      self.tenant = tenant
+      self.profiler = profiler
+      self.prefetcher = ProfiledPool( scheduler.prefetcher, self ) if profiler else scheduler.prefetcher
+
+   def profiled(self, fn):
+      if self.profiler is None:
+         return fn
+
+      return self.profiler.wrap_task( current_collector() or 'scheduler', fn )
+
+   def submit(self, fn, *args, **kwargs):
+      return self.scheduler.submit(self.profiled(fn), *args, tenant=self.tenant, **kwargs)
+
+   def __getattr__(self, name):
+      return getattr(self.scheduler, name)
+
+class ProfiledPool(object):
+   def __init__(self, executor, tenant_scheduler):
+      self.executor = executor
+      self.tenant_scheduler = tenant_scheduler
+
+   def submit(self, fn, *args, **kwargs):
+      return self.executor.submit(self.tenant_scheduler.profiled(fn), *args, **kwargs)
+
+### Lazy pagination over OCI list calls ###
+###########################################
+# Yields records page by page instead of materialising the whole listing the
+# way list_call_get_all_results does, so callers can work on the first page
+# while later ones are still coming. Pass an executor as prefetch to request
+# the next page in the background while the current one is consumed.
+def paginate( list_call, *args, prefetch=None, **kwargs ):
+   response = list_call( *args, **kwargs )
+
+   while True:
+      next_page = None
+      if response.has_next_page and prefetch is not None:
+         next_page = prefetch.submit( list_call, *args, page=response.next_page, **kwargs )
+
+      # some list calls wrap their records in a collection
+      yield from getattr( response.data, 'items', response.data )
+
+      if not response.has_next_page:
+         break
+
+      response = next_page.result() if next_page is not None else list_call( *args, page=response.next_page, **kwargs )
+
+### Per-collector result store ###
+###################################
+# Collector results used to live in class-level lists that every worker
+# thread appended to with "+=", shared across instances (and tenancies).
+# Each worker thread now appends to its own shard of a store owned by the
+# collector instance, so there is no shared list to contend on, and the
+# shards are merged once the collector's tasks are done.
+class ResultStore(object):
+   def __init__(self, *names):
+      self.names = names
+      self.local = local()
+      self.lock = Lock()
+      self.shards = []
+
+   ### this thread's lists - created on first use ###
+   ##################################################
+   def shard(self):
+      shard = getattr(self.local, 'shard', None)
+      if shard is None:
+         shard = self.local.shard = { name: [] for name in self.names }
+         with self.lock:
+            self.shards.append(shard)
+
+      return shard
+
+   def append(self, name, item):
+      self.shard()[name].append(item)
+
+   def extend(self, name, items):
+      self.shard()[name].extend(items)
+
+   ### lengths of this thread's lists - hand back to since() ###
+   #############################################################
+   def mark(self):
+      return { name: len(items) for name, items in self.shard().items() }
+
+   ### what this thread added after mark() ###
+   ###########################################
+   def since(self, mark):
+      return { name: items[mark[name]:] for name, items in self.shard().items() }
+
+   ### merge all shards into one list per name on the target object ###
+   ####################################################################
+   def merge_into(self, target):
+      with self.lock:
+         for name in self.names:
+            merged = []
+            for shard in self.shards:
+               merged += shard[name]
+            setattr(target, name, merged)
+
+### Profiling ###
+#################
+# --profile mode. Pipeline stages, create_csv calls and table uploads run
+# as profiled sections: wall time, CPU time of the section's thread and of
+# the process, traced memory and thread counts are kept for the summary.
+# A sampler thread snapshots memory and threads every interval. With the
+# sample profiler it also takes the stack of every thread, written as
+# folded stacks (flamegraph.pl, speedscope) per section or thread pool.
+# With cprofile the outermost section of each thread is profiled into
+# <section>.prof. tracemalloc is only started with trace_memory, as it
+# slows down every allocation.
+#
+# The OCI calls of a section run as tasks on the scheduler's pool threads.
+# Tasks are too many to keep one by one: per section their count, wall and
+# thread CPU time are added up, sampled stacks of a pool thread go to the
+# section of its task, and with cprofile each pool thread keeps one profile
+# per section, merged into <section>.tasks.prof.
+PROFILERS = ( 'sample', 'cprofile', 'none' )
+
+class Profiler(object):
+   def __init__(self, directory, profiler='sample', trace_memory=False, interval=0.05):
+      if profiler not in PROFILERS:
+         raise ValueError(f'profiler must be one of {", ".join(PROFILERS)}, not {profiler}')
+
+      self.directory = directory
+      self.profiler = profiler
+      self.trace_memory = trace_memory
+      self.interval = interval
+      self.lock = Lock()
+      self.local = local()
+      self.stopped = Event()
+      self.sampler = None
+      # thread ident -> the sections open on that thread, innermost last
+      self.active = {}
+      self.sections = []
+      self.stacks = {}
+      self.timeline = []
+      # thread ident -> section of the task running on that pool thread
+      self.running_tasks = {}
+      self.tasks = OrderedDict()
+      # (section, thread ident) -> cProfile of the section's tasks on that thread
+      self.task_profiles = {}
+
+   def start(self):
+      os.makedirs( self.directory, exist_ok=True )
+      if self.trace_memory and not tracemalloc.is_tracing():
+         tracemalloc.start()
+
+      self.started = time.monotonic()
+      self.sampler = Thread( target=self.sample, name='oci-profiler', daemon=True )
+      self.sampler.start()
+
+   def traced_memory(self):
+      return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+   ### a section of one thread - sections on the same thread may nest ###
+   #######################################################################
+   @contextmanager
+   def section(self, name):
+      thread = get_ident()
+      memory = self.traced_memory()
+      threads = active_count()
+      record = {
+         'section': name, 'thread': current_thread().name, 'start': round(time.monotonic() - self.started, 3),
+         'memory_start': memory, 'memory_peak': memory, 'threads_start': threads, 'threads_max': threads, 'profile': ''
+      }
+
+      with self.lock:
+         self.sections.append( record )
+         self.active.setdefault( thread, [] ).append( record )
+
+      # a thread can only be profiled once at a time
+      profile = None
+      depth = getattr( self.local, 'depth', 0 )
+      if self.profiler == 'cprofile' and depth == 0:
+         profile = cProfile.Profile()
+         try:
+            profile.enable()
+         except ValueError as err:
+            logger.warning(f'Profiler - {name} not profiled: {err}')
+            profile = None
+
+      self.local.depth = depth + 1
+      wall = time.monotonic()
+      thread_cpu = time.thread_time()
+      process_cpu = time.process_time()
+      try:
+         yield
+      finally:
+         if profile is not None:
+            profile.disable()
+         self.local.depth = depth
+
+         memory = self.traced_memory()
+         record.update( {
+            'wall_seconds': round(time.monotonic() - wall, 3),
+            'thread_cpu_seconds': round(time.thread_time() - thread_cpu, 3),
+            'process_cpu_seconds': round(time.process_time() - process_cpu, 3),
+            'memory_end': memory,
+            'threads_end': active_count()
+         } )
+
+         with self.lock:
+            self.active[thread].remove( record )
+            record[ 'memory_peak' ] = max( record[ 'memory_peak' ], memory )
+
+         if profile is not None:
+            record[ 'profile' ] = f'{self.file_name(name)}.prof'
+            profile.dump_stats( os.path.join( self.directory, record[ 'profile' ] ) )
+
+   def wrap(self, name, fn):
+      def run(*args, **kwargs):
+         with self.section(name):
+            return fn(*args, **kwargs)
+
+      return run
+
+   ### a task of a section on a pool thread ###
+   ############################################
+   @contextmanager
+   def task(self, name):
+      thread = get_ident()
+      with self.lock:
+         self.running_tasks[thread] = name
+         totals = self.tasks.get(name)
+         if totals is None:
+            totals = self.tasks[name] = { 'section': name, 'tasks': 0, 'threads': set(), 'wall_seconds': 0.0, 'thread_cpu_seconds': 0.0, 'profile': '' }
+
+      profile = None
+      depth = getattr( self.local, 'depth', 0 )
+      if self.profiler == 'cprofile' and depth == 0:
+         profile = self.task_profiles.get( ( name, thread ) )
+         if profile is None:
+            profile = self.task_profiles[ ( name, thread ) ] = cProfile.Profile()
+         try:
+            profile.enable()
+         except ValueError:
+            profile = None
+
+      self.local.depth = depth + 1
+      wall = time.monotonic()
+      thread_cpu = time.thread_time()
+      try:
+         yield
+      finally:
+         if profile is not None:
+            profile.disable()
+         self.local.depth = depth
+
+         with self.lock:
+            del self.running_tasks[thread]
+            totals[ 'tasks' ] += 1
+            totals[ 'threads' ].add( thread )
+            totals[ 'wall_seconds' ] += time.monotonic() - wall
+            totals[ 'thread_cpu_seconds' ] += time.thread_time() - thread_cpu
+
+   def wrap_task(self, name, fn):
+      def run(*args, **kwargs):
+         with self.task(name):
+            return fn(*args, **kwargs)
+
+      return run
+
+   ### the same profiler with the sections named <prefix>/<name> ###
+   ##################################################################
+   def scope(self, prefix):
+      return ProfilerScope( self, prefix )
+
+   @staticmethod
+   def file_name(name):
+      return re.sub( r'[^\w.-]+', '.', name ).strip('.')
+
+   ### sampler thread ###
+   ######################
+   def sample(self):
+      own = get_ident()
+      while not self.stopped.wait( self.interval ):
+         memory = self.traced_memory()
+         threads = active_count()
+
+         with self.lock:
+            for records in self.active.values():
+               for record in records:
+                  record[ 'memory_peak' ] = max( record[ 'memory_peak' ], memory )
+                  record[ 'threads_max' ] = max( record[ 'threads_max' ], threads )
+            active = { thread: records[-1][ 'section' ] for thread, records in self.active.items() if records }
+            for thread, name in self.running_tasks.items():
+               active.setdefault( thread, name )
+
+         self.timeline.append( ( round(time.monotonic() - self.started, 3), threads, memory, round(time.process_time(), 3) ) )
+
+         if self.profiler != 'sample':
+            continue
+
+         # stacks go to the section running on the thread, else to its pool
+         names = { thread.ident: re.sub( r'^Thread-\d+', 'Thread', re.sub( r'_\d+$', '', thread.name ) ) for thread in enumerate_threads() }
+         for thread, frame in sys._current_frames().items():
+            if thread == own:
+               continue
+
+            stack = []
+            while frame is not None:
+               stack.append( f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}' )
+               frame = frame.f_back
+
+            stacks = self.stacks.setdefault( active.get( thread, names.get( thread, 'unknown' ) ), Counter() )
+            stacks[ ';'.join( reversed(stack) ) ] += 1
+
+   ### stop sampling and write the profiles and the summary ###
+   ############################################################
+   def stop(self):
+      self.stopped.set()
+      if self.sampler is not None:
+         self.sampler.join()
+
+      peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+      if self.trace_memory and tracemalloc.is_tracing():
+         tracemalloc.stop()
+
+      try:
+         self.write( peak )
+      except Exception as err:
+         # profiling must never fail the extract
+         logger.error(f'Failed to write the profile: {err}')
+
+   def write(self, peak):
+      for name, stacks in self.stacks.items():
+         with open( os.path.join( self.directory, f'{self.file_name(name)}.folded' ), 'w' ) as f:
+            for stack, count in stacks.most_common():
+               f.write( f'{stack} {count}\n' )
+
+      with open( os.path.join( self.directory, 'timeline.csv' ), 'w', newline='' ) as f:
+         writer = csv.writer(f)
+         writer.writerow( [ 'seconds', 'threads', 'traced_memory', 'process_cpu_seconds' ] )
+         writer.writerows( self.timeline )
+
+      with self.lock:
+         sections = [ dict(record) for record in self.sections ]
+         tasks = [ dict(totals, threads=len(totals[ 'threads' ]), wall_seconds=round(totals[ 'wall_seconds' ], 3), thread_cpu_seconds=round(totals[ 'thread_cpu_seconds' ], 3)) for totals in self.tasks.values() ]
+
+      # one profile per section from the profiles of all its pool threads
+      for totals in tasks:
+         profiles = [ profile for ( name, _ ), profile in self.task_profiles.items() if name == totals[ 'section' ] ]
+         if profiles:
+            stats = pstats.Stats( profiles[0] )
+            for profile in profiles[1:]:
+               stats.add( profile )
+            totals[ 'profile' ] = f'{self.file_name(totals["section"])}.tasks.prof'
+            stats.dump_stats( os.path.join( self.directory, totals[ 'profile' ] ) )
+
+      summary = {
+         'profiler': self.profiler,
+         'trace_memory': self.trace_memory,
+         'seconds': round(time.monotonic() - self.started, 3),
+         'traced_memory_peak': peak,
+         'threads_max': max( [ threads for _, threads, _, _ in self.timeline ] + [ active_count() ] ),
+         'sections': sections,
+         'tasks': tasks
+      }
+      with open( os.path.join( self.directory, 'summary.json' ), 'w' ) as f:
+         json.dump( summary, f, indent=1 )
+
+      columns = [ ( 'wall_seconds', 'wall s' ), ( 'thread_cpu_seconds', 'thread cpu s' ), ( 'process_cpu_seconds', 'process cpu s' ), ( 'threads_start', 'threads' ), ( 'threads_max', 'max threads' ) ]
+      if self.trace_memory:
+         columns += [ ( 'memory_start', 'mem start MB' ), ( 'memory_end', 'mem end MB' ), ( 'memory_peak', 'mem peak MB' ) ]
+      width = max( [ len(record[ 'section' ]) for record in sections + tasks ] + [ 7 ] )
+      task_columns = [ ( 'tasks', 'tasks' ), ( 'threads', 'pool threads' ), ( 'wall_seconds', 'wall s' ), ( 'thread_cpu_seconds', 'thread cpu s' ) ]
+      with open( os.path.join( self.directory, 'summary.txt' ), 'w' ) as f:
+         f.write( f'{"section":<{width}} ' + ' '.join( f'{title:>13}' for _, title in columns ) + '\n' )
+         for record in sections:
+            cells = [ f'{record.get(column, 0) / 1024 / 1024:.1f}' if column.startswith('memory') else f'{record.get(column, "")}' for column, _ in columns ]
+            f.write( f'{record["section"]:<{width}} ' + ' '.join( f'{cell:>13}' for cell in cells ) + '\n' )
+         if tasks:
+            f.write( f'\n{"tasks of":<{width}} ' + ' '.join( f'{title:>13}' for _, title in task_columns ) + '\n' )
+            for totals in tasks:
+               f.write( f'{totals["section"]:<{width}} ' + ' '.join( f'{totals[column]:>13}' for column, _ in task_columns ) + '\n' )
+         f.write( f'\n{summary["seconds"]}s, at most {summary["threads_max"]} threads' )
+         f.write( f', traced memory peak {peak / 1024 / 1024:.1f} MB\n' if self.trace_memory else ' (memory not traced - see --trace-memory)\n' )
+
+      logger.info(f'Profile of {len(sections)} sections written to {self.directory}')
+
+class ProfilerScope(object):
+   def __init__(self, profiler, prefix):
+      self.profiler = profiler
+      self.prefix = prefix
+
+   def section(self, name):
+      return self.profiler.section( f'{self.prefix}/{name}' )
+
+   def wrap(self, name, fn):
+      return self.profiler.wrap( f'{self.prefix}/{name}', fn )
+
+   def wrap_task(self, name, fn):
+      return self.profiler.wrap_task( f'{self.prefix}/{name}', fn )
+
+### Dependency-aware pipeline ###
+##################################
+# A small DAG of named stages. A stage starts as soon as the stages it
+# depends on are done and gets their results as arguments, so independent
+# collectors and uploads overlap and wall time is roughly the longest
+# chain instead of the sum of all stages. Stages must be added after
+# their dependencies.
+class Pipeline(object):
+   def __init__(self, profiler=None):
+      self.stages = OrderedDict()
+      self.durations = OrderedDict()
+      self.profiler = profiler
+
+   def add(self, name, fn, *depends_on):
+      self.stages[name] = (fn, depends_on)
+
+   ### run every stage, raise the first failure once all are done ###
+   ##################################################################
+   def run(self):
+      # one thread per stage - stages wait on each other, never on a pool slot
+      executor = ThreadPoolExecutor(max_workers=len(self.stages), thread_name_prefix='oci-stage')
+      futures = OrderedDict()
+
+      for name, (fn, depends_on) in self.stages.items():
+         futures[name] = executor.submit( self.run_stage, name, fn, [futures[d] for d in depends_on] )
+
+      executor.shutdown(wait=True)
+
+      failed = [name for name, future in futures.items() if future.exception() is not None]
+      for name in failed:
+         err = futures[name].exception()
+         logger.error(f'Pipeline stage {name} failed.')
+         logger.exception(format_exception(type(err), err, err.__traceback__))
+
+      if failed:
+         raise futures[failed[0]].exception()
+
+      return {name: future.result() for name, future in futures.items()}
+
+   def run_stage(self, name, fn, depends_on):
+      args = [future.result() for future in depends_on]
+
+      call_context.collector = name
+      start_time = time.time()
+      try:
+         with self.profiler.section(name) if self.profiler else nullcontext():
+            return fn(*args)
+      finally:
+         self.durations[name] = time.time() - start_time
+
+   ### log the duration of every stage ###
+   #######################################
+   def report(self):
+      logger.info(" --- Pipeline stages --- ")
+      for name, seconds in self.durations.items():
+         logger.info(f'{name}: {seconds:.2f}s')
+
+### Upload stage ###
+####################
+# Runs every collector's create_csv on a bounded pool as soon as the
+# collector is done, so serialising and uploading overlap with the
+# collectors still running. Keeps the duration and size of every table
+# for the summary at the end of the run.
+class UploadStage(object):
+   def __init__(self, uploader, max_workers=4, output=None, profiler=None):
+      self.uploader = uploader
+      self.output = output or OutputFormat()
+      self.profiler = profiler
+      self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='oci-upload')
+      self.lock = Lock()
+      self.jobs = []
+      self.tables = OrderedDict()
+
+   ### queue the tables of a finished collector ###
+   ################################################
+   def submit(self, collector):
+      create_csv = collector.create_csv
+      if self.profiler:
+         create_csv = self.profiler.wrap( f'{type(collector).__name__.lower()}.create_csv', create_csv )
+
+      job = self.executor.submit( bind_collector(create_csv) )
+      self.jobs.append( job )
+      return job
+
+   ### queue the tables and wait until they are uploaded ###
+   #########################################################
+   def upload(self, collector):
+      return self.submit(collector).result()
+
+   ### upload one table to Object Storage ###
+   ###########################################
+   def write_file(self, body, filename, extension='csv', content_type='text/csv', compress=True):
+      try:
+         with self.profiler.section(f'write_file.{filename}') if self.profiler else nullcontext():
+            return self.uploader.put( filename, body, extension, content_type, compress )
+      except Exception as err:
+         logger.error( f'Failed to upload file : {filename}_{self.uploader.report_no}')
+         logger.error(err)
+         raise
+
+   ### called for every uploaded table ###
+   #######################################
+   def record(self, filename, seconds):
+      with self.lock:
+         self.tables[filename] = seconds
+
+   def wait(self):
+      for job in self.jobs:
+         try:
+            job.result()
+         except Exception as err:
+            logger.error("Failed to write collector tables.")
+            logger.exception(format_exception(type(err), err, err.__traceback__))
+
+      self.executor.shutdown(wait=True)
+
+   ### log writes, size and duration for every table ###
+   #####################################################
+   def report(self):
+      uploader = self.uploader
+      logger.info(" --- Uploaded tables --- ")
+      for filename, stats in uploader.tables.items():
+         logger.info(f'{filename}: {stats["writes"]} write(s), {stats["bytes"]} bytes ({stats["raw_bytes"]} raw) in {self.tables.get(filename, 0):.2f}s')
+
+      logger.info(f'Total: {len(uploader.tables)} tables, {sum(stats["bytes"] for stats in uploader.tables.values())} bytes ({sum(stats["raw_bytes"] for stats in uploader.tables.values())} raw)')
+
+### Shared keep-alive sessions ###
+###################################
+# One HTTP session per (client class, region), each with a connection pool
+# sized to the scheduler's concurrency. Batch runs hand the same pool to
+# every tenancy so they reuse the connections to each service endpoint.
+class SessionPool(object):
+   def __init__(self, pool_size=10):
+      self.pool_size = pool_size
+      self.lock = Lock()
+      self.sessions = {}
+
+   def get(self, client_class, region):
+      key = (client_class, region)
+
+      with self.lock:
+         session = self.sessions.get(key)
+         if session is None:
+            session = oci._vendor.requests.Session()
+            session.mount( 'https://', oci.base_client.OCIHTTPAdapter( pool_connections=1, pool_maxsize=self.pool_size ) )
+            session.hooks[ 'response' ].append( count_response )
+            self.sessions[key] = session
+
+      return session
+
+   def close(self):
+      with self.lock:
+         for session in self.sessions.values():
+            session.close()
+         self.sessions = {}
+
+### Per-region client pool ###
+###############################
+# One client per (client class, region), created on first use and shared by
+# every collector. Clients get their region from their own config instead
+# of the shared signer.region being switched between regions while other
+# threads are still using it, and send their calls through the shared
+# keep-alive sessions.
+class ClientPool(object):
+   def __init__(self, config, signer, sessions, rate_limits=None, stats=None):
+      self.config = config
+      self.signer = signer
+      self.sessions = sessions
+      self.rate_limits = rate_limits
+      self.stats = stats or CallStats()
+      self.lock = Lock()
+      self.clients = {}
+      self.limiters = {}
+
+   ### return the shared client for a region - home region by default ###
+   ######################################################################
+   def get(self, client_class, region=None):
+      region = region or self.config[ 'region' ]
+      key = (client_class, region)
+
+      with self.lock:
+         client = self.clients.get(key)
+         if client is None:
+            client = self.create( client_class, region )
+            client.base_client.session.close()
+            client.base_client.session = self.sessions.get( client_class, region )
+            service = self.service_name(client_class)
+            client = ThrottledClient( client, self.limiter(service, region), self.stats, service, region )
+            self.clients[key] = client
+
+      return client
+
+   ### a new SDK client of a region ###
+   ######################################
+   # endpoint_template (optional config key) sends every service to one
+   # host instead of the public endpoints, e.g. http://127.0.0.1:8000/{region}
+   # for the benchmark stand-in server - {region} and {service} are filled in.
+   def create(self, client_class, region):
+      kwargs = {}
+      template = self.config.get('endpoint_template')
+      if template:
+         kwargs[ 'service_endpoint' ] = template.format( region=region, service=self.service_name(client_class) )
+
+      return client_class( dict(self.config, region=region), signer=self.signer, **kwargs )
+
+   ### ComputeClient -> compute ###
+   ################################
+   @staticmethod
+   def service_name(client_class):
+      name = client_class.__name__
+      return (name[:-len('Client')] if name.endswith('Client') else name).lower()
+
+   ### one adaptive limiter per region and service, shared by its clients ###
+   ##########################################################################
+   def limiter(self, service, region):
+      if self.rate_limits is None:
+         return None
+
+      key = (region, service)
+      if key not in self.limiters:
+         self.limiters[key] = AdaptiveRateLimiter( **self.rate_limits )
+
+      return self.limiters[key]
+
+   def limiter_summary(self):
+      return [
+         { 'region': region, 'service': service, 'calls': limiter.calls, 'throttles': limiter.throttles,
+           'lowest_rate': None if limiter.lowest is None else round(limiter.lowest, 2),
+           'rate': None if limiter.rate is None else round(limiter.rate, 2) }
+         for (region, service), limiter in sorted(self.limiters.items())
+      ]
+
+   def report(self):
+      for (region, service), limiter in sorted(self.limiters.items()):
+         if limiter.throttles:
+            logger.info(f'Rate limit {region} {service}: {limiter.calls} calls, {limiter.throttles} throttled, rate {limiter.lowest:.1f}-{limiter.rate:.1f}/s')
+
+   ### sessions belong to the SessionPool - only drop the clients ###
+   ##################################################################
+   def close(self):
+      with self.lock:
+         self.clients = {}
+
+### Disk cache ###
+##################
+# Small JSON documents kept between runs in cache_dir, stamped with the
+# time they were written. Without a cache_dir nothing is cached. The cache
+# is only an optimisation, so failing to write it is logged and ignored.
+class DiskCache(object):
+   def __init__(self, directory):
+      self.directory = os.path.expanduser(directory) if directory else None
+      if self.directory:
+         os.makedirs( self.directory, exist_ok=True )
+
+   def path(self, name):
+      return os.path.join( self.directory, f'{name}.json' )
+
+   ### the cached data - None if missing or older than max_age seconds ###
+   #######################################################################
+   def get(self, name, max_age):
+      if not self.directory:
+         return None
+
+      try:
+         with open( self.path(name) ) as cache_file:
+            entry = json.load(cache_file)
+      except (OSError, ValueError):
+         return None
+
+      if time.time() - entry['time'] > max_age:
+         return None
+
+      return entry['data']
+
+   def put(self, name, data):
+      if not self.directory:
+         return
+
+      # write aside and rename, so readers never see half a file
+      temp_path = f'{self.path(name)}.{os.getpid()}.tmp'
+      try:
+         with open( temp_path, 'w' ) as cache_file:
+            json.dump( { 'time': time.time(), 'data': data }, cache_file )
+         os.replace( temp_path, self.path(name) )
+      except OSError as err:
+         logger.warning( f'Failed to write cache {name}: {err}' )
+
+### Resource Search index ###
+#############################
+# One structured Resource Search query per region for the resource types
+# the collectors care about, grouped by compartment. A type Search can't
+# query in a region fails the whole query there (400), so the region is
+# then queried type by type and the types that still fail are unknown in
+# it. A region whose query failed otherwise is left out. Callers fall back
+# to listing whatever is unknown - both are logged as warnings.
+#
+# With inventory_engine = search (or prefilter = true, which may use a
+# cached index) the index is also the collectors' plan: a listing only
+# runs for the compartments (and ADs) where Search shows a resource of its
+# type, and the list call then hydrates the full records for the CSV.
+# Without a plan - or without an index, see unplanned() - every listing
+# runs.
+#
+# Which (compartment, type, AD) combinations hold anything is also kept in
+# the disk cache; with max_age set a fresh enough copy is used instead of
+# querying again. A cached index has no fingerprints.
+class SearchIndex(object):
+   def __init__(self, oci_service, resource_types, max_age, tenancy):
+      scheduler = oci_service.scheduler
+      self.plan = oci_service.plan_with_search
+      self.resource_types = sorted(set(resource_types))
+      self.regions = {}
+      self.activity = {}
+      self.unknown = {}
+      region_names = sorted( region.region_name for region in tenancy.regions )
+      cache_name = f'search_index_{tenancy.tenancy_id}'
+      jobs = []
+
+      cached = oci_service.cache.get( cache_name, max_age ) if max_age else None
+      if cached is not None and cached['resource_types'] == self.resource_types and sorted(cached['activity']) == region_names:
+         self.activity = { region_name: { compartment_id: { t: set(ads) for t, ads in types.items() } for compartment_id, types in compartments.items() } for region_name, compartments in cached['activity'].items() }
+         self.unknown = { region_name: set(types) for region_name, types in cached.get('unknown', {}).items() }
+         logger.info("Search Index - from cache.")
+         return
+
+      for region in tenancy.regions:
+         search_client = oci_service.clients.get( oci.resource_search.ResourceSearchClient, region.region_name )
+         jobs.append( scheduler.submit(self.get_info, search_client, region, region=region.region_name, service='search') )
+
+      scheduler.gather(jobs)
+
+      missing = [ region_name for region_name in region_names if region_name not in self.activity ]
+      if missing:
+         logger.warning(f'Search Index - no index of {", ".join(missing)}, every compartment there is listed.')
+
+      # only cache a complete index
+      if not missing:
+         oci_service.cache.put( cache_name, {
+            'resource_types': self.resource_types,
+            'activity': { region_name: { compartment_id: { t: list(ads) for t, ads in types.items() } for compartment_id, types in compartments.items() } for region_name, compartments in self.activity.items() },
+            'unknown': { region_name: sorted(types) for region_name, types in self.unknown.items() }
+         } )
+
+      logger.info("Search Index - DONE.")
+
+   ### the index of a run without Search - no plan, no fingerprints ###
+   ######################################################################
+   @classmethod
+   def unplanned(cls):
+      index = cls.__new__(cls)
+      index.plan = False
+      index.resource_types = []
+      index.regions = {}
+      index.activity = {}
+      index.unknown = {}
+      return index
+
+   ### thread function - all matching resources of a region ###
+   ############################################################
+   def get_info(self, search_client, region):
+      unknown = []
+      try:
+         resources = self.search( search_client, self.resource_types )
+      except oci.exceptions.ServiceError as err:
+         if err.status != 400:
+            raise
+
+         # e.g. AutonomousExadataInfrastructure where Search doesn't index it
+         resources = []
+         for resource_type in self.resource_types:
+            try:
+               resources += self.search( search_client, [ resource_type ] )
+            except oci.exceptions.ServiceError as type_err:
+               if type_err.status != 400:
+                  raise
+               unknown.append( resource_type )
+
+         logger.warning(f'Search Index - the query failed in {region.region_name} ({err.code}), queried type by type. Listing every compartment for: {", ".join(unknown) or "none"}.')
+
+      compartments = {}
+      activity = {}
+      for resource in resources:
+         compartments.setdefault( resource.compartment_id, [] ).append( resource )
+         activity.setdefault( resource.compartment_id, {} ).setdefault( resource.resource_type.lower(), set() ).add( resource.availability_domain )
+
+      self.regions[region.region_name] = compartments
+      self.activity[region.region_name] = activity
+      self.unknown[region.region_name] = { t.lower() for t in unknown }
+
+   def search(self, search_client, resource_types):
+      details = oci.resource_search.models.StructuredSearchDetails( type='Structured', matching_context_type='NONE', query=f'query {", ".join(resource_types)} resources' )
+      return list( paginate( search_client.search_resources, details, limit=1000, retry_strategy=retry_strategy_via_constructor ) )
+
+   ### hash of what Search shows for a compartment - None if unknown ###
+   #####################################################################
+   def fingerprint(self, region_name, compartment_id, resource_types):
+      compartments = self.regions.get(region_name)
+      types = { t.lower() for t in resource_types }
+      if compartments is None or types & self.unknown[region_name]:
+         return None
+
+      resources = sorted(
+         [ r.identifier, r.resource_type, r.display_name, r.lifecycle_state, str(r.time_created), json.dumps( [r.freeform_tags, r.defined_tags], sort_keys=True, default=str ) ]
+         for r in compartments.get(compartment_id, []) if r.resource_type.lower() in types
+      )
+      return hashlib.sha256( json.dumps(resources).encode('utf-8') ).hexdigest()
+
+   ### should a listing of these types run here - True if unknown ###
+   ##################################################################
+   def wanted(self, region_name, compartment_id, resource_types, availability_domain=None):
+      compartments = self.activity.get(region_name)
+      if not self.plan or compartments is None:
+         return True
+
+      # a resource without an AD in Search could be in any of them
+      unknown = self.unknown.get( region_name, set() )
+      types = compartments.get( compartment_id, {} )
+      for resource_type in resource_types:
+         ads = types.get( resource_type.lower() )
+         if resource_type.lower() in unknown or ads and ( availability_domain is None or None in ads or availability_domain in ads ):
+            return True
+
+      return False
+
+### Incremental state store ###
+################################
+# Keeps what the last run listed for every (collector, region, compartment)
+# in a local SQLite file, with the compartment's Search fingerprint. While
+# the fingerprint is unchanged the records are replayed from the store
+# instead of listed again, so the tables are still full snapshots. Every
+# compartment is listed again after max_age_hours anyway, to pick up the
+# changes Search doesn't show (e.g. attaching an existing volume).
+#
+# Records are stored as the API's JSON with their model name and rebuilt
+# by the listing's client, like a response. A file of another version
+# (0 pickled the SDK models) starts empty.
+class StateStore(object):
+   version = 1
+
+   def __init__(self, path, tenancy_id, max_age_hours=168):
+      self.path = path
+      self.tenancy_id = tenancy_id
+      self.max_age = max_age_hours * 3600
+      self.enabled = path is not None
+      self.lock = Lock()
+      self.reused = 0
+      self.listed = 0
+
+      if self.enabled:
+         self.db = sqlite3.connect( os.path.expanduser(path), timeout=60, check_same_thread=False )
+         with self.db:
+            if self.db.execute( 'PRAGMA user_version' ).fetchone()[0] != self.version:
+               self.db.execute( 'DROP TABLE IF EXISTS snapshot' )
+               self.db.execute( 'DROP TABLE IF EXISTS record' )
+            self.db.execute( f'PRAGMA user_version = {self.version}' )
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS snapshot (tenancy_id TEXT, collector TEXT, region_name TEXT, compartment_id TEXT, fingerprint TEXT, sdk_version TEXT, time_listed REAL, PRIMARY KEY (tenancy_id, collector, region_name, compartment_id))' )
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS record (tenancy_id TEXT, collector TEXT, region_name TEXT, compartment_id TEXT, name TEXT, id TEXT, lifecycle_state TEXT, time_created TEXT, hash TEXT, model TEXT, data BLOB)' )
+            self.db.execute( 'CREATE INDEX IF NOT EXISTS record_key ON record (tenancy_id, collector, region_name, compartment_id)' )
+
+   ### run a collector task unless its compartment is unchanged ###
+   ################################################################
+   def run(self, collector, search_index, client, region_name, compartment_id, get_info, *args):
+      if not self.enabled:
+         return get_info(*args)
+
+      key = ( self.tenancy_id, type(collector).__name__, region_name, compartment_id )
+      fingerprint = search_index.fingerprint( region_name, compartment_id, collector.search_types )
+
+      if fingerprint is not None and self.unchanged(key, fingerprint):
+         for name, records in self.load(key, client).items():
+            collector.results.extend( name, records )
+         with self.lock:
+            self.reused += 1
+         return
+
+      mark = collector.results.mark()
+      get_info(*args)
+      if fingerprint is not None:
+         self.save( key, fingerprint, client, collector.results.since(mark) )
+      with self.lock:
+         self.listed += 1
+
+   def unchanged(self, key, fingerprint):
+      with self.lock:
+         row = self.db.execute( 'SELECT fingerprint, sdk_version, time_listed FROM snapshot WHERE tenancy_id=? AND collector=? AND region_name=? AND compartment_id=?', key ).fetchone()
+
+      return row is not None and row[0] == fingerprint and row[1] == oci.__version__ and time.time() - row[2] < self.max_age
+
+   ### stored records by result name, in listing order ###
+   #######################################################
+   def load(self, key, client):
+      records = {}
+      with self.lock:
+         rows = self.db.execute( 'SELECT name, model, data FROM record WHERE tenancy_id=? AND collector=? AND region_name=? AND compartment_id=? ORDER BY rowid', key ).fetchall()
+
+      for name, model, data in rows:
+         records.setdefault( name, [] ).append( client.base_client.deserialize_response_data( data, model ) )
+
+      return records
 
+   def save(self, key, fingerprint, client, results):
+      rows = []
+      for name, records in results.items():
+         for record in records:
+            data = json.dumps( client.base_client.sanitize_for_serialization(record) ).encode('utf-8')
+            rows.append( key + ( name, getattr(record, 'id', None), getattr(record, 'lifecycle_state', None), str(getattr(record, 'time_created', None)), hashlib.sha256(data).hexdigest(), type(record).__name__, data ) )
+
+      with self.lock, self.db:
+         self.db.execute( 'DELETE FROM record WHERE tenancy_id=? AND collector=? AND region_name=? AND compartment_id=?', key )
+         self.db.executemany( 'INSERT INTO record VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows )
+         self.db.execute( 'INSERT OR REPLACE INTO snapshot VALUES (?, ?, ?, ?, ?, ?, ?)', key + ( fingerprint, oci.__version__, time.time() ) )
+
+   def report(self):
+      if self.enabled:
+         logger.info(f'Incremental: {self.reused} compartment listings reused from {self.path}, {self.listed} listed')
+
+   def close(self):
+      if self.enabled:
+         self.db.close()
+
+
+### Default config file - every profile has its own par ###
+############################################################
+CONFIG_FILE = "/.oci/config"
 
 class OCIService(object):
-   def __init__(self, authentication):
-      global report_no
-      global par_url
-      
+   def __init__(self, authentication, profile="DEFAULT", scheduler=None, sessions=None, engine=None, profiler=None):
+      self.profile = profile
+      self.profiler = profiler
+
       # source the config file
-      self.config = oci.config.from_file( "/.oci/config", "DEFAULT")
-      par_url = self.config[ 'par' ]   
+      self.config = oci.config.from_file( CONFIG_FILE, profile )
+      self.par_url = self.config[ 'par' ]
 
       # if intance pricipals - generate signer from token or config
       if( authentication == 'CONFIG' ):
@@ -111,56 +1522,179 @@ class OCIService(object):
       else:
          logger.info("Generate Auth signer from instance principal.")
          self.generate_signer_from_instance_principals()
-      
+
+      # batch runs pass in the scheduler and sessions all tenancies share
+      self.owns_pools = scheduler is None
+      if self.owns_pools:
+         scheduler = Scheduler(
+            max_workers=int(self.config.get('max_workers', 32)),
+            region_workers=int(self.config.get('region_workers', 16)),
+            service_workers=int(self.config.get('service_workers', 8))
+         )
+         # one connection per concurrent call to a service endpoint
+         sessions = SessionPool( pool_size=scheduler.service_workers + scheduler.prefetch_workers )
+
+      self.scheduler = TenantScheduler( scheduler, self.config[ 'tenancy' ], profiler )
+      self.sessions = sessions
+
+      # every OCI call goes through an adaptive rate limiter per region and
+      # service - open until the first 429 unless rate_limit_initial is set
+      rate_limits = None
+      if str(self.config.get('rate_limit', 'true')).lower() == 'true':
+         rate_limits = dict(
+            rate=float(self.config[ 'rate_limit_initial' ]) if 'rate_limit_initial' in self.config else None,
+            minimum=float(self.config.get('rate_limit_min', 1)),
+            maximum=float(self.config.get('rate_limit_max', 100))
+         )
+      self.stats = CallStats()
+      self.clients = ClientPool( self.config, self.signer, sessions, rate_limits, self.stats )
+
       # time var for report number
       timetup = time.gmtime()
-      report_no = time.strftime('%Y-%m-%dT%H:%M:%SZ', timetup).replace( ':', '-')
+      self.report_no = time.strftime('%Y-%m-%dT%H:%M:%SZ', timetup).replace( ':', '-')
+
+      # optional gzip/zstd compression of the uploads
+      compressor = None
+      if self.config.get('upload_compression', 'none') != 'none':
+         level = self.config.get('upload_compression_level')
+         compressor = Compressor( self.config['upload_compression'], int(level) if level is not None else None )
+
+      # pooled, retrying uploader for the PAR - large tables go multipart
+      self.uploader = Uploader(
+         self.par_url,
+         self.report_no,
+         pool_size=int(self.config.get('upload_workers', 4)),
+         multipart_threshold=int(self.config.get('multipart_threshold_mb', 128)) * 1024 * 1024,
+         part_size=int(self.config.get('multipart_part_mb', 32)) * 1024 * 1024,
+         part_workers=int(self.config.get('multipart_workers', 4)),
+         compressor=compressor,
+         stats=self.stats
+      )
+
+      # tables are serialised and uploaded on their own bounded pool
+      output = OutputFormat( self.config.get('output_format', 'csv'), compression=self.config.get('output_compression') )
+      self.uploads = UploadStage( self.uploader, max_workers=int(self.config.get('upload_workers', 4)), output=output, profiler=profiler )
+
+      # list (per compartment) or search (Resource Search plans the listings)
+      self.engine = self.config.get('inventory_engine', 'list')
+
+      # the list engine can still skip what a (cached) Search index shows empty
+      self.prefilter = str(self.config.get('prefilter', 'false')).lower() == 'true'
+      self.plan_with_search = self.engine == 'search' or self.prefilter
+      self.cache = DiskCache( self.config.get('cache_dir') )
+      self.search_index_ttl = float(self.config.get('search_index_ttl_hours', 12)) * 3600
+
+      # incremental mode - only when the config names a state file
+      self.state = StateStore( self.config.get('state_file'), self.config[ 'tenancy' ], max_age_hours=float(self.config.get('state_max_age_hours', 168)) )
+
+      # threads (scheduler) or async (oci_async, one event loop) collectors
+      self.collection_engine = engine or self.config.get('collection_engine', 'threads')
+      if self.collection_engine not in ( 'threads', 'async' ):
+         raise ValueError(f'collection_engine must be threads or async, not {self.collection_engine}')
+      if self.collection_engine == 'async' and ( self.plan_with_search or self.state.enabled ):
+         raise ValueError('the async engine lists every compartment - it does not support inventory_engine=search, prefilter or state_file')
 
    def extract_data(self):
       logger.info("Data Extract & Data Upload processes initated. Please wait...")
       
       logger.debug("Initiate Data Extract objects...")
-      tenancy = Tenancy(self.config, self.signer)
-      announcement = Announcement(self.config, self.signer)
-      limit = Limit( self.config, tenancy, self.signer )
-      compute = Compute( self.config, tenancy, self.signer)
-      block_storage = BlockStorage(self.config, tenancy, self.signer)    
-      db_system = DBSystem( self.config, tenancy, self.signer )
-      monitoring = Monitoring( self.config, tenancy, self.signer )  
-      images = Images( self.config, tenancy, self.signer)
-      logger.info("Data extraction finished.")
-      
-      # Create threads for "create_csv" methods 
-      thread1 = Thread(target = tenancy.create_csv)
-      thread2 = Thread(target = announcement.create_csv(self.config))
-      thread3 = Thread(target = limit.create_csv(self.config))
-      thread4 = Thread(target = compute.create_csv)
-      thread5 = Thread(target = block_storage.create_csv)
-      thread6 = Thread(target = db_system.create_csv(self.config))
-      thread7 = Thread(target = monitoring.create_csv(self.config))
-      thread8 = Thread(target = images.create_csv)
-      
-      logger.debug("Starting to write data to Object storage...")
-      thread1.start()
-      thread2.start()
-      thread3.start()
-      thread4.start()
-      thread5.start()
-      thread6.start()
-      thread7.start()
-      thread8.start()
-      thread1.join()
-      thread2.join()
-      thread3.join()
-      thread4.join()
-      thread5.join()
-      thread6.join()
-      thread7.join()
-      thread8.join()
-      
+      # only Tenancy is a real dependency - everything else runs side by
+      # side and each collector's tables upload as soon as it is done
+      pipeline = Pipeline( self.profiler )
+      pipeline.add( 'tenancy', partial(Tenancy, self) )
+      pipeline.add( 'announcement', partial(Announcement, self) )
+
+      if self.collection_engine == 'async':
+         # only imported when used - the async engine needs aiohttp
+         import oci_async
+         pipeline.add( 'collectors', oci_async.AsyncEngine(self, pipeline).run, 'tenancy' )
+         for collector in ( 'tenancy', 'announcement' ):
+            pipeline.add( f'{collector}_upload', self.uploads.upload, collector )
+      else:
+         self.add_collectors( pipeline )
+
+      started = time.time()
+      succeeded = False
+      try:
+         pipeline.run()
+         succeeded = True
+         logger.info("Data extraction finished.")
+      finally:
+         self.uploads.wait()
+         self.uploads.report()
+         self.state.report()
+         self.clients.report()
+         self.stats.report()
+         pipeline.report()
+         self.write_run_report( pipeline, started, succeeded )
+
+         if self.owns_pools:
+            self.scheduler.shutdown()
+            self.sessions.close()
+         self.clients.close()
+         self.uploader.close()
+         self.state.close()
+
       logger.info("Data upload to Object Storage finished.")
       logger.info("### END ###")
 
+   ### the threaded collectors - each on its own pipeline stage ###
+   ################################################################
+   def add_collectors(self, pipeline):
+      pipeline.add( 'limit', partial(Limit, self), 'tenancy' )
+
+      # the search engine, the prefilter and incremental runs query Resource
+      # Search first - only the prefilter can make do with a cached index
+      inventory = [ 'tenancy' ]
+      if self.plan_with_search or self.state.enabled:
+         max_age = self.search_index_ttl if self.engine != 'search' and not self.state.enabled else 0
+         pipeline.add( 'search_index', partial(SearchIndex, self, Compute.search_types + BlockStorage.search_types + DBSystem.search_types + Images.search_types, max_age), 'tenancy' )
+         inventory.append( 'search_index' )
+
+      pipeline.add( 'compute', partial(Compute, self), *inventory )
+      pipeline.add( 'block_storage', partial(BlockStorage, self), *inventory )
+      pipeline.add( 'db_system', partial(DBSystem, self), *inventory )
+      pipeline.add( 'monitoring', partial(Monitoring, self), 'tenancy' )
+      pipeline.add( 'images', partial(Images, self), *inventory )
+
+      for collector in [ name for name in pipeline.stages if name != 'search_index' ]:
+         pipeline.add( f'{collector}_upload', self.uploads.upload, collector )
+
+   ### Machine-readable run report ###
+   ###################################
+   # Stage durations, every OCI call and upload request, the uploaded tables
+   # and the rate limiters as JSON - written to run_report_file and/or
+   # uploaded next to the tables when run_report_upload is true.
+   def write_run_report(self, pipeline, started, succeeded):
+      path = self.config.get('run_report_file')
+      upload = str(self.config.get('run_report_upload', 'false')).lower() == 'true'
+      if not path and not upload:
+         return
+
+      report = {
+         'tenancy': self.config[ 'tenancy' ],
+         'report_no': self.report_no,
+         'started': datetime.datetime.fromtimestamp(started, datetime.timezone.utc).isoformat(),
+         'seconds': round(time.time() - started, 3),
+         'succeeded': succeeded,
+         'oci_sdk': oci.__version__,
+         'stages': { name: round(seconds, 3) for name, seconds in pipeline.durations.items() },
+         'calls': self.stats.summary(),
+         'tables': [ dict(stats, table=filename, seconds=round(self.uploads.tables.get(filename, 0), 3)) for filename, stats in self.uploader.tables.items() ],
+         'rate_limits': self.clients.limiter_summary()
+      }
+      body = json.dumps(report, indent=1).encode('utf-8')
+
+      try:
+         if path:
+            with open(path.format(tenancy=self.config[ 'tenancy' ], report_no=self.report_no), 'wb') as f:
+               f.write(body)
+         if upload:
+            self.uploader.put( 'run_report', io.BytesIO(body), 'json', 'application/json' )
+      except Exception as err:
+         # the report must never fail the extract
+         logger.error(f'Failed to write the run report: {err}')
+
    ### Generate Signer from config ###
    ###################################
    def generate_signer_from_config(self):
@@ -188,56 +1722,197 @@ class OCIService(object):
          logger.error("")
          raise SystemExit
 
-      # generate config info from signer
-      self.config = {'region': self.signer.region, 'tenancy': self.signer.tenancy_id}
+      # generate config info from signer - keep the optional settings
+      self.config = dict(self.config, region=self.signer.region, tenancy=self.signer.tenancy_id)
+
+### Batch mode - many tenancies in one process ###
+##################################################
+# Extracts several tenancies side by side. Each entry is a profile of the
+# config file or a tenancy OCID (the profile holding that tenancy is used).
+# All tenancies share one scheduler - served round-robin per tenancy - and
+# one keep-alive session per service endpoint; the limits come from the
+# first profile that loads. Each tenancy's service is built in its own task,
+# so a missing profile, bad key or unreachable tenancy only fails that one.
+class BatchService(object):
+   def __init__(self, authentication, targets, engine=None, profiler=None):
+      self.authentication = authentication
+      self.engine = engine
+      self.profiler = profiler
+      self.services = OrderedDict()
+      self.durations = OrderedDict()
+      self.errors = OrderedDict()
+
+      self.profiles = []
+      for target in targets:
+         try:
+            self.profiles.append( self.resolve_profile(target) )
+         except Exception as err:
+            logger.error(f'Batch target {target} skipped: {err}')
+            self.errors[target] = err
+
+      config = self.scheduler_config()
+      self.scheduler = Scheduler(
+         max_workers=int(config.get('max_workers', 32)),
+         region_workers=int(config.get('region_workers', 16)),
+         service_workers=int(config.get('service_workers', 8))
+      )
+      # every tenancy may have service_workers calls open to the same endpoint
+      self.sessions = SessionPool( pool_size=min(self.scheduler.max_workers, self.scheduler.service_workers * max(1, len(self.profiles))) + self.scheduler.prefetch_workers )
+
+   ### the scheduler settings - from the first profile that loads ###
+   ##################################################################
+   def scheduler_config(self):
+      for profile in self.profiles:
+         try:
+            return oci.config.from_file( CONFIG_FILE, profile )
+         except Exception as err:
+            logger.error(f'Failed to load profile {profile}: {err}')
+      return {}
+
+   ### map a tenancy OCID to the config profile that holds it ###
+   ##############################################################
+   @staticmethod
+   def resolve_profile(target):
+      if not target.startswith('ocid1.tenancy.'):
+         return target
+
+      parser = configparser.ConfigParser(interpolation=None)
+      parser.read( os.path.expanduser(CONFIG_FILE) )
+      for profile in [ 'DEFAULT' ] + parser.sections():
+         if parser[profile].get('tenancy') == target:
+            return profile
+
+      raise ValueError(f'No profile in {CONFIG_FILE} for tenancy {target}')
+
+   def extract_data(self):
+      logger.info(f'Batch extract of {len(self.profiles)} tenancies initiated.')
+      start_time = time.time()
+
+      executor = ThreadPoolExecutor(max_workers=max(1, len(self.profiles)), thread_name_prefix='oci-tenancy')
+      for profile in self.profiles:
+         executor.submit( self.run_service, profile )
+      executor.shutdown(wait=True)
+
+      self.scheduler.shutdown()
+      self.sessions.close()
+
+      self.report( time.time() - start_time )
+      if self.errors:
+         raise next(iter(self.errors.values()))
+
+   def run_service(self, profile):
+      start_time = time.time()
+      try:
+         # sections of every tenancy are named <profile>/<section>
+         service = self.services[profile] = OCIService( self.authentication, profile, scheduler=self.scheduler, sessions=self.sessions, engine=self.engine, profiler=self.profiler.scope(profile) if self.profiler else None )
+         service.extract_data()
+      except Exception as err:
+         logger.error(f'Extract of profile {profile} failed.')
+         logger.exception(format_exception(type(err), err, err.__traceback__))
+         self.errors[profile] = err
+      finally:
+         self.durations[profile] = time.time() - start_time
+
+   ### log wall time and status for every tenancy ###
+   ##################################################
+   def report(self, seconds):
+      logger.info(" --- Batch tenancies --- ")
+      targets = list(self.profiles) + [ target for target in self.errors if target not in self.profiles ]
+      for target in targets:
+         status = 'FAILED' if target in self.errors else 'OK'
+         service = self.services.get(target)
+         tenancy = service.config[ 'tenancy' ] if service is not None else 'not loaded'
+         logger.info(f'{target} ({tenancy}): {status} in {self.durations.get(target, 0):.2f}s')
+
+      logger.info(f'Total: {len(targets)} tenancies, {len(self.errors)} failed, {seconds:.2f}s')
 
 class Tenancy(object):
-   logger.info("Initiate Tennancy object...")
-   
    tenancy_id = None
    name = None
    description = None
    home_region = None
-
-   compartments = []
    regions = None
-   availability_domains = []
-   limit_summary = []
 
-   def __init__(self, config, signer):
-      self.tenancy_id = config["tenancy"]
+   def __init__(self, oci_service):
+      self.uploads = oci_service.uploads
+      self.report_no = oci_service.report_no
+      self.tenancy_id = oci_service.config["tenancy"]
+      self.compartments = []
+      self.availability_domains = []
+      # region name -> its ADs, filled as the ADs are listed per region
+      self.ads_by_region = {}
+      cache = oci_service.cache
+      cache_ttl = float(oci_service.config.get('topology_cache_ttl_hours', 6)) * 3600
+
+      # get the identity client & the subscribed regions - always listed, a
+      # cached topology is only used while they are the same
+      identity_client = oci_service.clients.get( oci.identity.IdentityClient )
+      base_client = identity_client.base_client
+      self.regions = identity_client.list_region_subscriptions( self.tenancy_id, retry_strategy=retry_strategy_via_constructor ).data
+      logger.debug(" --- List of regions is --- ")
+      logger.debug(self.regions)
 
-      # get the identity client & tenancy objects
-      identity_client = oci.identity.IdentityClient(config = {}, signer=signer )
-      tenancy = identity_client.get_tenancy( self.tenancy_id, retry_strategy=retry_strategy_via_constructor ).data
+      cache_name = f'topology_{self.tenancy_id}'
+      cached = cache.get( cache_name, cache_ttl )
+      if cached is not None and not self.valid_topology( cached ):
+         logger.info("Tenancy - cached topology is out of date, listing it again.")
+         cached = None
+
+      if cached is not None:
+         tenancy = base_client.deserialize_response_data( json.dumps(cached[ 'tenancy' ]).encode('utf-8'), 'Tenancy' )
+         compartments = base_client.deserialize_response_data( json.dumps(cached[ 'compartments' ]).encode('utf-8'), 'list[Compartment]' )
+         for region in self.regions:
+            self.ads_by_region[ region.region_name ] = base_client.deserialize_response_data( json.dumps(cached[ 'availability_domains' ][ region.region_name ]).encode('utf-8'), 'list[AvailabilityDomain]' )
+      else:
+         # ADs of every region in parallel, while the compartments are listed
+         ad_jobs = {}
+         for region in self.regions:
+            regional_client = oci_service.clients.get( oci.identity.IdentityClient, region.region_name )
+            ad_jobs[ region.region_name ] = oci_service.scheduler.submit( regional_client.list_availability_domains, self.tenancy_id, retry_strategy=retry_strategy_via_constructor, region=region.region_name, service='identity' )
+
+         tenancy = identity_client.get_tenancy( self.tenancy_id, retry_strategy=retry_strategy_via_constructor ).data
+         compartments = list( paginate( identity_client.list_compartments, self.tenancy_id, compartment_id_in_subtree=True, access_level="ACCESSIBLE", retry_strategy=retry_strategy_via_constructor ) )
+         for region_name, job in ad_jobs.items():
+            self.ads_by_region[ region_name ] = job.result().data
+
+         cache.put( cache_name, {
+            'regions': sorted( region.region_name for region in self.regions ),
+            'tenancy': base_client.sanitize_for_serialization( tenancy ),
+            'compartments': base_client.sanitize_for_serialization( compartments ),
+            'availability_domains': { name: base_client.sanitize_for_serialization( ads ) for name, ads in self.ads_by_region.items() }
+         } )
 
       self.name = tenancy.name
       self.description = tenancy.description
       self.home_region = tenancy.home_region_key
 
-      # get list of regions
-      self.regions = identity_client.list_region_subscriptions( self.tenancy_id, retry_strategy=retry_strategy_via_constructor ).data
-      logger.debug(" --- List of regions is --- ")
-      logger.debug(self.regions)
-
       # create compartments list
       self.compartments.append( oci.identity.models.Compartment(compartment_id=tenancy.id, name=f'{tenancy.name} (root)', description=tenancy.description, id=tenancy.id) )
-      self.compartments += identity_client.list_compartments( self.tenancy_id, compartment_id_in_subtree=True, access_level="ACCESSIBLE", retry_strategy=retry_strategy_via_constructor ).data
+      self.compartments += compartments
       logger.debug(" --- List of compartments is --- ")
       logger.debug(self.compartments)
-      
-      # loop over each region
+
       for region in self.regions:
-         signer.region = region.region_name
-         identity_client = oci.identity.IdentityClient(config = {}, signer=signer)
-         
-         # add ADs for each region
-         self.availability_domains += identity_client.list_availability_domains(self.tenancy_id, retry_strategy=retry_strategy_via_constructor).data
+         self.availability_domains += self.ads_by_region[ region.region_name ]
 
       logger.debug(" --- List of ADs is --- ")
       logger.debug(self.availability_domains)
       
       logger.info("Tenancy - DONE.")
+
+   ### a cached topology must cover the regions subscribed now ###
+   ###############################################################
+   def valid_topology(self, cached):
+      try:
+         regions = sorted( region.region_name for region in self.regions )
+         return (
+            cached[ 'regions' ] == regions
+            and cached[ 'tenancy' ][ 'id' ] == self.tenancy_id
+            and all( cached[ 'availability_domains' ].get(name) for name in regions )
+            and isinstance( cached[ 'compartments' ], list )
+         )
+      except (KeyError, TypeError):
+         return False
       
    ### return the list of ACTIVE compartments ###
    ##############################################
@@ -247,62 +1922,40 @@ class Tenancy(object):
    ### return the list of ADs for a specific region ###
    ####################################################
    def get_availability_domains( self, region_name):
-      #return [e for e in availability.domains if e.region_name == region_name]
-      data = []
-      for ad in self.availability_domains:
-         s = ad.name.split( '-')
-         name = f'{s[0][5:].lower()}-{s[1].lower()}-{s[2].lower()}'
-         if name == region_name.lower():
-            data.append( ad )
-
-      return data
+      return self.ads_by_region.get( region_name, [] )
 
    ### upload tennancy data to object storage ###
    ##############################################
    def create_csv(self):
       # Report
-      data = 'tenancy_id, report_no'
-      data += '\n'
-      data += f'{self.tenancy_id}, {report_no}'
-
-      write_file( data, 'report' )
+      with CSVFile( self.uploads, 'report', [ 'tenancy_id', 'report_no' ] ) as csv_file:
+         csv_file.writerow( self.tenancy_id, self.report_no )
 
       # Region
-      data = 'tenancy_id, region_key, region_name, is_home_region, report_no'
-      
-      for region in self.regions:
-         data += '\n'
-         data += f'{self.tenancy_id}, {region.region_key}, {region.region_name}, {region.is_home_region}, {report_no}'
-      
-      write_file( data, 'region' )
+      with CSVFile( self.uploads, 'region', [ 'tenancy_id', 'region_key', 'region_name', 'is_home_region', 'report_no' ] ) as csv_file:
+         for region in self.regions:
+            csv_file.writerow( self.tenancy_id, region.region_key, region.region_name, region.is_home_region, self.report_no )
 
       # Compartment
-      data = 'compartment_id, name, description, tenancy_id, report_no'      
-
-      for compartment in self.compartments:
-         data += '\n'
-         data += f'{compartment.id}, {compartment.name}, {compartment.description}, {compartment.compartment_id}, {report_no}'
-
-      write_file( data, 'compartment' )
+      with CSVFile( self.uploads, 'compartment', [ 'compartment_id', 'name', 'description', 'tenancy_id', 'report_no' ] ) as csv_file:
+         for compartment in self.compartments:
+            csv_file.writerow( compartment.id, compartment.name, compartment.description, compartment.compartment_id, self.report_no )
 
       # Availability Domains
-      data = 'ad_id, ad_name, tenancy_id, region_name, report_no'
-      for ad in self.availability_domains:
-         s = ad.name.split( '-')
-         data += '\n'
-         data += f'{ad.id}, {ad.name}, {ad.compartment_id}, {s[0][5:].lower()}-{s[1].lower()}-{s[2].lower()}, {report_no}'
-
-      write_file( data, 'availability_domain' )
+      with CSVFile( self.uploads, 'availability_domain', [ 'ad_id', 'ad_name', 'tenancy_id', 'region_name', 'report_no' ] ) as csv_file:
+         for region_name, ads in self.ads_by_region.items():
+            for ad in ads:
+               csv_file.writerow( ad.id, ad.name, ad.compartment_id, region_name, self.report_no )
 
 class Announcement(object):
-   logger.info("Initiate Announcement object...")
-   
-   annoucements = []
+   def __init__(self, oci_service):      
+      self.uploads = oci_service.uploads
+      self.report_no = oci_service.report_no
+      self.tenancy_id = oci_service.config[ "tenancy" ]
 
-   def __init__(self, config, signer):      
       # get list of announcements
-      announcement_service = oci.announcements_service.AnnouncementClient( config={}, signer=signer )
-      self.announcements = announcement_service.list_announcements( config[ "tenancy" ], lifecycle_state=oci.announcements_service.models.AnnouncementSummary.LIFECYCLE_STATE_ACTIVE, sort_by="timeCreated", retry_strategy=retry_strategy_via_constructor ).data
+      announcement_service = oci_service.clients.get( oci.announcements_service.AnnouncementClient )
+      self.announcements = list( paginate( announcement_service.list_announcements, oci_service.config[ "tenancy" ], lifecycle_state=oci.announcements_service.models.AnnouncementSummary.LIFECYCLE_STATE_ACTIVE, sort_by="timeCreated", retry_strategy=retry_strategy_via_constructor ) )
 
       logger.debug(" --- List of Announcements is --- ")
       logger.debug(self.announcements)
@@ -311,189 +1964,250 @@ class Announcement(object):
       
    ### upload Announcement data to object storage ###
    ##################################################
-   def create_csv(self, config):
-      self.tenancy_id = config["tenancy"]
-      
-      data = 'affected_regions, announcement_type, announcement_id, reference_ticket_number, services, summary, time_updated, type, tenancy_id, report_no'
-
-      for announcement in self.announcements.items:
-         affected_regions = str(announcement.affected_regions).strip( '[]' ).replace( ',', '/' ).replace( "'",'' )
-         services = str(announcement.services).strip( '[]' ).replace( ',', '/' ).replace( "'",'' )
-         data += '\n'
-         data += f'{affected_regions}, {announcement.announcement_type}, {announcement.id}, {announcement.reference_ticket_number}, {services}, {announcement.summary}, {announcement.time_updated}, {announcement.type}, {self.tenancy_id}, {report_no}'
-         
-      write_file( data, 'announcement' )
+   def create_csv(self):
+      with CSVFile( self.uploads, 'announcement', [ 'affected_regions', 'announcement_type', 'announcement_id', 'reference_ticket_number', 'services', 'summary', 'time_updated', 'type', 'tenancy_id', 'report_no' ] ) as csv_file:
+         for announcement in self.announcements:
+            affected_regions = str(announcement.affected_regions).strip( '[]' ).replace( ',', '/' ).replace( "'",'' )
+            services = str(announcement.services).strip( '[]' ).replace( ',', '/' ).replace( "'",'' )
+            csv_file.writerow( affected_regions, announcement.announcement_type, announcement.id, announcement.reference_ticket_number, services, announcement.summary, announcement.time_updated, announcement.type, self.tenancy_id, self.report_no )
 
 class Limit(object):
-   logger.info("Initiate Limit object...")
-   
-   limit_summary = []
-
-   def __init__(self, config, tenancy, signer):
-      tenancy_id = config[ "tenancy" ]
-      jobs = []
+   def __init__(self, oci_service, tenancy):
+      self.uploads = oci_service.uploads
+      self.report_no = oci_service.report_no
+      self.tenancy_id = tenancy_id = oci_service.config[ "tenancy" ]
+      self.scheduler = scheduler = oci_service.scheduler
+      self.results = ResultStore( 'limit_summary' )
+      self.usage_jobs = []
+      cache = oci_service.cache
+      cache_ttl = float(oci_service.config.get('limits_cache_ttl_hours', 24)) * 3600
+      rate = float(oci_service.config.get('limits_rate', 10))
+
+      # future -> (region, limits client, rate limiter, service or None for list_services)
+      definition_jobs = {}
+      # limit definitions listed this run, per region - cached when complete
+      definitions = {}
 
       # loop over all regions
       for region in tenancy.regions:
-         signer.region = region.region_name
-         
-         limits_client = oci.limits.LimitsClient(config={}, signer=signer)
-         services = limits_client.list_services( tenancy_id, sort_by="name", retry_strategy=retry_strategy_via_constructor).data      
-
-         if services:
-            # oci.limits.models.ServiceSummary
-            for service in services:            
-               # get the limits per service
-               limits = limits_client.list_limit_values(tenancy_id, service_name=service.name, sort_by="name", retry_strategy=retry_strategy_via_constructor).data
-               
-               # initiate thread for service
-               thread = Thread(target = self.get_info, args=(service, limits_client, limits, tenancy_id, tenancy, signer.region))
-               jobs.append(thread)
-         
-      # start threads   
-      for job in jobs:
-         job.start()
-         
-      # join threads so we don't quit until all threads have finished
-      for job in jobs:
-         job.join()
+         limits_client = oci_service.clients.get( oci.limits.LimitsClient, region.region_name )
+         limiter = RateLimiter( rate )
+
+         # services and limit values rarely change - reuse them for a while
+         cached = cache.get( f'limits_{tenancy_id}_{region.region_name}', cache_ttl )
+         if cached is not None:
+            for service in cached[ 'services' ]:
+               limits = [ oci.limits.models.LimitValueSummary(**limit) for limit in cached[ 'limits' ][ service[ 'name' ] ] ]
+               self.queue_usage( limits_client, limiter, oci.limits.models.ServiceSummary(**service), limits, region.region_name )
+            continue
+
+         definitions[ region.region_name ] = { 'services': [], 'limits': {}, 'complete': True }
+         job = scheduler.submit( self.get_services, limits_client, tenancy_id, region=region.region_name, service='limits' )
+         definition_jobs[job] = ( region, limits_client, limiter, None )
+
+      # list the limit values of every service as soon as its region's
+      # services are known, and queue the usage lookups as soon as those are
+      pending = set(definition_jobs)
+      while pending:
+         done, pending = wait( pending, return_when=FIRST_COMPLETED )
+         for job in done:
+            region, limits_client, limiter, service = definition_jobs.pop(job)
+            definition = definitions[ region.region_name ]
+
+            try:
+               result = job.result()
+            except Exception as err:
+               logger.error(f'Failed to list limits for {region.region_name}.')
+               logger.exception(format_exception(type(err), err, err.__traceback__))
+               definition[ 'complete' ] = False
+               continue
+
+            if service is None:
+               for service in result:
+                  definition[ 'services' ].append( service )
+                  job = scheduler.submit( self.get_limit_values, limits_client, tenancy_id, service, region=region.region_name, service='limits' )
+                  definition_jobs[job] = ( region, limits_client, limiter, service )
+                  pending.add( job )
+            else:
+               definition[ 'limits' ][ service.name ] = result
+               self.queue_usage( limits_client, limiter, service, result, region.region_name )
+
+      for region_name, definition in definitions.items():
+         if definition[ 'complete' ]:
+            cache.put( f'limits_{tenancy_id}_{region_name}', {
+               'services': [ oci.util.to_dict(service) for service in definition[ 'services' ] ],
+               'limits': { name: [ oci.util.to_dict(limit) for limit in limits ] for name, limits in definition[ 'limits' ].items() }
+            } )
+
+      # wait so we don't quit until all tasks have finished
+      scheduler.gather(self.usage_jobs)
+      self.results.merge_into(self)
          
       logger.debug(" --- List of Limits is --- ")
       logger.debug(self.limit_summary)
       
       logger.info("Limit - DONE.")
-      
-   ### thread function - get all limits ###
-   ########################################
-   def get_info(self, service, limits_client, limits, tenancy_id, tenancy, region):
-      for limit in limits:
-         val = {
-                  'service_name': str(service.name),
-                  'service_description': str(service.description),
-                  'limit_name': str(limit.name),
-                  'availability_domain': ("" if limit.availability_domain is None else str(limit.availability_domain)),
-                  'scope_type': str(limit.scope_type),
-                  'value': str(limit.value),
-                  'used': "",
-                  'available': "",
-                  'region_name': str(region)
-         }
 
+   ### thread function - services with limits in a region ###
+   ###########################################################
+   def get_services(self, limits_client, tenancy_id):
+      return list( paginate( limits_client.list_services, tenancy_id, sort_by="name", retry_strategy=retry_strategy_via_constructor ) )
+
+   ### thread function - the limits of a service ###
+   #################################################
+   def get_limit_values(self, limits_client, tenancy_id, service):
+      return list( paginate( limits_client.list_limit_values, tenancy_id, service_name=service.name, sort_by="name", retry_strategy=retry_strategy_via_constructor ) )
+
+   ### queue a usage lookup for every limit that is set ###
+   ########################################################
+   def queue_usage(self, limits_client, limiter, service, limits, region_name):
+      for limit in limits:
          # if not limit, continue, don't calculate limit = 0
          if limit.value == 0:
             continue
 
-         # get usage per limit if available
-         usage = []
-         
-         if limit.scope_type == "AD":
-            usage = limits_client.get_resource_availability(service.name, limit.name, tenancy_id, availability_domain=limit.availability_domain, retry_strategy=retry_strategy_via_constructor).data
-         else:
-            usage = limits_client.get_resource_availability(service.name, limit.name, tenancy_id, retry_strategy=retry_strategy_via_constructor).data
+         # at most limits_rate usage lookups a second per region - the scheduler
+         # holds them back, so no worker sleeps waiting for the rate
+         self.usage_jobs.append( self.scheduler.submit(self.get_info, service, limits_client, limit, self.tenancy_id, region_name, region=region_name, service='limits', limiter=limiter) )
+
+   ### thread function - usage of one limit ###
+   ############################################
+   def get_info(self, service, limits_client, limit, tenancy_id, region):
+      val = {
+               'service_name': str(service.name),
+               'service_description': str(service.description),
+               'limit_name': str(limit.name),
+               'availability_domain': ("" if limit.availability_domain is None else str(limit.availability_domain)),
+               'scope_type': str(limit.scope_type),
+               'value': str(limit.value),
+               'used': "",
+               'available': "",
+               'region_name': str(region)
+      }
+
+      # get usage per limit if available
+      if limit.scope_type == "AD":
+         usage = limits_client.get_resource_availability(service.name, limit.name, tenancy_id, availability_domain=limit.availability_domain, retry_strategy=retry_strategy_via_constructor).data
+      else:
+         usage = limits_client.get_resource_availability(service.name, limit.name, tenancy_id, retry_strategy=retry_strategy_via_constructor).data
 
-         # oci.limits.models.ResourceAvailability
-         if usage.used:
-            val['used'] = str(usage.used)
-            
-         if usage.available:
-            val['available'] = str(usage.available)
+      # oci.limits.models.ResourceAvailability
+      if usage.used:
+         val['used'] = str(usage.used)
+         
+      if usage.available:
+         val['available'] = str(usage.available)
 
-         self.limit_summary.append(val)
+      self.results.append( 'limit_summary', val )
          
    ### upload Limit data to object storage ###
    ###########################################
-   def create_csv(self, config):
-      self.tenancy_id = config["tenancy"]
-      
-      data = 'region_name, service_name, service_description, limit_name, availability_domain, scope_type, value, used, available, tenancy_id, report_no'
-      for limit in self.limit_summary:
-         data += '\n'
-         data += f"{limit['region_name']}, {limit['service_name']}, {limit['service_description']}, {limit['limit_name']}, {limit['availability_domain']}, {limit['scope_type']}, {limit['value']}, {limit[ 'used' ]}, {limit[ 'available' ]}, {self.tenancy_id}, {report_no}"
-
-      write_file( data, 'limit' )
+   def create_csv(self):
+      with CSVFile( self.uploads, 'limit', [ 'region_name', 'service_name', 'service_description', 'limit_name', 'availability_domain', 'scope_type', 'value', 'used', 'available', 'tenancy_id', 'report_no' ] ) as csv_file:
+         for limit in self.limit_summary:
+            csv_file.writerow( limit['region_name'], limit['service_name'], limit['service_description'], limit['limit_name'], limit['availability_domain'], limit['scope_type'], limit['value'], limit[ 'used' ], limit[ 'available' ], self.tenancy_id, self.report_no )
 
 
 class Images(object):
-   logger.info("Initiate Images object...")
-   
-   images = []
-   
-   def __init__(self, config, tenancy, signer):
-      self.tenancy_id = config[ 'tenancy']
+   # Resource Search type of the custom images - platform images aren't
+   # resources of the tenancy
+   search_types = [ 'Image' ]
+
+   def __init__(self, oci_service, tenancy, search_index=None):
+      self.uploads = oci_service.uploads
+      self.report_no = oci_service.report_no
+      self.scheduler = scheduler = oci_service.scheduler
+      self.tenancy_id = oci_service.config[ 'tenancy']
+      self.results = ResultStore( 'images' )
+      self.search_index = search_index or SearchIndex.unplanned()
+      self.cache = oci_service.cache
+      cache_ttl = float(oci_service.config.get('images_cache_ttl_hours', 24)) * 3600
       jobs = []
       
       # loop over all regions
       for region in tenancy.regions:
-         signer.region = region.region_name
-         compute_client = oci.core.ComputeClient(config={}, signer=signer)
+         compute_client = oci_service.clients.get( oci.core.ComputeClient, region.region_name )
+
+         # the platform catalog is the same for every compartment - list it
+         # once per region and reuse it for a while
+         cached = self.cache.get( f'platform_images_{self.tenancy_id}_{region.region_name}', cache_ttl )
+         if cached is not None:
+            self.results.extend( 'images', compute_client.base_client.deserialize_response_data( json.dumps(cached).encode('utf-8'), 'list[Image]' ) )
+         else:
+            jobs.append( scheduler.submit(self.get_platform_images, compute_client, region, region=region.region_name, service='compute') )
          
          # loop over all compartments in each region
          for c in tenancy.get_compartments():
-            # initiate a thread for each compartment
-            thread = Thread(target = self.get_info, args=(c, compute_client, tenancy, region))
-            jobs.append(thread)
+            # queue a task for each compartment
+            if not self.search_index.wanted( region.region_name, c.id, self.search_types ):
+               continue
+
+            jobs.append( scheduler.submit(self.get_info, c, compute_client, tenancy, region, region=region.region_name, service='compute') )
       
-      # start threads
-      for job in jobs:
-         job.start()
-         
-      # join threads so we don't quit until all threads have finished
-      for job in jobs:
-         job.join()
+      # wait so we don't quit until all tasks have finished
+      scheduler.gather(jobs)
+      self.results.merge_into(self)
+
+      # an image is listed once whatever the number of listings it showed up in
+      self.images = list( { image.id: image for image in self.images }.values() )
                   
       logger.debug(" --- List of Images is --- ")
       logger.debug(self.images)
+
+   ### thread function - the platform images of a region ###
+   ##########################################################
+   def get_platform_images(self, compute_client, region):
+      images = [ image for image in paginate( compute_client.list_images, self.tenancy_id, prefetch=self.scheduler.prefetcher, retry_strategy=retry_strategy_via_constructor ) if image.compartment_id is None ]
+      self.results.extend( 'images', images )
+      self.cache.put( f'platform_images_{self.tenancy_id}_{region.region_name}', compute_client.base_client.sanitize_for_serialization(images) )
    
    ### thread function - get all info about images ###
    ######################################################
    def get_info(self, c, compute_client, tenancy, region):
-      # get all images
-      self.images += compute_client.list_images(c.id, retry_strategy=retry_strategy_via_constructor).data
+      # every listing repeats the platform images - keep the compartment's own.
+      # ListImages can't leave them out, so the pages are still fetched; only
+      # the search plan skips compartments without images
+      self.results.extend( 'images', ( image for image in paginate( compute_client.list_images, c.id, prefetch=self.scheduler.prefetcher, retry_strategy=retry_strategy_via_constructor ) if image.compartment_id == c.id ) )
    
    ### upload images data to object storage ###
    #############################################          
    def create_csv(self):
       # images
-      data = 'agent_features, base_image_id, compartment_id, display_name, id, launch_mode, boot_volume_type, firmware, network_type, operating_system, operating_system_version, size_in_mbs, time_created, report_no'
-
-      for image in self.images:
-         data += '\n'
-         data += f'{image.agent_features}, {image.base_image_id}, {image.compartment_id}, {image.display_name}, {image.id}, {image.launch_mode}, {image.launch_options.boot_volume_type}, {image.launch_options.firmware}, {image.launch_options.network_type}, {image.operating_system}, {image.operating_system_version}, {image.size_in_mbs}, {image.time_created}, {report_no}'
-
-      write_file( data, 'image' )
- 
+      with CSVFile( self.uploads, 'image', [ 'agent_features', 'base_image_id', 'compartment_id', 'display_name', 'id', 'launch_mode', 'boot_volume_type', 'firmware', 'network_type', 'operating_system', 'operating_system_version', 'size_in_mbs', 'time_created', 'report_no' ] ) as csv_file:
+         for image in self.images:
+            csv_file.writerow( image.agent_features, image.base_image_id, image.compartment_id, image.display_name, image.id, image.launch_mode, image.launch_options.boot_volume_type, image.launch_options.firmware, image.launch_options.network_type, image.operating_system, image.operating_system_version, image.size_in_mbs, image.time_created, self.report_no )
  
+
 class Compute(object):
-   logger.info("Initiate Compute object...")
-   
-   dedicated_hosts = []
-   instances = []
-   bv_attachments = []
-   vol_attachments = []
    tenancy_id = None
 
-   def __init__(self, config, tenancy, signer):
-      self.tenancy_id = config[ 'tenancy']
+   # Resource Search types that show a change in these listings
+   search_types = [ 'Instance', 'DedicatedVmHost', 'Volume', 'BootVolume' ]
+
+   def __init__(self, oci_service, tenancy, search_index=None):
+      self.uploads = oci_service.uploads
+      self.report_no = oci_service.report_no
+      self.scheduler = scheduler = oci_service.scheduler
+      self.tenancy_id = oci_service.config[ 'tenancy']
+      self.results = ResultStore( 'dedicated_hosts', 'instances', 'bv_attachments', 'vol_attachments' )
+      self.search_index = search_index or SearchIndex.unplanned()
       jobs = []
       
       # loop over all regions
       for region in tenancy.regions:
-         signer.region = region.region_name
-         compute_client = oci.core.ComputeClient(config={}, signer=signer)
+         compute_client = oci_service.clients.get( oci.core.ComputeClient, region.region_name )
          
          # loop over all compartments in each region
          for c in tenancy.get_compartments():
-            # initiate a thread for each compartment
-            thread = Thread(target = self.get_info, args=(c, compute_client, tenancy, region))
-            jobs.append(thread)
+            # queue a task for each compartment
+            if not self.search_index.wanted( region.region_name, c.id, self.search_types ):
+               continue
+
+            jobs.append( scheduler.submit(oci_service.state.run, self, self.search_index, compute_client, region.region_name, c.id, self.get_info, c, compute_client, tenancy, region, region=region.region_name, service='compute') )
       
-      # start threads
-      for job in jobs:
-         job.start()
-         
-      # join threads so we don't quit until all threads have finished
-      for job in jobs:
-         job.join()
+      # wait so we don't quit until all tasks have finished
+      scheduler.gather(jobs)
+      self.results.merge_into(self)
                   
       logger.debug(" --- List of Dedicated Hosts is --- ")
       logger.debug(self.dedicated_hosts)
@@ -510,83 +2224,78 @@ class Compute(object):
    ######################################################
    def get_info(self, c, compute_client, tenancy, region):
       # get all dedicated hosts
-      self.dedicated_hosts += compute_client.list_dedicated_vm_hosts(c.id, retry_strategy=retry_strategy_via_constructor).data
+      if self.search_index.wanted( region.region_name, c.id, [ 'DedicatedVmHost' ] ):
+         self.results.extend( 'dedicated_hosts', paginate( compute_client.list_dedicated_vm_hosts, c.id, retry_strategy=retry_strategy_via_constructor ) )
+
+      # attachments live in the compartment of their instance
+      if not self.search_index.wanted( region.region_name, c.id, [ 'Instance' ] ):
+         return
+
       # get all instances
-      self.instances += compute_client.list_instances(c.id, retry_strategy=retry_strategy_via_constructor).data
+      self.results.extend( 'instances', paginate( compute_client.list_instances, c.id, prefetch=self.scheduler.prefetcher, retry_strategy=retry_strategy_via_constructor ) )
       # get all volume attachments
-      self.vol_attachments += compute_client.list_volume_attachments(c.id, retry_strategy=retry_strategy_via_constructor).data
+      self.results.extend( 'vol_attachments', paginate( compute_client.list_volume_attachments, c.id, prefetch=self.scheduler.prefetcher, retry_strategy=retry_strategy_via_constructor ) )
             
       ads = tenancy.get_availability_domains(region.region_name)
       
       for ad in ads:
+         if not self.search_index.wanted( region.region_name, c.id, [ 'Instance' ], ad.name ):
+            continue
+
          # get all boot volume attachments
-         self.bv_attachments += compute_client.list_boot_volume_attachments( ad.name, c.id, retry_strategy=retry_strategy_via_constructor ).data
+         self.results.extend( 'bv_attachments', paginate( compute_client.list_boot_volume_attachments, ad.name, c.id, retry_strategy=retry_strategy_via_constructor ) )
 
       
    ### upload Compute data to object storage ###
    #############################################          
    def create_csv(self):
       # Dedicated VM Hosts
-      data = 'id, availability_domain, compartment_id, dedicated_vm_host_shape, display_name, fault_domain, lifecycle_state, remaining_ocpus, total_ocpus, report_no'
-
-      for host in self.dedicated_hosts:
-         data += '\n'
-         data += f'{host.id}, {host.availability_domain}, {host.compartment_id}, {host.dedicated_vm_host_shape}, {host.display_name}, {host.fault_domain}, {host.lifecycle_state}, {host.remaining_ocpus}, {host.total_ocpus}, {report_no}'
-
-      write_file( data, 'dedicated_vm_host' )
+      with CSVFile( self.uploads, 'dedicated_vm_host', [ 'id', 'availability_domain', 'compartment_id', 'dedicated_vm_host_shape', 'display_name', 'fault_domain', 'lifecycle_state', 'remaining_ocpus', 'total_ocpus', 'report_no' ] ) as csv_file:
+         for host in self.dedicated_hosts:
+            csv_file.writerow( host.id, host.availability_domain, host.compartment_id, host.dedicated_vm_host_shape, host.display_name, host.fault_domain, host.lifecycle_state, host.remaining_ocpus, host.total_ocpus, self.report_no )
 
       # VM Instances
-      data = 'instance_id, availability_domain, compartment_id, dedicated_vm_host_id, display_name, fault_domain, lifecycle_state, region, shape, tenancy_id, report_no'
-
-      for instance in self.instances:
-         data += '\n'
-         data += f'{instance.id}, {instance.availability_domain}, {instance.compartment_id}, {instance.dedicated_vm_host_id}, {instance.display_name}, {instance.fault_domain}, {instance.lifecycle_state}, {instance.region}, {instance.shape}, {self.tenancy_id}, {report_no}'
-
-      write_file( data, 'instance' )
+      with CSVFile( self.uploads, 'instance', [ 'instance_id', 'availability_domain', 'compartment_id', 'dedicated_vm_host_id', 'display_name', 'fault_domain', 'lifecycle_state', 'region', 'shape', 'tenancy_id', 'report_no' ] ) as csv_file:
+         for instance in self.instances:
+            csv_file.writerow( instance.id, instance.availability_domain, instance.compartment_id, instance.dedicated_vm_host_id, instance.display_name, instance.fault_domain, instance.lifecycle_state, instance.region, instance.shape, self.tenancy_id, self.report_no )
 
       # Boot Volume Attachments
-      data = 'id, availability_domain, boot_volume_id, compartment_id, display_name, instance_id, is_pv_encryption_in_transit_enabled, lifecycle_state, report_no'
-
-      for bv in self.bv_attachments:
-         data += '\n'
-         data += f'{bv.id}, {bv.availability_domain}, {bv.boot_volume_id}, {bv.compartment_id}, {bv.display_name}, {bv.instance_id}, {bv.is_pv_encryption_in_transit_enabled}, {bv.lifecycle_state}, {report_no}'
-
-      write_file( data, 'bv_attachment' )
+      with CSVFile( self.uploads, 'bv_attachment', [ 'id', 'availability_domain', 'boot_volume_id', 'compartment_id', 'display_name', 'instance_id', 'is_pv_encryption_in_transit_enabled', 'lifecycle_state', 'report_no' ] ) as csv_file:
+         for bv in self.bv_attachments:
+            csv_file.writerow( bv.id, bv.availability_domain, bv.boot_volume_id, bv.compartment_id, bv.display_name, bv.instance_id, bv.is_pv_encryption_in_transit_enabled, bv.lifecycle_state, self.report_no )
 
       # Block Volume Attachments
-      data = 'id, attachment_type, availability_domain, compartment_id, device, display_name, instance_id, is_pv_encryption_in_transit_enabled, is_read_only, is_shareable, lifecycle_state, volume_id, report_no'
-      for vol in self.vol_attachments:
-         data += '\n'
-         data += f'{vol.id}, {vol.attachment_type}, {vol.availability_domain}, {vol.compartment_id}, {vol.device}, {vol.display_name}, {vol.instance_id}, {vol.is_pv_encryption_in_transit_enabled}, {vol.is_read_only}, {vol.is_shareable}, {vol.lifecycle_state}, {vol.volume_id}, {report_no}'
-         write_file( data, 'vol_attachment' )
+      with CSVFile( self.uploads, 'vol_attachment', [ 'id', 'attachment_type', 'availability_domain', 'compartment_id', 'device', 'display_name', 'instance_id', 'is_pv_encryption_in_transit_enabled', 'is_read_only', 'is_shareable', 'lifecycle_state', 'volume_id', 'report_no' ] ) as csv_file:
+         for vol in self.vol_attachments:
+            csv_file.writerow( vol.id, vol.attachment_type, vol.availability_domain, vol.compartment_id, vol.device, vol.display_name, vol.instance_id, vol.is_pv_encryption_in_transit_enabled, vol.is_read_only, vol.is_shareable, vol.lifecycle_state, vol.volume_id, self.report_no )
 
 class BlockStorage(object):
-   logger.info("Initiate Block Storage object...")
-   
-   boot_volumes = []
-   block_volumes = []
-
-   def __init__(self, config, tenancy, signer):
+   # Resource Search types that show a change in these listings
+   search_types = [ 'Volume', 'BootVolume' ]
+
+   def __init__(self, oci_service, tenancy, search_index=None):
+      self.uploads = oci_service.uploads
+      self.report_no = oci_service.report_no
+      self.scheduler = scheduler = oci_service.scheduler
+      self.results = ResultStore( 'boot_volumes', 'block_volumes' )
+      self.search_index = search_index or SearchIndex.unplanned()
       jobs = []
       
       # loop over all regions
       for region in tenancy.regions:
-         signer.region = region.region_name
-         block_storage_client = oci.core.BlockstorageClient(config={}, signer=signer)
+         block_storage_client = oci_service.clients.get( oci.core.BlockstorageClient, region.region_name )
          
          # loop over all compartments from each region
          for c in tenancy.get_compartments():  
-            # initiate a thread for each compartment
-            thread = Thread(target = self.get_info, args=(c, block_storage_client, tenancy, region))
-            jobs.append(thread)
+            # queue a task for each compartment
+            if not self.search_index.wanted( region.region_name, c.id, self.search_types ):
+               continue
+
+            jobs.append( scheduler.submit(oci_service.state.run, self, self.search_index, block_storage_client, region.region_name, c.id, self.get_info, c, block_storage_client, tenancy, region, region=region.region_name, service='blockstorage') )
                
-      # start all threads
-      for job in jobs:
-         job.start()
-         
-      # join threads so we don't quit until all threads have finished
-      for job in jobs:
-         job.join()
+      # wait so we don't quit until all tasks have finished
+      scheduler.gather(jobs)
+      self.results.merge_into(self)
                   
       logger.debug(" --- List of Block Volumes is --- ")
       logger.debug(self.block_volumes)
@@ -600,65 +2309,57 @@ class BlockStorage(object):
    def get_info(self, c, block_storage_client, tenancy, region):     
       # get all block volumes
       ads = tenancy.get_availability_domains(region.region_name)
-      self.block_volumes += block_storage_client.list_volumes(c.id, retry_strategy=retry_strategy_via_constructor).data
+      if self.search_index.wanted( region.region_name, c.id, [ 'Volume' ] ):
+         self.results.extend( 'block_volumes', paginate( block_storage_client.list_volumes, compartment_id=c.id, prefetch=self.scheduler.prefetcher, retry_strategy=retry_strategy_via_constructor ) )
       
       for ad in ads:   
+         if not self.search_index.wanted( region.region_name, c.id, [ 'BootVolume' ], ad.name ):
+            continue
+
          # get all boot volumes from each AD         
-         self.boot_volumes += block_storage_client.list_boot_volumes(ad.name, c.id, retry_strategy=retry_strategy_via_constructor).data
+         self.results.extend( 'boot_volumes', paginate( block_storage_client.list_boot_volumes, availability_domain=ad.name, compartment_id=c.id, retry_strategy=retry_strategy_via_constructor ) )
          
    ### upload Block Storage data to object storage ###
    ###################################################      
    def create_csv(self):
       # Boot Volumes
-      data = 'id, availability_domain, compartment_id, display_name, image_id, is_hydrated, kms_key_id, lifecycle_state, size_in_gbs, size_in_mbs, volume_group_id, vpus_per_gb, report_no'
-
-      for bv in self.boot_volumes:
-         data += '\n'
-         data += f'{bv.id}, {bv.availability_domain}, {bv.compartment_id}, {bv.display_name}, {bv.image_id}, {bv.is_hydrated}, {bv.kms_key_id}, {bv.lifecycle_state}, {bv.size_in_gbs}, {bv.size_in_mbs}, {bv.volume_group_id}, {bv.vpus_per_gb}, {report_no}'
-
-      write_file( data, 'boot_volume' )
+      with CSVFile( self.uploads, 'boot_volume', [ 'id', 'availability_domain', 'compartment_id', 'display_name', 'image_id', 'is_hydrated', 'kms_key_id', 'lifecycle_state', 'size_in_gbs', 'size_in_mbs', 'volume_group_id', 'vpus_per_gb', 'report_no' ] ) as csv_file:
+         for bv in self.boot_volumes:
+            csv_file.writerow( bv.id, bv.availability_domain, bv.compartment_id, bv.display_name, bv.image_id, bv.is_hydrated, bv.kms_key_id, bv.lifecycle_state, bv.size_in_gbs, bv.size_in_mbs, bv.volume_group_id, bv.vpus_per_gb, self.report_no )
 
       # Block Volumes
-      data = 'id, availability_domain, compartment_id, display_name, is_hydrated, kms_key_id, lifecycle_state, size_in_gbs, size_in_mbs, volume_group_id, vpus_per_gb, report_no'
-
-      for bv in self.block_volumes:
-         data += '\n'
-         data += f'{bv.id}, {bv.availability_domain}, {bv.compartment_id}, {bv.display_name}, {bv.is_hydrated}, {bv.kms_key_id}, {bv.lifecycle_state}, {bv.size_in_gbs}, {bv.size_in_mbs}, {bv.volume_group_id}, {bv.vpus_per_gb}, {report_no}'
-
-      write_file( data, 'block_volume' )
+      with CSVFile( self.uploads, 'block_volume', [ 'id', 'availability_domain', 'compartment_id', 'display_name', 'is_hydrated', 'kms_key_id', 'lifecycle_state', 'size_in_gbs', 'size_in_mbs', 'volume_group_id', 'vpus_per_gb', 'report_no' ] ) as csv_file:
+         for bv in self.block_volumes:
+            csv_file.writerow( bv.id, bv.availability_domain, bv.compartment_id, bv.display_name, bv.is_hydrated, bv.kms_key_id, bv.lifecycle_state, bv.size_in_gbs, bv.size_in_mbs, bv.volume_group_id, bv.vpus_per_gb, self.report_no )
 
 class DBSystem(object):
-   logger.info("Initiate DB System object...")
-   
-   db_systems = []
-   db_homes = []
-   databases = []
-   dg_associations = []
-   autonomous_exadata = []
-   autonomous_cdb = []
-   autonomous_db = []
-
-   def __init__(self, config, tenancy, signer):
+   # Resource Search types that show a change in these listings
+   search_types = [ 'DbSystem', 'Database', 'AutonomousDatabase', 'AutonomousContainerDatabase', 'AutonomousExadataInfrastructure' ]
+
+   def __init__(self, oci_service, tenancy, search_index=None):
+      self.uploads = oci_service.uploads
+      self.report_no = oci_service.report_no
+      self.tenancy_id = oci_service.config[ 'tenancy']
+      self.scheduler = scheduler = oci_service.scheduler
+      self.results = ResultStore( 'db_systems', 'db_homes', 'databases', 'autonomous_exadata', 'autonomous_cdb', 'autonomous_db' )
+      self.search_index = search_index or SearchIndex.unplanned()
       jobs = []
       
       # loop over all regions
       for region in tenancy.regions:
-         signer.region = region.region_name
-         db_client = oci.database.DatabaseClient(config={}, signer=signer)
+         db_client = oci_service.clients.get( oci.database.DatabaseClient, region.region_name )
 
          # loop over all compartments from each region
          for c in tenancy.get_compartments():   
-            # initiate a thread for each compartment
-            thread = Thread(target = self.get_info, args=(c, db_client, tenancy, region))
-            jobs.append(thread)
-         
-      # start all threads
-      for job in jobs:
-         job.start()
+            # queue a task for each compartment
+            if not self.search_index.wanted( region.region_name, c.id, self.search_types ):
+               continue
+
+            jobs.append( scheduler.submit(oci_service.state.run, self, self.search_index, db_client, region.region_name, c.id, self.get_info, c, db_client, tenancy, region, region=region.region_name, service='database') )
          
-      # join threads so we don't quit until all threads have finished
-      for job in jobs:
-         job.join()
+      # wait so we don't quit until all tasks have finished
+      scheduler.gather(jobs)
+      self.results.merge_into(self)
          
       logger.debug(" --- List of DB Systems is --- ")
       logger.debug(self.db_systems)
@@ -678,186 +2379,710 @@ class DBSystem(object):
    ### thread function - get all info about DB Systems ###
    #######################################################
    def get_info(self, c, db_client, tenancy, region):  
+      region_name = region.region_name
+
       # get all db systems
-      self.db_systems += db_client.list_db_systems(c.id, retry_strategy=retry_strategy_via_constructor).data
+      if self.search_index.wanted( region_name, c.id, [ 'DbSystem' ] ):
+         self.results.extend( 'db_systems', paginate( db_client.list_db_systems, c.id, retry_strategy=retry_strategy_via_constructor ) )
 
-      # get all db homes
-      db_homes = db_client.list_db_homes(c.id, retry_strategy=retry_strategy_via_constructor).data
-      self.db_homes += db_homes
+      # get all db homes - the next page is fetched while we list the databases of this one
+      db_homes = []
+      if self.search_index.wanted( region_name, c.id, [ 'DbSystem', 'Database' ] ):
+         db_homes = paginate( db_client.list_db_homes, c.id, prefetch=self.scheduler.prefetcher, retry_strategy=retry_strategy_via_constructor )
 
       for db_home in db_homes:
+         self.results.append( 'db_homes', db_home )
+
          # get all databases from each db home
-         self.databases += db_client.list_databases(c.id, db_home_id=db_home.id, retry_strategy=retry_strategy_via_constructor).data
+         self.results.extend( 'databases', paginate( db_client.list_databases, c.id, db_home_id=db_home.id, retry_strategy=retry_strategy_via_constructor ) )
       
       # for db in databases:
       #    self.dg_associations += db_client.list_data_guard_associations(db.id).data             
       
       # get all autonomous exadata infra
-      self.autonomous_exadata += db_client.list_autonomous_exadata_infrastructures(c.id, retry_strategy=retry_strategy_via_constructor).data
+      if self.search_index.wanted( region_name, c.id, [ 'AutonomousExadataInfrastructure' ] ):
+         self.results.extend( 'autonomous_exadata', paginate( db_client.list_autonomous_exadata_infrastructures, c.id, retry_strategy=retry_strategy_via_constructor ) )
       # get all autonomous container dbs
-      self.autonomous_cdb += db_client.list_autonomous_container_databases(c.id, retry_strategy=retry_strategy_via_constructor).data
+      if self.search_index.wanted( region_name, c.id, [ 'AutonomousContainerDatabase' ] ):
+         self.results.extend( 'autonomous_cdb', paginate( db_client.list_autonomous_container_databases, c.id, retry_strategy=retry_strategy_via_constructor ) )
       # get all autonomous dbs
-      self.autonomous_db += db_client.list_autonomous_databases(c.id, retry_strategy=retry_strategy_via_constructor).data
+      if self.search_index.wanted( region_name, c.id, [ 'AutonomousDatabase' ] ):
+         self.results.extend( 'autonomous_db', paginate( db_client.list_autonomous_databases, c.id, prefetch=self.scheduler.prefetcher, retry_strategy=retry_strategy_via_constructor ) )
 
    ### upload DB Systems data to object storage ###
    ################################################
-   def create_csv(self, config):
-      self.tenancy_id = config["tenancy"]
-      
+   def create_csv(self):
       # DB System
-      data = 'id, availability_domain, cluster_name, compartment_id, cpu_core_count, data_storage_percentage, data_storage_size_in_gbs, database_edition, disk_redundancy, display_name, domain, hostname, lifecycle_state, node_count, reco_storage_size_in_gb, shape, sparse_diskgroup, version, region_id, tenancy_id, report_no'
-
-      for db_system in self.db_systems:
-         region_id = db_system.id.split(".")[3]
-         data += '\n'
-         data += f'{db_system.id}, {db_system.availability_domain}, {db_system.cluster_name}, {db_system.compartment_id}, {db_system.cpu_core_count}, {db_system.data_storage_percentage}, {db_system.data_storage_size_in_gbs}, {db_system.database_edition}, {db_system.disk_redundancy}, {db_system.display_name}, {db_system.domain}, {db_system.hostname}, {db_system.lifecycle_state}, {db_system.node_count}, {db_system.reco_storage_size_in_gb}, {db_system.shape}, {db_system.sparse_diskgroup}, {db_system.version}, {region_id}, {self.tenancy_id}, {report_no}'
-      
-      write_file( data, 'db_system' )
+      with CSVFile( self.uploads, 'db_system', [ 'id', 'availability_domain', 'cluster_name', 'compartment_id', 'cpu_core_count', 'data_storage_percentage', 'data_storage_size_in_gbs', 'database_edition', 'disk_redundancy', 'display_name', 'domain', 'hostname', 'lifecycle_state', 'node_count', 'reco_storage_size_in_gb', 'shape', 'sparse_diskgroup', 'version', 'region_id', 'tenancy_id', 'report_no' ] ) as csv_file:
+         for db_system in self.db_systems:
+            region_id = db_system.id.split(".")[3]
+            csv_file.writerow( db_system.id, db_system.availability_domain, db_system.cluster_name, db_system.compartment_id, db_system.cpu_core_count, db_system.data_storage_percentage, db_system.data_storage_size_in_gbs, db_system.database_edition, db_system.disk_redundancy, db_system.display_name, db_system.domain, db_system.hostname, db_system.lifecycle_state, db_system.node_count, db_system.reco_storage_size_in_gb, db_system.shape, db_system.sparse_diskgroup, db_system.version, region_id, self.tenancy_id, self.report_no )
 
       # DB Home
-      data = 'id, compartment_id, db_system_id, db_version, display_name, last_patch_history_entry_id, lifecycle_state, report_no'
-
-      for db_home in self.db_homes:
-         data += '\n'
-         data += f'{db_home.id}, {db_home.compartment_id}, {db_home.db_system_id}, {db_home.db_version}, {db_home.display_name}, {db_home.last_patch_history_entry_id}, {db_home.lifecycle_state}, {report_no}'
-
-      write_file( data, 'db_home' )
+      with CSVFile( self.uploads, 'db_home', [ 'id', 'compartment_id', 'db_system_id', 'db_version', 'display_name', 'last_patch_history_entry_id', 'lifecycle_state', 'report_no' ] ) as csv_file:
+         for db_home in self.db_homes:
+            csv_file.writerow( db_home.id, db_home.compartment_id, db_home.db_system_id, db_home.db_version, db_home.display_name, db_home.last_patch_history_entry_id, db_home.lifecycle_state, self.report_no )
       
       # Database
-      data = 'id, compartment_id, auto_backup_enabled, auto_backup_window, backup_destination_details, recovery_window_in_days, db_home_id, db_name, db_unique_name, db_workload, lifecycle_state, pdb_name, report_no'
+      with CSVFile( self.uploads, 'database', [ 'id', 'compartment_id', 'auto_backup_enabled', 'auto_backup_window', 'backup_destination_details', 'recovery_window_in_days', 'db_home_id', 'db_name', 'db_unique_name', 'db_workload', 'lifecycle_state', 'pdb_name', 'report_no' ] ) as csv_file:
+         for db in self.databases:
+            db_auto_backup_enabled = 'False' if db.db_backup_config == None else db.db_backup_config.auto_backup_enabled
+            db_auto_backup_window  = 'None' if db.db_backup_config == None else db.db_backup_config.auto_backup_window
+            db_backup_destination_details  = 'None' if db.db_backup_config == None else db.db_backup_config.backup_destination_details
+            db_recovery_window_in_days = 'None' if db.db_backup_config == None else db.db_backup_config.recovery_window_in_days
 
-      for db in self.databases:
-         data += '\n'
-         db_auto_backup_enabled = 'False' if db.db_backup_config == None else db.db_backup_config.auto_backup_enabled
-         db_auto_backup_window  = 'None' if db.db_backup_config == None else {db.db_backup_config.auto_backup_window}
-         db_backup_destination_details  = 'None' if db.db_backup_config == None else {db.db_backup_config.backup_destination_details}
-         db_recovery_window_in_days = 'None' if db.db_backup_config == None else {db.db_backup_config.recovery_window_in_days}
-
-         data += f'{db.id}, {db.compartment_id}, {db_auto_backup_enabled}, {db_auto_backup_window}, {db_backup_destination_details}, {db_recovery_window_in_days}, {db.db_home_id}, {db.db_name}, {db.db_unique_name}, {db.db_workload}, {db.lifecycle_state}, {db.pdb_name}, {report_no}'
-
-      write_file( data, 'database' )
+            csv_file.writerow( db.id, db.compartment_id, db_auto_backup_enabled, db_auto_backup_window, db_backup_destination_details, db_recovery_window_in_days, db.db_home_id, db.db_name, db.db_unique_name, db.db_workload, db.lifecycle_state, db.pdb_name, self.report_no )
 
       # DG Association
       # for db in self.databases:
       #    create_csv( f'' )
 
       # Autonomous Exadata
-      data = 'id, availability_domain, compartment_id, display_name, domain, hostname, last_maintenance_run_id, license_model, lifecycle_state, maintenance_window, next_maintenance_run_id, shape, report_no'
-
-      for auto_exadata in self.autonomous_exadata:
-         data += '\n'
-         data += f'{auto_exadata.id}, {auto_exadata.availability_domain}, {auto_exadata.compartment_id}, {auto_exadata.display_name}, {auto_exadata.domain}, {auto_exadata.hostname}, {auto_exadata.last_maintenance_run_id}, {auto_exadata.license_model}, {auto_exadata.lifecycle_state}, {auto_exadata.maintenance_window}, {auto_exadata.next_maintenance_run_id}, {auto_exadata.shape}, {report_no}'
-
-      write_file( data, 'autonomous_exadata' )
+      with CSVFile( self.uploads, 'autonomous_exadata', [ 'id', 'availability_domain', 'compartment_id', 'display_name', 'domain', 'hostname', 'last_maintenance_run_id', 'license_model', 'lifecycle_state', 'maintenance_window', 'next_maintenance_run_id', 'shape', 'report_no' ] ) as csv_file:
+         for auto_exadata in self.autonomous_exadata:
+            csv_file.writerow( auto_exadata.id, auto_exadata.availability_domain, auto_exadata.compartment_id, auto_exadata.display_name, auto_exadata.domain, auto_exadata.hostname, auto_exadata.last_maintenance_run_id, auto_exadata.license_model, auto_exadata.lifecycle_state, auto_exadata.maintenance_window, auto_exadata.next_maintenance_run_id, auto_exadata.shape, self.report_no )
 
       # Autonomous Container DB
-      data = 'id, autonomous_exadata_infrastructure_id, availability_domain, backup_config, compartment_id, display_name, last_maintenance_run_id, lifecycle_state, maintenance_window, next_maintenance_run_id, patch_model, service_level_agreement_type, report_no'
-
-      for acdb in self.autonomous_cdb:
-         data += '\n'
-         data += f'{acdb.id}, {acdb.autonomous_exadata_infrastructure_id}, {acdb.availability_domain}, {acdb.backup_config}, {acdb.compartment_id}, {acdb.display_name}, {acdb.last_maintenance_run_id}, {acdb.lifecycle_state}, {acdb.maintenance_window}, {acdb.next_maintenance_run_id}, {acdb.patch_model}, {acdb.service_level_agreement_type}, {report_no}'
-
-      write_file( data, 'autonomous_cdb' )
+      with CSVFile( self.uploads, 'autonomous_cdb', [ 'id', 'autonomous_exadata_infrastructure_id', 'availability_domain', 'backup_config', 'compartment_id', 'display_name', 'last_maintenance_run_id', 'lifecycle_state', 'maintenance_window', 'next_maintenance_run_id', 'patch_model', 'service_level_agreement_type', 'report_no' ] ) as csv_file:
+         for acdb in self.autonomous_cdb:
+            csv_file.writerow( acdb.id, acdb.autonomous_exadata_infrastructure_id, acdb.availability_domain, acdb.backup_config, acdb.compartment_id, acdb.display_name, acdb.last_maintenance_run_id, acdb.lifecycle_state, acdb.maintenance_window, acdb.next_maintenance_run_id, acdb.patch_model, acdb.service_level_agreement_type, self.report_no )
 
       # Autonomous DB     
-      data = 'id, autonomous_container_database_id, compartment_id, cpu_core_count, data_safe_status, data_storage_size_in_tbs, db_name, db_version, db_workload, display_name, is_auto_scaling_enabled, is_dedicated, is_free_tier, lifecycle_state, whitelisted_ips, report_no'
-      
-      for adb in self.autonomous_db:
-         data += '\n'
-         data += f'{adb.id}, {adb.autonomous_container_database_id}, {adb.compartment_id}, {adb.cpu_core_count}, {adb.data_safe_status},  {adb.data_storage_size_in_tbs}, {adb.db_name}, {adb.db_version}, {adb.db_workload}, {adb.display_name}, {adb.is_auto_scaling_enabled}, {adb.is_dedicated}, {adb.is_free_tier}, {adb.lifecycle_state}, {adb.whitelisted_ips}, {report_no}'
-
-      write_file( data, 'autonomous_db' )
-
+      with CSVFile( self.uploads, 'autonomous_db', [ 'id', 'autonomous_container_database_id', 'compartment_id', 'cpu_core_count', 'data_safe_status', 'data_storage_size_in_tbs', 'db_name', 'db_version', 'db_workload', 'display_name', 'is_auto_scaling_enabled', 'is_dedicated', 'is_free_tier', 'lifecycle_state', 'whitelisted_ips', 'report_no' ] ) as csv_file:
+         for adb in self.autonomous_db:
+            csv_file.writerow( adb.id, adb.autonomous_container_database_id, adb.compartment_id, adb.cpu_core_count, adb.data_safe_status, adb.data_storage_size_in_tbs, adb.db_name, adb.db_version, adb.db_workload, adb.display_name, adb.is_auto_scaling_enabled, adb.is_dedicated, adb.is_free_tier, adb.lifecycle_state, adb.whitelisted_ips, self.report_no )
+
+
+### Metric resolutions the Monitoring service aggregates to ###
+###############################################################
+METRIC_RESOLUTIONS = ( '1m', '5m', '1h' )
+
+### nearest-rank percentile of a sorted list ###
+################################################
+def percentile(values, fraction):
+   return values[ max(0, math.ceil(fraction * len(values)) - 1) ]
+
+### One metric series merged from its sub-queries ###
+#####################################################
+# Sub-queries return the same series in pieces (one per time slice). The
+# pieces are kept as they came and merged by timestamp while the series is
+# read, dropping the datapoints two neighbouring slices both returned.
+class MetricSeries(object):
+   def __init__(self, name, dimensions):
+      self.name = name
+      self.dimensions = dimensions
+      self.parts = []
+
+   def datapoints(self):
+      last = None
+      for datapoint in heapq.merge( *self.parts, key=lambda datapoint: datapoint.timestamp ):
+         if datapoint.timestamp != last:
+            last = datapoint.timestamp
+            yield datapoint
 
 class Monitoring(object):
-   logger.info("Initiate Monitoring object...")
-    
-   compute_metrics_data = []
-   autonomous_metrics_data = []
-
-   def __init__(self, config, tenancy, signer):      
-      jobs = []
+   def __init__(self, oci_service, tenancy):      
+      self.configure(oci_service, tenancy)
+      scheduler = oci_service.scheduler
+      queries = []
+
+      # queue a task for each slice and scope - the scheduler caps how many
+      # run against the region's Monitoring endpoint
+      for region_name, name, parts in self.queries(tenancy):
+         monitor = oci_service.clients.get( oci.monitoring.MonitoringClient, region_name )
+         queries.append( ( name, [ scheduler.submit(self.get_metrics, monitor, details, compartment_id, in_subtree, region=region_name, service='monitoring') for details, compartment_id, in_subtree in parts ] ) )
+
+      # merge the slices of every query as its tasks finish
+      for name, parts in queries:
+         self.merge( name, scheduler.gather(parts) )
+
+   ### settings of the queries (optional config keys) ###
+   ######################################################
+   def configure(self, oci_service, tenancy):
+      self.uploads = oci_service.uploads
+      self.report_no = oci_service.report_no
+      config = oci_service.config
+      self.tenancy_id = config[ 'tenancy']
       compute_metrics_list = [ ( 'CpuUtilization', 'mean' ),  ( 'MemoryUtilization', 'mean' ), ( 'DiskBytesRead', 'rate' ), ( 'DiskBytesWritten', 'rate' ), ( 'NetworksBytesIn', 'rate' ), ( 'NetworksBytesOut', 'rate' ) ]
       autonomous_metrics_list = [ ( 'CpuUtilization', 'mean' ),  ( 'StorageUtilization', 'mean' ), ('CurrentLogons', 'sum')]
 
+      # resolution, window and grouping of the queries (optional config keys)
+      self.resolution = config.get('metrics_resolution', '1m')
+      if self.resolution not in METRIC_RESOLUTIONS:
+         raise ValueError(f'metrics_resolution must be one of {", ".join(METRIC_RESOLUTIONS)}, not {self.resolution}')
+
+      self.group_by = config.get('metrics_group_by')
+
+      # raw - every datapoint, summary - one row of stats per resource
+      self.mode = config.get('metrics_mode', 'raw')
+
+      # the window ends at midnight - by default it is the previous day
+      end = datetime.datetime.combine( datetime.date.today(), datetime.time() )
+      start = end - datetime.timedelta( hours=float(config.get('metrics_window_hours', 24)) )
+      self.start_time = start.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+      self.end_time = end.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+      # split the window into slices so no response hits the datapoint limit
+      slice_length = datetime.timedelta( hours=float(config.get('metrics_slice_hours', 6)) )
+      self.slices = []
+      slice_start = start
+      while slice_start < end:
+         slice_end = min( slice_start + slice_length, end )
+         self.slices.append( ( slice_start.strftime('%Y-%m-%dT%H:%M:%S.000Z'), slice_end.strftime('%Y-%m-%dT%H:%M:%S.000Z') ) )
+         slice_start = slice_end
+
+      # one query for the whole tree, or one per compartment - groups could
+      # span compartments, so grouped queries always cover the whole tree
+      if str(config.get('metrics_split_compartments', 'false')).lower() == 'true' and not self.group_by:
+         self.scopes = [ ( c.id, False ) for c in tenancy.compartments if c.id == self.tenancy_id or c.lifecycle_state == 'ACTIVE' ]
+      else:
+         self.scopes = [ ( self.tenancy_id, True ) ]
+
+      self.metrics_lists = ( ( 'compute_metrics_data', 'oci_computeagent', compute_metrics_list ), ( 'autonomous_metrics_data', 'oci_autonomous_database', autonomous_metrics_list ) )
+      self.compute_metrics_data = []
+      self.autonomous_metrics_data = []
+
+   ### every query - (region, result list, [ (details, compartment, in subtree) ]) ###
+   ##################################################################################
+   def queries(self, tenancy):
+      grouping = f'.groupBy({self.group_by})' if self.group_by else ''
+
       # loop over each region in the tenancy
       for region in tenancy.regions:
-         signer.region = region.region_name
-         monitor = oci.monitoring.MonitoringClient(config={}, signer=signer)
-         start_time = (datetime.datetime.today() - datetime.timedelta(days=1)).strftime('%Y-%m-%dT00:00:00.000Z')
-         end_time = datetime.datetime.today().strftime('%Y-%m-%dT00:00:00.000Z')   
-         
-         # loop over the metrics in the compute_metrics_list
-         for metric in compute_metrics_list:
-            metrics_summary = oci.monitoring.models.SummarizeMetricsDataDetails( end_time=end_time, namespace='oci_computeagent', query=f'{metric[0]}[1m].{metric[1]}()', start_time=start_time)
-            
-            # initiate a thread for each metric
-            thread = Thread(target = self.get_metrics_compute, args=(region, config, monitor, metrics_summary))
-            jobs.append(thread)
-            
-         # loop over the metrics in the autonomous_metrics_list
-         for metric in autonomous_metrics_list:
-            metrics_summary = oci.monitoring.models.SummarizeMetricsDataDetails( end_time=end_time, namespace='oci_autonomous_database', query=f'{metric[0]}[1m].{metric[1]}()', start_time=start_time)
-            
-            # initiate a thread for each metric
-            thread = Thread(target = self.get_metrics_autonomous, args=(region, config, monitor, metrics_summary))
-            jobs.append(thread)
-            
-            
-      # start all threads
-      for job in jobs:
-         job.start()
-         
-      # join threads so we don't quit until all threads have finished
-      for job in jobs:
-         job.join()
-         
+         for name, namespace, metrics_list in self.metrics_lists:
+            # loop over the metrics in the list
+            for metric in metrics_list:
+               parts = []
+               for slice_start, slice_end in self.slices:
+                  metrics_summary = oci.monitoring.models.SummarizeMetricsDataDetails( end_time=slice_end, namespace=namespace, query=f'{metric[0]}[{self.resolution}]{grouping}.{metric[1]}()', start_time=slice_start)
+                  for compartment_id, in_subtree in self.scopes:
+                     parts.append( ( metrics_summary, compartment_id, in_subtree ) )
+
+               yield region.region_name, name, parts
+
+   ### merge the slices of one query into its series ###
+   #####################################################
+   def merge(self, name, results):
+      series = OrderedDict()
+      for metrics_data in results:
+         for metrics in metrics_data or []:
+            key = ( metrics.name, tuple(sorted(metrics.dimensions.items())) )
+            series.setdefault( key, MetricSeries(metrics.name, metrics.dimensions) ).parts.append( metrics.aggregated_datapoints )
+
+      # in summary mode the datapoints are dropped as soon as they are summarised
+      if self.mode == 'summary':
+         getattr(self, name).extend( self.summarize(metrics) for metrics in series.values() )
+      else:
+         getattr(self, name).extend( series.values() )
          
-   ### thread function - get all info about Compute Metrics ###
-   #######################################################
-   def get_metrics_compute(self, region, config, monitor, metrics_summary):  
-      self.compute_metrics_data += monitor.summarize_metrics_data( config[ "tenancy" ], metrics_summary, compartment_id_in_subtree=True, retry_strategy=retry_strategy_via_constructor).data
-   
-   ### thread function - get all info about Compute Metrics ###
-   #######################################################
-   def get_metrics_autonomous(self, region, config, monitor, metrics_summary):  
-       self.autonomous_metrics_data += monitor.summarize_metrics_data( config[ "tenancy" ], metrics_summary, compartment_id_in_subtree=True, retry_strategy=retry_strategy_via_constructor).data
-      
+   ### thread function - get one slice of a metric ###
+   ###################################################
+   def get_metrics(self, monitor, metrics_summary, compartment_id, in_subtree):  
+      return monitor.summarize_metrics_data( compartment_id, metrics_summary, compartment_id_in_subtree=in_subtree, retry_strategy=retry_strategy_via_constructor).data
+
+   ### the resource (or group) a series belongs to ###
+   ###################################################
+   def resource_id(self, metrics):
+      return metrics.dimensions.get( "resourceId", metrics.dimensions.get( self.group_by ) )
+
+   ### one row of stats for a series ###
+   #####################################
+   def summarize(self, metrics):
+      values = sorted( datapoint.value for datapoint in metrics.datapoints() )
+      if not values:
+         return [ metrics.name, self.resource_id(metrics), 0, None, None, None, None, None ]
+
+      return [ metrics.name, self.resource_id(metrics), len(values), values[0], values[-1], sum(values) / len(values), percentile(values, 0.5), percentile(values, 0.95) ]
+
    ### upload Metrics data to object storage ###
    ################################################
-   def create_csv(self, config):
-      self.tenancy_id = config["tenancy"]
-      
-      # write data for Compute Metrics
-      data = 'metric_name, resource_id, timestamp, value, tenancy_id, report_no'
-
-      for metrics in self.compute_metrics_data:
-         for datapoint in metrics.aggregated_datapoints:
-            data += '\n'
-            data += f'{metrics.name}, {metrics.dimensions[ "resourceId" ]}, {str(datapoint.timestamp)}, {datapoint.value}, {self.tenancy_id}, {report_no}'
+   def create_csv(self):
+      if self.mode == 'summary':
+         self.create_summary_csv()
+         return
 
-      write_file( data, 'metrics_compute' )
+      # write data for Compute Metrics
+      with CSVFile( self.uploads, 'metrics_compute', [ 'metric_name', 'resource_id', 'timestamp', 'value', 'tenancy_id', 'report_no' ] ) as csv_file:
+         for metrics in self.compute_metrics_data:
+            for datapoint in metrics.datapoints():
+               csv_file.writerow( metrics.name, self.resource_id(metrics), datapoint.timestamp, datapoint.value, self.tenancy_id, self.report_no )
       
       # write data for Autonomous DB Metrics
-      data = 'metric_name, resource_id, timestamp, value, tenancy_id, report_no'
+      with CSVFile( self.uploads, 'metrics_autonomous_db', [ 'metric_name', 'resource_id', 'timestamp', 'value', 'tenancy_id', 'report_no' ] ) as csv_file:
+         for metrics in self.autonomous_metrics_data:
+            for datapoint in metrics.datapoints():
+               csv_file.writerow( metrics.name, self.resource_id(metrics), datapoint.timestamp, datapoint.value, self.tenancy_id, self.report_no )
+
+   ### upload the per-resource summaries ###
+   #########################################
+   def create_summary_csv(self):
+      header = [ 'metric_name', 'resource_id', 'datapoints', 'min', 'max', 'mean', 'p50', 'p95', 'start_time', 'end_time', 'resolution', 'tenancy_id', 'report_no' ]
+
+      # write summaries for Compute Metrics
+      with CSVFile( self.uploads, 'metrics_compute_summary', header ) as csv_file:
+         for row in self.compute_metrics_data:
+            csv_file.writerow( *row, self.start_time, self.end_time, self.resolution, self.tenancy_id, self.report_no )
+
+      # write summaries for Autonomous DB Metrics
+      with CSVFile( self.uploads, 'metrics_autonomous_db_summary', header ) as csv_file:
+         for row in self.autonomous_metrics_data:
+            csv_file.writerow( *row, self.start_time, self.end_time, self.resolution, self.tenancy_id, self.report_no )
+
+
+### Column types of the tables ###
+##################################
+# Columns not listed here are strings. The csv formats ignore the types -
+# every value keeps its str() rendering there - the columnar ones write
+# typed columns with None (or the string 'None') as null.
+TABLE_TYPES = {
+   'region': { 'is_home_region': 'bool' },
+   'announcement': { 'time_updated': 'timestamp' },
+   'limit': { 'value': 'int', 'used': 'int', 'available': 'int' },
+   'image': { 'size_in_mbs': 'int', 'time_created': 'timestamp' },
+   'dedicated_vm_host': { 'remaining_ocpus': 'float', 'total_ocpus': 'float' },
+   'bv_attachment': { 'is_pv_encryption_in_transit_enabled': 'bool' },
+   'vol_attachment': { 'is_pv_encryption_in_transit_enabled': 'bool', 'is_read_only': 'bool', 'is_shareable': 'bool' },
+   'boot_volume': { 'is_hydrated': 'bool', 'size_in_gbs': 'int', 'size_in_mbs': 'int', 'vpus_per_gb': 'int' },
+   'block_volume': { 'is_hydrated': 'bool', 'size_in_gbs': 'int', 'size_in_mbs': 'int', 'vpus_per_gb': 'int' },
+   'db_system': { 'cpu_core_count': 'int', 'data_storage_percentage': 'int', 'data_storage_size_in_gbs': 'int', 'node_count': 'int', 'reco_storage_size_in_gb': 'int' },
+   'database': { 'auto_backup_enabled': 'bool', 'recovery_window_in_days': 'int' },
+   'autonomous_db': { 'cpu_core_count': 'int', 'data_storage_size_in_tbs': 'int', 'is_auto_scaling_enabled': 'bool', 'is_dedicated': 'bool', 'is_free_tier': 'bool' },
+   'metrics_compute': { 'timestamp': 'timestamp', 'value': 'float' },
+   'metrics_autonomous_db': { 'timestamp': 'timestamp', 'value': 'float' },
+   'metrics_compute_summary': { 'datapoints': 'int', 'min': 'float', 'max': 'float', 'mean': 'float', 'p50': 'float', 'p95': 'float' },
+   'metrics_autonomous_db_summary': { 'datapoints': 'int', 'min': 'float', 'max': 'float', 'mean': 'float', 'p50': 'float', 'p95': 'float' },
+}
+
+### convert a value for a typed column ###
+##########################################
+def typed_value(value, column_type):
+   if value is None or value == 'None':
+      return None
+   # the collectors leave unknown numbers (e.g. limit usage) as ''
+   if value == '' and column_type != 'string':
+      return None
+   if column_type == 'int':
+      return int(value)
+   if column_type == 'float':
+      return float(value)
+   if column_type == 'bool':
+      return value if isinstance(value, bool) else str(value) == 'True'
+   if column_type == 'timestamp':
+      return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(str(value))
+   return str(value)
+
+### Output formats ###
+######################
+# csv (the default), csv.gz, parquet and arrow (Arrow IPC file). Each table
+# gets a writer from the format; it buffers into a spooled file and hands
+# the file over for the upload when the table is done.
+SPOOL_SIZE = 8 * 1024 * 1024
+
+OUTPUT_FORMATS = ( 'csv', 'csv.gz', 'parquet', 'arrow' )
+
+class OutputFormat(object):
+   def __init__(self, name='csv', compression=None):
+      if name not in OUTPUT_FORMATS:
+         raise ValueError(f'output_format must be one of {", ".join(OUTPUT_FORMATS)}, not {name}')
+      if name in ( 'parquet', 'arrow' ) and pyarrow is None:
+         raise ValueError(f'output_format {name} needs the pyarrow package')
+
+      self.name = name
+      self.compression = compression
+
+   def writer(self, table, header):
+      if self.name == 'csv':
+         return CSVWriter(header)
+      if self.name == 'csv.gz':
+         return GzipCSVWriter(header)
+      if self.name == 'parquet':
+         return ParquetWriter(table, header, self.compression or 'zstd')
+      return ArrowWriter(table, header, self.compression)
+
+### csv - rows through the csv module, so commas in names are quoted ###
+########################################################################
+class CSVWriter(object):
+   extension = 'csv'
+   content_type = 'text/csv'
+   compressed = False
+
+   def __init__(self, header):
+      self.buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+      self.text = io.TextIOWrapper(self.open(self.buffer), encoding='utf-8', newline='')
+      self.writer = csv.writer(self.text, lineterminator='\n')
+      self.writer.writerow(header)
+
+   def open(self, buffer):
+      return buffer
+
+   ### write one row - values keep their str() rendering ###
+   #########################################################
+   def writerow(self, values):
+      self.writer.writerow( [ str(v) for v in values ] )
+
+   ### the finished file, ready to upload ###
+   ##########################################
+   def finish(self):
+      self.text.flush()
+      self.text.detach()
+      return self.buffer
+
+   def close(self):
+      self.text.close()
+      self.buffer.close()
+
+### csv.gz - the same csv, gzipped while it is written ###
+##########################################################
+class GzipCSVWriter(CSVWriter):
+   extension = 'csv.gz'
+   content_type = 'application/gzip'
+   compressed = True
+
+   def open(self, buffer):
+      self.gzip = gzip.GzipFile(fileobj=buffer, mode='wb')
+      return self.gzip
+
+   def finish(self):
+      self.text.flush()
+      self.text.detach()
+      # closing the gzip stream writes the trailer, the buffer stays open
+      self.gzip.close()
+      return self.buffer
+
+### parquet - typed columns, written a row group at a time ###
+##############################################################
+class ParquetWriter(object):
+   extension = 'parquet'
+   content_type = 'application/vnd.apache.parquet'
+   compressed = True
+   batch_rows = 64 * 1024
+
+   def __init__(self, table, header, compression):
+      types = TABLE_TYPES.get(table, {})
+      self.column_types = [ types.get(column, 'string') for column in header ]
+      self.schema = pyarrow.schema( [ ( column, self.arrow_type(column_type) ) for column, column_type in zip(header, self.column_types) ] )
+      self.columns = [ [] for column in header ]
+      self.buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+      self.sink = pyarrow.PythonFile(self.buffer, mode='w')
+      self.writer = self.open(compression)
+
+   def open(self, compression):
+      return pyarrow.parquet.ParquetWriter(self.sink, self.schema, compression=compression)
+
+   @staticmethod
+   def arrow_type(column_type):
+      return {
+         'int': pyarrow.int64(),
+         'float': pyarrow.float64(),
+         'bool': pyarrow.bool_(),
+         'timestamp': pyarrow.timestamp('us', tz='UTC'),
+      }.get(column_type, pyarrow.string())
+
+   def writerow(self, values):
+      for column, column_type, value in zip(self.columns, self.column_types, values):
+         column.append( typed_value(value, column_type) )
+
+      if len(self.columns[0]) >= self.batch_rows:
+         self.flush()
+
+   def flush(self):
+      if self.columns[0]:
+         self.write( pyarrow.record_batch( self.columns, schema=self.schema ) )
+         self.columns = [ [] for column in self.columns ]
+
+   def write(self, batch):
+      self.writer.write_batch(batch)
+
+   def finish(self):
+      # a table that can't be finished is never uploaded - close the pyarrow
+      # writer and the spooled buffer, as close() does for a failed table
+      try:
+         self.flush()
+         self.writer.close()
+      except Exception:
+         self.close()
+         raise
+
+      return self.buffer
+
+   ### close the pyarrow writer of a half written table ###
+   ########################################################
+   # Left open, its __del__ fails later on the closed buffer and the logged
+   # "I/O operation on closed file" hides the error that stopped the table.
+   def abort(self):
+      try:
+         self.writer.close()
+      except Exception as err:
+         logger.debug(f'Failed to close the {self.extension} writer: {err}')
+
+   def close(self):
+      self.abort()
+      self.buffer.close()
+
+### arrow - Arrow IPC file, optionally lz4/zstd compressed buffers ###
+######################################################################
+class ArrowWriter(ParquetWriter):
+   extension = 'arrow'
+   content_type = 'application/vnd.apache.arrow.file'
+
+   def open(self, compression):
+      return pyarrow.ipc.new_file( self.sink, self.schema, options=pyarrow.ipc.IpcWriteOptions(compression=compression) )
+
+### One table ###
+#################
+# create_csv writes every table through this, whatever the output format.
+# The table is uploaded when the "with" block exits.
+class CSVFile(object):
+   def __init__(self, uploads, filename, header):
+      self.uploads = uploads
+      self.filename = filename
+      self.start_time = time.time()
+      self.writer = uploads.output.writer(filename, header)
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, type, value, tb):
+      # don't upload a half written table
+      if type is None:
+         self.upload()
+      else:
+         self.writer.close()
 
-      for metrics in self.autonomous_metrics_data:
-         for datapoint in metrics.aggregated_datapoints:
-            data += '\n'
-            data += f'{metrics.name}, {metrics.dimensions[ "resourceId" ]}, {str(datapoint.timestamp)}, {datapoint.value}, {self.tenancy_id}, {report_no}'
+   def writerow(self, *values):
+      self.writer.writerow( values )
 
-      write_file( data, 'metrics_autonomous_db' )
+   def upload(self):
+      body = self.writer.finish()
+      try:
+         self.uploads.write_file( body, self.filename, self.writer.extension, self.writer.content_type, compress=not self.writer.compressed )
+      finally:
+         body.close()
+
+      self.uploads.record( self.filename, time.time() - self.start_time )
+
+### Upload body - streams a file object with a known length ###
+###############################################################
+# requests only sends a Content-Length for a stream it can size; asking a
+# spooled file for fileno() would force it to disk, so wrap it instead.
+class UploadBody(object):
+   def __init__(self, fileobj, chunk_size=64 * 1024):
+      self.fileobj = fileobj
+      self.chunk_size = chunk_size
+      self.fileobj.seek(0, io.SEEK_END)
+      self.size = self.fileobj.tell()
+      self.fileobj.seek(0)
+
+   def __len__(self):
+      return self.size
+
+   def read(self, size=-1):
+      return self.fileobj.read(size)
+
+   def __iter__(self):
+      return iter(lambda: self.fileobj.read(self.chunk_size), b'')
+
+   def rewind(self):
+      self.fileobj.seek(0)
+
+class DuplicateUploadError(Exception):
+   pass
+
+### Upload compression ###
+############################
+# Compresses a finished table into a new spooled file before the upload,
+# on the upload worker that serialised it, so collectors never wait on it.
+# The object gets the codec's suffix and the codec's Content-Type, not a
+# Content-Encoding header - clients that honour it would decompress the
+# object on download and the .gz/.zst name would no longer fit.
+UPLOAD_CODECS = { 'gzip': ( 'gz', 'application/gzip' ), 'zstd': ( 'zst', 'application/zstd' ) }
+
+class Compressor(object):
+   def __init__(self, codec, level=None):
+      if codec not in UPLOAD_CODECS:
+         raise ValueError(f'upload_compression must be one of {", ".join(UPLOAD_CODECS)}, not {codec}')
+      if codec == 'zstd' and zstandard is None:
+         raise ValueError('upload_compression zstd needs the zstandard package')
+
+      self.codec = codec
+      self.extension, self.content_type = UPLOAD_CODECS[codec]
+      self.level = level
+
+   def compress(self, fileobj):
+      compressed = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+      fileobj.seek(0)
+
+      if self.codec == 'gzip':
+         stream = gzip.GzipFile( fileobj=compressed, mode='wb', compresslevel=6 if self.level is None else self.level, mtime=0 )
+      else:
+         stream = zstandard.ZstdCompressor( level=3 if self.level is None else self.level ).stream_writer( compressed, closefd=False )
+
+      shutil.copyfileobj( fileobj, stream, 1024 * 1024 )
+      stream.close()
+      return compressed
+
+### PAR uploader ###
+#####################
+# Uploads tables through the pre-authenticated request (PAR) URL from the
+# config. One pooled session keeps TLS connections to the PAR endpoint
+# open between files, every request has a timeout and is retried with full
+# jitter backoff on connection errors, 429 and 5xx, and anything that still
+# fails raises. Bodies above multipart_threshold go up as an Object Storage
+# multipart upload with parts sent in parallel.
+#
+# With a compressor, bodies that aren't compressed already are compressed
+# first; bytes counts what was sent, raw_bytes the table before that.
+#
+# Every table is counted (writes and bytes) and may only be written once
+# per report - a second write raises DuplicateUploadError instead of
+# silently overwriting the object with another PUT.
+class Uploader(object):
+   def __init__(self, par_url, report_no, pool_size=8, timeout=(10, 120), max_attempts=6,
+                multipart_threshold=128 * 1024 * 1024, part_size=32 * 1024 * 1024, part_workers=4, compressor=None, stats=None):
+      self.par_url = par_url
+      self.compressor = compressor
+      self.stats = stats or CallStats()
+      self.report_no = report_no
+      self.timeout = timeout
+      self.max_attempts = max_attempts
+      self.multipart_threshold = multipart_threshold
+      self.part_size = part_size
+      self.part_workers = part_workers
+
+      # multipart access URIs are relative to the PAR host
+      url = urllib.parse.urlsplit(par_url)
+      self.host = f'{url.scheme}://{url.netloc}'
+      self.region = url.netloc.split('.')[1] if url.netloc.startswith('objectstorage.') else None
+
+      self.session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter( pool_connections=1, pool_maxsize=pool_size + part_workers )
+      self.session.mount( 'https://', adapter )
+      self.session.mount( 'http://', adapter )
+      self.part_executor = ThreadPoolExecutor(max_workers=part_workers, thread_name_prefix='oci-part')
+
+      self.lock = Lock()
+      self.tables = OrderedDict()
+
+   def object_url(self, filename, extension='csv'):
+      return f'{self.par_url}{filename}_{self.report_no}.{extension}'
+
+   ### upload one table - returns the number of bytes sent ###
+   ###########################################################
+   def put(self, filename, body, extension='csv', content_type='text/csv', compress=True):
+      headers = { 'Content-Type': content_type }
+
+      with self.lock:
+         stats = self.tables.setdefault( filename, { 'writes': 0, 'bytes': 0, 'raw_bytes': 0 } )
+         stats[ 'writes' ] += 1
+         if stats[ 'writes' ] > 1:
+            raise DuplicateUploadError(f'Table {filename} was already uploaded for report {self.report_no} ({stats["writes"]} writes).')
+
+      raw_size = len( UploadBody(body) )
+      compressed = None
+      if compress and self.compressor is not None:
+         compressed = body = self.compressor.compress( body )
+         extension = f'{extension}.{self.compressor.extension}'
+         headers[ 'Content-Type' ] = self.compressor.content_type
 
+      try:
+         body = UploadBody( body )
+         url = self.object_url(filename, extension)
 
-### Upload data to Object Storage ###
-#####################################
-def write_file( strdata, filename ):
-   global report_no
-   global par_url
+         if len(body) > self.multipart_threshold:
+            logger.info(f'Uploading file: {url} to object storage ({len(body)} bytes, multipart).')
+            self.put_multipart(url, body, headers)
+         else:
+            logger.info(f'Uploading file: {url} to object storage.')
+            self.request('PUT', url, body, headers)
+      finally:
+         if compressed is not None:
+            compressed.close()
 
-   try:
-      resp = requests.put( f'{par_url}{filename}_{report_no}.csv', data=strdata.encode('utf-8'))
-      logger.info(f'Uploading file: {par_url}{filename}_{report_no}.csv to object storage.')
-   except Exception as err:
-      logger.error( f'Failed to upload file : {filename}_{report_no}')
-      logger.error(err)
+      with self.lock:
+         stats[ 'bytes' ] += len(body)
+         stats[ 'raw_bytes' ] += raw_size
+
+      return len(body)
+
+   ### multipart upload - parts are read in order and sent in parallel ###
+   ########################################################################
+   def put_multipart(self, url, body, headers):
+      resp = self.request('PUT', url, headers=dict(headers, **{ 'opc-multipart': 'true' }))
+      upload_url = self.host + resp.json()[ 'accessUri' ]
+
+      try:
+         parts = deque()
+         part_no = 0
+
+         while True:
+            data = body.read(self.part_size)
+            if not data:
+               break
+
+            # keep at most part_workers parts in memory
+            if len(parts) >= self.part_workers:
+               parts.popleft().result()
+
+            part_no += 1
+            parts.append( self.part_executor.submit(bind_collector(self.request), 'PUT', f'{upload_url}{part_no}', data) )
+
+         for part in parts:
+            part.result()
+
+         self.request('POST', upload_url)
+      except Exception:
+         # don't leave an uncommitted upload behind
+         try:
+            self.session.delete(upload_url, timeout=self.timeout)
+         except Exception as err:
+            logger.error(f'Failed to abort multipart upload: {err}')
+         raise
+
+   ### one HTTP request with timeout, status check and retries ###
+   ###############################################################
+   def request(self, method, url, body=None, headers=None):
+      start = time.monotonic()
+      throttles = 0
+      attempt = 0
+      failed = True
+
+      try:
+         for attempt in range(1, self.max_attempts + 1):
+            if isinstance(body, UploadBody):
+               body.rewind()
+
+            try:
+               resp = self.session.request(method, url, data=body, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as err:
+               error = err
+            else:
+               if resp.status_code < 300:
+                  failed = False
+                  return resp
+
+               # only throttling and server errors are worth another try
+               if resp.status_code != 429 and resp.status_code < 500:
+                  resp.raise_for_status()
+
+               throttles += int(resp.status_code == 429)
+               error = requests.HTTPError(f'{resp.status_code} {resp.reason} for {method} {url}', response=resp)
+
+            if attempt < self.max_attempts:
+               sleep_time = random.uniform(0, min(60, 2 ** attempt))
+               logger.warning(f'Upload attempt {attempt} failed ({error}), retrying in {sleep_time:.1f}s.')
+               time.sleep(sleep_time)
+
+         raise error
+      finally:
+         self.stats.record(
+            current_collector(), 'objectstorage', method.lower(), self.region,
+            time.monotonic() - start,
+            attempts=attempt,
+            throttles=throttles,
+            size=len(body) if body is not None else 0,
+            error=failed
+         )
+
+   def close(self):
+      self.part_executor.shutdown(wait=True)
+      self.session.close()